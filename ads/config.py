@@ -8,6 +8,28 @@ class Settings(BaseSettings):
     mongodb_collection: str = "ads"
     mongodb_username: str = "admin"
     mongodb_password: str = "password"
+    # MongoDB runs as a replica set (change streams, transactions); with its name the client
+    # discovers the members, without it the configured host is connected to directly
+    mongodb_replica_set: str = ""
+    drop_unknown_indexes: bool = False
+    # Token internal callers send as X-Admin-Token to reach /admin/indexes; empty disables it
+    admin_token: str = ""
+    
+    # Pagination
+    count_cache_ttl: float = 5.0
+    
+    # Ad serving
+    impressions_collection: str = "ad_impressions"
+    # Seconds between reloads of the active ads, picking up writes made through other replicas
+    ad_snapshot_refresh_interval: float = 30.0
+    impression_flush_interval: float = 5.0
+    # Impressions an ad may run ahead of an even spread of its daily cap
+    pacing_burst: int = 10
+    # Impressions of one ad per viewer within frequency_window seconds; 0 disables capping
+    frequency_cap: int = 3
+    frequency_window: float = 3600.0
+    frequency_max_viewers: int = 100000
+    serve_max_ads: int = 10
     
     class Config:
         env_file = ".env"
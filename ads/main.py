@@ -1,13 +1,18 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime
 from bson import ObjectId
+import asyncio
+import hmac
 import logging
 from typing import List, Optional
 
 from config import settings
-from database import connect_to_mongo, close_mongo_connection, get_collection
+from instrumentation import instrument
+from database import connect_to_mongo, close_mongo_connection, get_collection, get_index_report
+from pagination import apply_cursor, sort_spec, next_cursor, count_cache
 from models import Ad, AdCreate, AdUpdate, AdList
+from serving import ad_server
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,12 +29,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+instrument(app, "ads")
+
+ad_server_runner: Optional[asyncio.Task] = None
+
 @app.on_event("startup")
 async def startup_db_client():
+    global ad_server_runner
     await connect_to_mongo()
+    ad_server_runner = asyncio.create_task(ad_server.run(
+        get_collection(settings.mongodb_collection),
+        get_collection(settings.impressions_collection)
+    ))
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if ad_server_runner:
+        ad_server_runner.cancel()
+        # Let it flush the impressions counted so far
+        await asyncio.gather(ad_server_runner, return_exceptions=True)
     await close_mongo_connection()
 
 @app.post("/ads", response_model=Ad)
@@ -43,6 +61,8 @@ async def create_ad(ad_data: AdCreate):
         ad_dict["updated_at"] = datetime.utcnow()
         
         result = await collection.insert_one(ad_dict)
+        count_cache.clear()
+        ad_server.refresh_soon()
         ad_dict["id"] = str(result.inserted_id)
         
         return Ad(**ad_dict)
@@ -55,7 +75,9 @@ async def create_ad(ad_data: AdCreate):
 async def list_ads(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
-    is_active: Optional[bool] = Query(None)
+    is_active: Optional[bool] = Query(None),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from a previous page's next_cursor; replaces skip"),
+    with_total: bool = Query(True, description="Include the (briefly cached) total count")
 ):
     """List advertisements with optional filtering."""
     try:
@@ -66,12 +88,15 @@ async def list_ads(
         if is_active is not None:
             filter_query["is_active"] = is_active
         
-        # Get total count
-        total = await collection.count_documents(filter_query)
+        # Get total count (optional, briefly cached)
+        total = await count_cache.count(collection, filter_query) if with_total else None
         
-        # Get ads with pagination
-        cursor = collection.find(filter_query).skip(skip).limit(limit).sort("created_at", -1)
-        ads = await cursor.to_list(length=limit)
+        # Get ads with keyset pagination when a cursor is given, offset pagination otherwise
+        page_query = apply_cursor(filter_query, "created_at", -1, cursor)
+        db_cursor = collection.find(page_query).sort(sort_spec("created_at", -1)).limit(limit)
+        if not cursor:
+            db_cursor = db_cursor.skip(skip)
+        ads = await db_cursor.to_list(length=limit)
         
         # Convert ObjectId to string
         for ad in ads:
@@ -79,9 +104,12 @@ async def list_ads(
         
         return AdList(
             ads=[Ad(**ad) for ad in ads],
-            total=total
+            total=total,
+            next_cursor=next_cursor(ads, "created_at", limit)
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error listing ads: {e}")
         raise HTTPException(status_code=500, detail=f"Error listing ads: {str(e)}")
@@ -105,6 +133,21 @@ async def get_active_ads():
         logger.error(f"Error getting active ads: {e}")
         raise HTTPException(status_code=500, detail=f"Error getting active ads: {str(e)}")
 
+@app.get("/ads/serve")
+async def serve_ads(
+    slot: str = Query(..., min_length=1, max_length=100),
+    n: int = Query(1, ge=1, le=settings.serve_max_ads),
+    viewer: Optional[str] = Query(None, max_length=200, description="Stable viewer id (e.g. a session id) for frequency capping")
+):
+    """Pick ads for a slot by weight, honouring pacing and frequency caps."""
+    if not ad_server.ready:
+        raise HTTPException(status_code=503, detail="Ads are not loaded yet", headers={"Retry-After": "1"})
+    try:
+        return {"slot": slot, "ads": ad_server.serve(slot, n, viewer)}
+    except Exception as e:
+        logger.error(f"Error serving ads: {e}")
+        raise HTTPException(status_code=500, detail=f"Error serving ads: {str(e)}")
+
 @app.get("/ads/{ad_id}", response_model=Ad)
 async def get_ad(ad_id: str):
     """Get a specific advertisement by ID."""
@@ -144,6 +187,8 @@ async def update_ad(ad_id: str, ad_update: AdUpdate):
             {"_id": ObjectId(ad_id)},
             {"$set": update_data}
         )
+        count_cache.clear()
+        ad_server.refresh_soon()
         
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Ad not found")
@@ -167,6 +212,8 @@ async def delete_ad(ad_id: str):
         collection = get_collection(settings.mongodb_collection)
         
         result = await collection.delete_one({"_id": ObjectId(ad_id)})
+        count_cache.clear()
+        ad_server.refresh_soon()
         
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Ad not found")
@@ -204,6 +251,20 @@ async def record_ad_click(ad_id: str):
         logger.error(f"Error recording ad click: {e}")
         raise HTTPException(status_code=500, detail=f"Error recording ad click: {str(e)}")
 
+def require_admin_token(x_admin_token: Optional[str] = Header(None)):
+    """Only let internal callers presenting the configured admin token through."""
+    if not settings.admin_token or not x_admin_token or not hmac.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+
+@app.get("/admin/indexes", dependencies=[Depends(require_admin_token)])
+async def index_report():
+    """Report index usage and query shapes that are not served by an index (internal callers only)."""
+    try:
+        return await get_index_report()
+    except Exception as e:
+        logger.error(f"Error getting index report: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting index report: {str(e)}")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
@@ -7,6 +7,9 @@ class AdBase(BaseModel):
     url: HttpUrl
     image: str = Field(..., min_length=1)
     is_active: bool = True
+    slots: list[str] = Field(default_factory=list, description="Slots the ad may be served in; empty for any slot")
+    weight: float = Field(1.0, gt=0)
+    daily_impression_cap: Optional[int] = Field(None, ge=1)
 
 class AdCreate(AdBase):
     pass
@@ -16,6 +19,9 @@ class AdUpdate(BaseModel):
     url: Optional[HttpUrl] = None
     image: Optional[str] = Field(None, min_length=1)
     is_active: Optional[bool] = None
+    slots: Optional[list[str]] = None
+    weight: Optional[float] = Field(None, gt=0)
+    daily_impression_cap: Optional[int] = Field(None, ge=1)
 
 class Ad(AdBase):
     id: str
@@ -24,4 +30,5 @@ class Ad(AdBase):
 
 class AdList(BaseModel):
     ads: list[Ad]
-    total: int 
\ No newline at end of file
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None 
\ No newline at end of file
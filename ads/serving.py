@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import random
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Slot key of the ads that are not targeted at any slot
+ANY_SLOT = "*"
+
+SNAPSHOT_PROJECTION = {"title": 1, "url": 1, "image": 1, "slots": 1, "weight": 1, "daily_impression_cap": 1}
+
+class AliasTable:
+    """Walker's alias method: O(n) to build, then O(1) per weighted draw."""
+
+    def __init__(self, weights: list[float]):
+        n = len(weights)
+        total = sum(weights)
+        scaled = [weight * n / total for weight in weights]
+        self.probability = [1.0] * n
+        self.alias = list(range(n))
+
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Whatever is left is 1 up to rounding error and keeps probability 1
+
+    def draw(self, rng: random.Random) -> int:
+        """Draw an index with probability proportional to its weight."""
+        i = rng.randrange(len(self.probability))
+        return i if rng.random() < self.probability[i] else self.alias[i]
+
+class FrequencyCaps:
+    """Impressions per viewer and ad within a window, for the most recent viewers."""
+
+    def __init__(self):
+        self._viewers = OrderedDict()
+
+    def capped(self, viewer: str, ad_id: str, now: float) -> bool:
+        """Check whether a viewer has seen an ad as often as allowed."""
+        entry = self._viewers.get(viewer)
+        if entry is None or now - entry[0] >= settings.frequency_window:
+            return False
+        return entry[1][ad_id] >= settings.frequency_cap
+
+    def record(self, viewer: str, ad_ids: list, now: float):
+        """Count impressions of ads shown to a viewer."""
+        entry = self._viewers.get(viewer)
+        if entry is None or now - entry[0] >= settings.frequency_window:
+            entry = (now, Counter())
+            self._viewers[viewer] = entry
+        self._viewers.move_to_end(viewer)
+        entry[1].update(ad_ids)
+        while len(self._viewers) > settings.frequency_max_viewers:
+            self._viewers.popitem(last=False)
+
+class AdServer:
+    """Weighted ad selection from an in-memory snapshot of the active ads.
+
+    Serving draws from a per-slot alias table and checks pacing and
+    frequency caps in memory, without touching Mongo. The snapshot is
+    reloaded right after a write through this replica and periodically for
+    writes through other ones. Impressions are counted in memory and
+    flushed with $inc in bulk.
+
+    Pacing spreads ``daily_impression_cap`` evenly over the UTC day. Each
+    replica knows the day's impressions as of its last reload plus its own
+    since, so across replicas an ad can run ahead by what the others served
+    in one reload interval. Frequency caps are counted per replica.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self._ads = {}
+        self._slots = {}
+        self._tables = {}
+        self._served_today = Counter()
+        self._day = None
+        self._pending = Counter()
+        self._pending_totals = Counter()
+        self._caps = FrequencyCaps()
+        self._random = random.Random()
+        self._reload = asyncio.Event()
+
+    def refresh_soon(self):
+        """Reload the snapshot now, after a write through this replica."""
+        self._reload.set()
+
+    async def load(self, collection, impressions):
+        """Replace the snapshot with the active ads and today's impressions."""
+        day = datetime.utcnow().strftime("%Y-%m-%d")
+        ads, slots = {}, {}
+        async for ad in collection.find({"is_active": True}, SNAPSHOT_PROJECTION):
+            ad_id = str(ad["_id"])
+            ads[ad_id] = {
+                "id": ad_id,
+                "title": ad["title"],
+                "url": str(ad["url"]),
+                "image": ad["image"],
+                "weight": float(ad.get("weight", 1.0)),
+                "daily_impression_cap": ad.get("daily_impression_cap"),
+            }
+            for slot in ad.get("slots") or [ANY_SLOT]:
+                slots.setdefault(slot, []).append(ad_id)
+
+        served = Counter()
+        async for count in impressions.find({"day": day}, {"ad_id": 1, "count": 1}):
+            served[count["ad_id"]] = count["count"]
+        # Impressions not flushed yet are not in the collection
+        for (ad_id, pending_day), count in self._pending.items():
+            if pending_day == day:
+                served[ad_id] += count
+
+        self._ads, self._slots, self._tables = ads, slots, {}
+        self._served_today, self._day = served, day
+        self.ready = True
+
+    def _table(self, slot: str) -> tuple[list, Optional[AliasTable]]:
+        """Get the ads eligible for a slot and their alias table, built once per snapshot."""
+        key = slot if slot in self._slots else ANY_SLOT
+        entry = self._tables.get(key)
+        if entry is None:
+            ad_ids = self._slots.get(key, []) if key == ANY_SLOT else self._slots[key] + self._slots.get(ANY_SLOT, [])
+            ads = [self._ads[ad_id] for ad_id in ad_ids]
+            entry = (ads, AliasTable([ad["weight"] for ad in ads]) if ads else None)
+            self._tables[key] = entry
+        return entry
+
+    def _paced_out(self, ad: dict, day_elapsed: float) -> bool:
+        cap = ad["daily_impression_cap"]
+        if cap is None:
+            return False
+        allowed = min(cap, cap * day_elapsed + settings.pacing_burst)
+        return self._served_today[ad["id"]] >= allowed
+
+    def serve(self, slot: str, n: int, viewer: Optional[str] = None) -> list[dict]:
+        """Pick up to ``n`` distinct ads for a slot and count their impressions."""
+        ads, table = self._table(slot)
+        if table is None:
+            return []
+
+        now = datetime.utcnow()
+        day = now.strftime("%Y-%m-%d")
+        if day != self._day:
+            self._served_today, self._day = Counter(), day
+        day_elapsed = (now - now.replace(hour=0, minute=0, second=0, microsecond=0)) / timedelta(days=1)
+        clock = time.monotonic()
+        capping = viewer is not None and settings.frequency_cap > 0
+
+        chosen, tried = [], set()
+        # Rejection sampling; bounded so a slot full of capped ads stays cheap
+        for _ in range(4 * n + 8):
+            if len(chosen) == n or len(tried) == len(ads):
+                break
+            i = table.draw(self._random)
+            if i in tried:
+                continue
+            tried.add(i)
+            ad = ads[i]
+            if self._paced_out(ad, day_elapsed) or (capping and self._caps.capped(viewer, ad["id"], clock)):
+                continue
+            chosen.append(ad)
+
+        for ad in chosen:
+            self._served_today[ad["id"]] += 1
+            self._pending[(ad["id"], day)] += 1
+            self._pending_totals[ad["id"]] += 1
+        if capping and chosen:
+            self._caps.record(viewer, [ad["id"] for ad in chosen], clock)
+        return [{"id": ad["id"], "title": ad["title"], "url": ad["url"], "image": ad["image"]} for ad in chosen]
+
+    async def flush(self, collection, impressions):
+        """Write the impressions counted since the last flush; failed writes are retried next time."""
+        if self._pending:
+            pending, self._pending = self._pending, Counter()
+            try:
+                await impressions.bulk_write([
+                    UpdateOne(
+                        {"_id": f"{ad_id}:{day}"},
+                        {
+                            "$inc": {"count": count},
+                            "$setOnInsert": {
+                                "ad_id": ad_id,
+                                "day": day,
+                                "expires_at": datetime.strptime(day, "%Y-%m-%d") + timedelta(days=2),
+                            },
+                        },
+                        upsert=True
+                    )
+                    for (ad_id, day), count in pending.items()
+                ], ordered=False)
+            except Exception:
+                self._pending.update(pending)
+                raise
+
+        if self._pending_totals:
+            totals, self._pending_totals = self._pending_totals, Counter()
+            try:
+                await collection.bulk_write([
+                    UpdateOne({"_id": ObjectId(ad_id)}, {"$inc": {"impressions": count}})
+                    for ad_id, count in totals.items()
+                ], ordered=False)
+            except Exception:
+                self._pending_totals.update(totals)
+                raise
+
+    async def run(self, collection, impressions):
+        """Keep the snapshot current and flush impressions, until cancelled."""
+        reload_at = 0.0
+        try:
+            while True:
+                try:
+                    await self.flush(collection, impressions)
+                except Exception as e:
+                    logger.error(f"Error flushing ad impressions: {e}")
+                if self._reload.is_set() or time.monotonic() >= reload_at:
+                    self._reload.clear()
+                    try:
+                        await self.load(collection, impressions)
+                        reload_at = time.monotonic() + settings.ad_snapshot_refresh_interval
+                    except Exception as e:
+                        logger.error(f"Error loading ad snapshot: {e}")
+                        reload_at = time.monotonic() + settings.impression_flush_interval
+                try:
+                    await asyncio.wait_for(self._reload.wait(), timeout=settings.impression_flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            try:
+                await self.flush(collection, impressions)
+            except Exception as e:
+                logger.error(f"Error flushing ad impressions: {e}")
+
+ad_server = AdServer()
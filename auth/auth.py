@@ -1,3 +1,6 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
@@ -5,8 +8,16 @@ from passlib.context import CryptContext
 from fastapi import HTTPException, status
 from config import settings
 from models import TokenData
+from keys import key_ring, SIGNING_ALGORITHM
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes with a different cost than the configured one are flagged for update
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.bcrypt_rounds,
+    bcrypt__min_rounds=settings.bcrypt_rounds,
+    bcrypt__max_rounds=settings.bcrypt_rounds,
+)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash."""
@@ -16,6 +27,58 @@ def get_password_hash(password: str) -> str:
     """Hash a password."""
     return pwd_context.hash(password)
 
+def _verify_and_update(plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+_executor: Optional[ProcessPoolExecutor] = None
+_pending = 0
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Get the password hashing process pool, creating it on first use."""
+    global _executor
+    if _executor is None:
+        # Spawned, not forked: by now Motor's threads are running and a fork would copy their locks
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.password_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+async def _offload(func, *args):
+    """Run a bcrypt call on the process pool, refusing work beyond the queue limit."""
+    global _pending
+    if _pending >= settings.password_workers * settings.password_queue_factor:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many password checks in progress, retry shortly",
+            headers={"Retry-After": str(settings.password_retry_after)},
+        )
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), func, *args)
+    finally:
+        _pending -= 1
+
+async def hash_password(password: str) -> str:
+    """Hash a password without blocking the event loop."""
+    return await _offload(get_password_hash, password)
+
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    """Verify a password without blocking the event loop.
+
+    Returns whether it matched and, when the stored hash uses an outdated
+    cost, a new hash to store in its place.
+    """
+    return await _offload(_verify_and_update, plain_password, hashed_password)
+
+def shutdown_password_pool():
+    """Shut down the password hashing process pool."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create a JWT access token."""
     to_encode = data.copy()
@@ -25,19 +88,38 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + timedelta(minutes=settings.access_token_expire_minutes)
     
     to_encode.update({"exp": expire})
+    if settings.jwt_algorithm == SIGNING_ALGORITHM:
+        return key_ring.sign(to_encode)
     encoded_jwt = jwt.encode(to_encode, settings.jwt_secret_key, algorithm=settings.jwt_algorithm)
     return encoded_jwt
 
+def user_claims(user: dict, session_id: Optional[str] = None) -> dict:
+    """Get the claims identifying a user in their tokens, enough to authorize without a lookup."""
+    claims = {"sub": user["username"], "uid": str(user["_id"]), "role": user["role"], "status": user["status"]}
+    if session_id:
+        claims["sid"] = session_id
+    return claims
+
 def verify_token(token: str) -> Optional[TokenData]:
     """Verify and decode a JWT token."""
     try:
-        payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm])
+        if settings.jwt_algorithm == SIGNING_ALGORITHM:
+            payload = key_ring.verify(token)
+        else:
+            payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm])
         username: str = payload.get("sub")
         if username is None:
             return None
-        token_data = TokenData(username=username)
+        token_data = TokenData(
+            username=username,
+            user_id=payload.get("uid"),
+            role=payload.get("role"),
+            status=payload.get("status"),
+            session_id=payload.get("sid"),
+            expires=payload.get("exp"),
+        )
         return token_data
-    except JWTError:
+    except (JWTError, ValueError):
         return None
 
 async def authenticate_user(username: str, password: str):
@@ -50,7 +132,13 @@ async def authenticate_user(username: str, password: str):
     if not user:
         return False
     
-    if not verify_password(password, user["hashed_password"]):
+    verified, new_hash = await verify_and_update_password(password, user["hashed_password"])
+    if not verified:
         return False
     
+    if new_hash:
+        # The configured cost changed since this hash was made
+        await collection.update_one({"_id": user["_id"]}, {"$set": {"hashed_password": new_hash}})
+        user["hashed_password"] = new_hash
+    
     return user 
\ No newline at end of file
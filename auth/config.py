@@ -1,3 +1,4 @@
+import os
 from pydantic_settings import BaseSettings
 from typing import Optional
 
@@ -9,11 +10,55 @@ class Settings(BaseSettings):
     mongodb_collection: str = "users"
     mongodb_username: str = "admin"
     mongodb_password: str = "password"
+    # MongoDB runs as a replica set (change streams, transactions); with its name the client
+    # discovers the members, without it the configured host is connected to directly
+    mongodb_replica_set: str = ""
+    drop_unknown_indexes: bool = False
+    
+    # Pagination
+    count_cache_ttl: float = 5.0
+    
+    # Bulk user administration
+    user_import_batch_size: int = 1000
     
     # JWT Configuration
     jwt_secret_key: str = "your-secret-key-here"
-    jwt_algorithm: str = "HS256"
-    access_token_expire_minutes: int = 30
+    # RS256 signs with the rotating keys published at /.well-known/jwks.json
+    jwt_algorithm: str = "RS256"
+    # Access tokens are short-lived; clients renew them with a refresh token
+    access_token_expire_minutes: int = 5
+    signing_keys_collection: str = "signing_keys"
+    signing_key_size: int = 2048
+    # Seconds a retired key stays published beyond the token lifetime
+    signing_key_grace: int = 300
+    signing_key_refresh_interval: float = 60.0
+    
+    # Refresh-token sessions
+    sessions_collection: str = "sessions"
+    refresh_token_expire_days: int = 14
+    
+    # Revoked sessions, shared across replicas
+    revocations_collection: str = "revocations"
+    revocation_sync_interval: float = 2.0
+    revocation_sync_overlap: float = 5.0
+    revocation_rebuild_interval: float = 600.0
+    revocation_bloom_capacity: int = 100000
+    revocation_bloom_error_rate: float = 0.001
+    revocation_confirm_cache_size: int = 10000
+    
+    # Password hashing
+    bcrypt_rounds: int = 12
+    password_workers: int = os.cpu_count() or 1
+    # Password checks queued per worker before logins are refused with 429
+    password_queue_factor: int = 8
+    password_retry_after: int = 1
+    
+    # Authenticated user cache
+    principal_cache_size: int = 10000
+    # Upper bound on how long a change made through another replica goes unnoticed
+    principal_cache_ttl: float = 60.0
+    # Authorize from the token's role/status claims alone, without reading the user
+    stateless_auth: bool = False
     
     class Config:
         env_file = ".env"
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import JWTError, jwk, jwt
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+SIGNING_ALGORITHM = "RS256"
+
+def generate_key() -> dict:
+    """Generate an RSA signing key as a signing_keys document."""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=settings.signing_key_size)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode("ascii")
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode("ascii")
+    return {
+        "_id": uuid.uuid4().hex,
+        "private_key": private_pem,
+        "public_key": public_pem,
+        "created_at": datetime.utcnow(),
+        "retired_at": None,
+    }
+
+def public_jwk(document: dict) -> dict:
+    """Get the public JWK of a signing key, as published in the key set."""
+    key = jwk.construct(document["public_key"], SIGNING_ALGORITHM).to_dict()
+    key.update({"kid": document["_id"], "use": "sig", "alg": SIGNING_ALGORITHM})
+    return key
+
+class KeyRing:
+    """RS256 signing keys shared by every auth replica through Mongo.
+
+    Tokens are signed with the newest key and carry its ``kid``. Rotating
+    adds a key and retires the previous one; retired keys stay published
+    until every token they signed has expired, so verifiers holding the
+    key set never reject a valid token. A new key is only used for signing
+    once it has been published for a refresh interval, so other replicas
+    know it before they see tokens signed with it.
+    """
+
+    def __init__(self):
+        self._current: Optional[dict] = None
+        self._public = {}
+        self._jwks = {"keys": []}
+
+    @property
+    def retention(self) -> timedelta:
+        """How long a retired key stays published."""
+        return timedelta(minutes=settings.access_token_expire_minutes) + timedelta(seconds=settings.signing_key_grace)
+
+    async def load(self, collection):
+        """Load the published keys, creating the first one if there is none."""
+        cutoff = datetime.utcnow() - self.retention
+        documents = await collection.find(
+            {"$or": [{"retired_at": None}, {"retired_at": {"$gt": cutoff}}]}
+        ).sort("created_at", -1).to_list(length=None)
+
+        if not any(document["retired_at"] is None for document in documents):
+            document = await asyncio.to_thread(generate_key)
+            await collection.insert_one(document)
+            logger.info(f"Created signing key {document['_id']}")
+            documents.insert(0, document)
+
+        activated = datetime.utcnow() - timedelta(seconds=settings.signing_key_refresh_interval)
+        self._current = next((document for document in documents if document["created_at"] <= activated), documents[0])
+        self._public = {document["_id"]: document["public_key"] for document in documents}
+        self._jwks = {"keys": [public_jwk(document) for document in documents]}
+
+    async def rotate(self, collection) -> str:
+        """Add a new signing key and retire the others; returns the new kid."""
+        document = await asyncio.to_thread(generate_key)
+        await collection.insert_one(document)
+        await collection.update_many(
+            {"_id": {"$ne": document["_id"]}, "retired_at": None},
+            {"$set": {"retired_at": datetime.utcnow()}}
+        )
+        await collection.delete_many({"retired_at": {"$lt": datetime.utcnow() - self.retention}})
+        await self.load(collection)
+        logger.info(f"Rotated signing key to {document['_id']}")
+        return document["_id"]
+
+    def sign(self, claims: dict) -> str:
+        """Sign claims with the current key."""
+        return jwt.encode(
+            claims,
+            self._current["private_key"],
+            algorithm=SIGNING_ALGORITHM,
+            headers={"kid": self._current["_id"]},
+        )
+
+    def verify(self, token: str) -> dict:
+        """Verify a token against the published keys; raises JWTError when invalid."""
+        kid = jwt.get_unverified_header(token).get("kid")
+        public_key = self._public.get(kid)
+        if public_key is None:
+            raise JWTError(f"Unknown signing key {kid}")
+        return jwt.decode(token, public_key, algorithms=[SIGNING_ALGORITHM])
+
+    def jwks(self) -> dict:
+        """Get the published key set."""
+        return self._jwks
+
+    async def run(self, collection):
+        """Reload the keys periodically to pick up rotations made by other replicas."""
+        while True:
+            await asyncio.sleep(settings.signing_key_refresh_interval)
+            try:
+                await self.load(collection)
+            except Exception as e:
+                logger.error(f"Error reloading signing keys: {e}")
+
+key_ring = KeyRing()
@@ -1,14 +1,28 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, status
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime, timedelta
 from bson import ObjectId
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+import asyncio
 import logging
+import re
+from typing import Optional
 
 from config import settings
-from database import connect_to_mongo, close_mongo_connection, get_collection
-from models import UserCreate, User, UserUpdate, Token, LoginRequest, UserStatus, UserRole
-from auth import create_access_token, verify_token, get_password_hash, authenticate_user
+from instrumentation import instrument
+from database import connect_to_mongo, close_mongo_connection, get_collection, get_index_report
+from models import (
+    UserCreate, User, UserUpdate, UserList, UserImport, Token, LoginRequest, RefreshRequest, UserStatus, UserRole,
+    BulkStatusRequest, BulkDeleteRequest, BulkItemResult, BulkResult,
+)
+from auth import create_access_token, verify_token, hash_password, authenticate_user, user_claims, shutdown_password_pool
+from principals import principal_cache
+from keys import key_ring
+from pagination import apply_cursor, sort_spec, next_cursor, count_cache
+from sessions import session_store, revocation_set, session_of
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,17 +39,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+instrument(app, "auth")
+
 # Security
 security = HTTPBearer()
 
+# Users are never read with their password hash outside of login
+USER_PROJECTION = {"hashed_password": 0}
+
+key_refresher: Optional[asyncio.Task] = None
+revocation_syncer: Optional[asyncio.Task] = None
+
 @app.on_event("startup")
 async def startup_db_client():
+    global key_refresher, revocation_syncer
     await connect_to_mongo()
+    keys = get_collection(settings.signing_keys_collection)
+    await key_ring.load(keys)
+    key_refresher = asyncio.create_task(key_ring.run(keys))
+    revocation_syncer = asyncio.create_task(revocation_set.run(get_collection(settings.revocations_collection)))
     # Create default admin user if not exists
     await create_default_admin()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in (key_refresher, revocation_syncer):
+        if task:
+            task.cancel()
+    shutdown_password_pool()
     await close_mongo_connection()
 
 async def create_default_admin():
@@ -50,7 +81,7 @@ async def create_default_admin():
             "full_name": "Administrator",
             "role": UserRole.ADMIN,
             "status": UserStatus.ACTIVE,
-            "hashed_password": get_password_hash("admin123"),
+            "hashed_password": await hash_password("admin123"),
             "created_at": datetime.utcnow(),
             "updated_at": datetime.utcnow()
         }
@@ -58,8 +89,28 @@ async def create_default_admin():
         logger.info("Default admin user created")
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get current authenticated user."""
+    """Get current authenticated user.
+
+    Served from the principal cache when the token was seen before; in
+    stateless mode the user is built from the token's claims instead of
+    being read from the database.
+    """
     token = credentials.credentials
+    user = principal_cache.get(token)
+    if user is None:
+        user = await load_current_user(token)
+    
+    session_id = user.get("session_id")
+    if session_id and await revocation_set.is_revoked(get_collection(settings.revocations_collection), session_id):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Session revoked",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
+
+async def load_current_user(token: str) -> dict:
+    """Verify a token and resolve its user, caching the result."""
     token_data = verify_token(token)
     
     if token_data is None:
@@ -69,8 +120,17 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    collection = get_collection(settings.mongodb_collection)
-    user = await collection.find_one({"username": token_data.username})
+    generation = principal_cache.generation
+    if settings.stateless_auth and token_data.user_id and token_data.role and token_data.status:
+        user = {
+            "_id": ObjectId(token_data.user_id),
+            "username": token_data.username,
+            "role": token_data.role,
+            "status": token_data.status,
+        }
+    else:
+        collection = get_collection(settings.mongodb_collection)
+        user = await collection.find_one({"username": token_data.username}, USER_PROJECTION)
     
     if user is None:
         raise HTTPException(
@@ -79,8 +139,24 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    user["session_id"] = token_data.session_id
+    if token_data.expires is not None:
+        principal_cache.put(token, user, token_data.expires, generation)
     return user
 
+def issue_tokens(user: dict, session_id: str, refresh_token: str) -> dict:
+    """Build the token response for a session."""
+    access_token_expires = timedelta(minutes=settings.access_token_expire_minutes)
+    access_token = create_access_token(
+        data=user_claims(user, session_id), expires_delta=access_token_expires
+    )
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "expires_in": int(access_token_expires.total_seconds()),
+        "refresh_token": refresh_token,
+    }
+
 @app.post("/login", response_model=Token)
 async def login(login_data: LoginRequest):
     """Login endpoint."""
@@ -99,12 +175,44 @@ async def login(login_data: LoginRequest):
             detail="User account is not active"
         )
     
-    access_token_expires = timedelta(minutes=settings.access_token_expire_minutes)
-    access_token = create_access_token(
-        data={"sub": user["username"]}, expires_delta=access_token_expires
-    )
+    sessions = get_collection(settings.sessions_collection)
+    refresh_token = await session_store.create(sessions, str(user["_id"]))
+    return issue_tokens(user, session_of(refresh_token), refresh_token)
+
+@app.post("/token/refresh", response_model=Token)
+async def refresh_access_token(request: RefreshRequest):
+    """Exchange a refresh token for a new access token and a rotated refresh token."""
+    sessions = get_collection(settings.sessions_collection)
+    revocations = get_collection(settings.revocations_collection)
+    rotated = await session_store.rotate(sessions, revocations, request.refresh_token)
+    if rotated is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    session, refresh_token = rotated
+    
+    collection = get_collection(settings.mongodb_collection)
+    user = await collection.find_one({"_id": ObjectId(session["user_id"])}, USER_PROJECTION)
+    if user is None or user["status"] != UserStatus.ACTIVE:
+        await session_store.revoke(sessions, revocations, session["_id"])
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User account is not active",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     
-    return {"access_token": access_token, "token_type": "bearer"}
+    return issue_tokens(user, session["_id"], refresh_token)
+
+@app.post("/logout")
+async def logout(request: RefreshRequest):
+    """End a session: its refresh token stops working and its access tokens are revoked."""
+    sessions = get_collection(settings.sessions_collection)
+    session = await session_store.verify(sessions, request.refresh_token)
+    if session is not None:
+        await session_store.revoke(sessions, get_collection(settings.revocations_collection), session["_id"])
+    return {"message": "Logged out"}
 
 @app.post("/register", response_model=User)
 async def register(user_data: UserCreate):
@@ -128,11 +236,12 @@ async def register(user_data: UserCreate):
         )
     
     user_dict = user_data.dict()
-    user_dict["hashed_password"] = get_password_hash(user_data.password)
+    user_dict["hashed_password"] = await hash_password(user_data.password)
     user_dict["created_at"] = datetime.utcnow()
     user_dict["updated_at"] = datetime.utcnow()
     
     result = await collection.insert_one(user_dict)
+    count_cache.clear()
     user_dict["id"] = str(result.inserted_id)
     
     return User(**user_dict)
@@ -140,12 +249,30 @@ async def register(user_data: UserCreate):
 @app.get("/me", response_model=User)
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     """Get current user information."""
+    if "created_at" not in current_user:
+        # Stateless principals only carry the claims; the profile needs the document
+        collection = get_collection(settings.mongodb_collection)
+        current_user = await collection.find_one({"_id": current_user["_id"]}, USER_PROJECTION)
+        if current_user is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="User not found"
+            )
     current_user["id"] = str(current_user["_id"])
     return User(**current_user)
 
-@app.get("/users", response_model=list[User])
-async def get_users(current_user: dict = Depends(get_current_user)):
-    """Get all users (admin only)."""
+@app.get("/users", response_model=UserList)
+async def get_users(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    status_filter: Optional[UserStatus] = Query(None, alias="status"),
+    role: Optional[UserRole] = Query(None),
+    q: Optional[str] = Query(None, description="Username or email prefix"),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from a previous page's next_cursor; replaces skip"),
+    with_total: bool = Query(True, description="Include the (briefly cached) total count"),
+    current_user: dict = Depends(get_current_user)
+):
+    """List users with optional filtering (admin only)."""
     if current_user["role"] != UserRole.ADMIN:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -153,12 +280,209 @@ async def get_users(current_user: dict = Depends(get_current_user)):
         )
     
     collection = get_collection(settings.mongodb_collection)
-    users = await collection.find().to_list(length=100)
+    
+    # Build filter
+    filter_query = {}
+    if status_filter is not None:
+        filter_query["status"] = status_filter
+    if role is not None:
+        filter_query["role"] = role
+    if q:
+        # Anchored prefixes can use the username and email indexes
+        prefix = {"$regex": f"^{re.escape(q)}"}
+        filter_query["$or"] = [{"username": prefix}, {"email": prefix}]
+    
+    total = await count_cache.count(collection, filter_query) if with_total else None
+    
+    page_query = apply_cursor(filter_query, "created_at", -1, cursor)
+    db_cursor = collection.find(page_query, USER_PROJECTION).sort(sort_spec("created_at", -1)).limit(limit)
+    if not cursor:
+        db_cursor = db_cursor.skip(skip)
+    users = await db_cursor.to_list(length=limit)
     
     for user in users:
         user["id"] = str(user["_id"])
     
-    return [User(**user) for user in users]
+    return UserList(
+        users=[User(**user) for user in users],
+        total=total,
+        next_cursor=next_cursor(users, "created_at", limit)
+    )
+
+async def _ndjson_lines(request: Request):
+    """Yield the non-empty lines of a streamed NDJSON request body."""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+async def _insert_users(collection, batch: list, results: list):
+    """Insert a batch of (index, document) pairs, recording a result per item."""
+    if not batch:
+        return
+    failed = {}
+    try:
+        await collection.bulk_write([InsertOne(document) for _, document in batch], ordered=False)
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            failed[error["index"]] = "Username or email already registered" if error["code"] == 11000 else error["errmsg"]
+    
+    for position, (index, document) in enumerate(batch):
+        if position in failed:
+            results.append(BulkItemResult(index=index, status="error", error=failed[position]))
+        else:
+            results.append(BulkItemResult(index=index, id=str(document["_id"]), status="created"))
+
+async def _import_documents(lines: list, results: list) -> list:
+    """Validate import lines and hash their passwords; returns (index, document) pairs."""
+    batch = []
+    for start in range(0, len(lines), settings.password_workers):
+        chunk = lines[start:start + settings.password_workers]
+        users = []
+        for index, line in chunk:
+            try:
+                user = UserImport.model_validate_json(line)
+            except ValueError as e:
+                results.append(BulkItemResult(index=index, status="error", error=str(e)))
+                continue
+            if bool(user.password) == bool(user.hashed_password):
+                results.append(BulkItemResult(index=index, status="error", error="Exactly one of password or hashed_password is required"))
+                continue
+            users.append((index, user))
+        
+        # Hash a worker's worth of passwords at a time, leaving room for logins
+        hashes = iter(await asyncio.gather(
+            *(hash_password(user.password) for _, user in users if user.password),
+            return_exceptions=True
+        ))
+        now = datetime.utcnow()
+        for index, user in users:
+            hashed = next(hashes) if user.password else user.hashed_password
+            if isinstance(hashed, Exception):
+                results.append(BulkItemResult(index=index, status="error", error="Could not hash password"))
+                continue
+            document = user.dict(exclude={"password", "hashed_password"})
+            document.update({"_id": ObjectId(), "hashed_password": hashed, "created_at": now, "updated_at": now})
+            batch.append((index, document))
+    return batch
+
+@app.post("/users/import", response_model=BulkResult)
+async def import_users(request: Request, current_user: dict = Depends(get_current_user)):
+    """Import users from an NDJSON body, one user per line (admin only).
+
+    Each line is a user with either a ``password`` or an existing bcrypt
+    ``hashed_password``. Users are inserted in unordered batches, so one
+    bad line does not stop the others; the result lists every line.
+    """
+    if current_user["role"] != UserRole.ADMIN:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    
+    collection = get_collection(settings.mongodb_collection)
+    results = []
+    lines = []
+    index = 0
+    async for line in _ndjson_lines(request):
+        lines.append((index, line))
+        index += 1
+        if len(lines) >= settings.user_import_batch_size:
+            await _insert_users(collection, await _import_documents(lines, results), results)
+            lines = []
+    await _insert_users(collection, await _import_documents(lines, results), results)
+    
+    count_cache.clear()
+    results.sort(key=lambda result: result.index)
+    succeeded = sum(1 for result in results if result.status != "error")
+    return BulkResult(processed=len(results), succeeded=succeeded, failed=len(results) - succeeded, results=results)
+
+def _bulk_targets(user_ids: list) -> tuple[list, dict]:
+    """Parse the user ids of a bulk request; returns (index, ObjectId) pairs and errors by index."""
+    targets = []
+    errors = {}
+    for index, user_id in enumerate(user_ids):
+        if ObjectId.is_valid(user_id):
+            targets.append((index, ObjectId(user_id)))
+        else:
+            errors[index] = BulkItemResult(index=index, id=user_id, status="error", error="Invalid user id")
+    return targets, errors
+
+async def _bulk_apply(collection, user_ids: list, operation) -> tuple[BulkResult, list]:
+    """Apply ``operation(ObjectId)`` to every existing user in one bulk_write; returns the result and the affected ids."""
+    targets, errors = _bulk_targets(user_ids)
+    existing = set()
+    async for user in collection.find({"_id": {"$in": [oid for _, oid in targets]}}, {"_id": 1}):
+        existing.add(user["_id"])
+    
+    affected = sorted({oid for _, oid in targets if oid in existing})
+    if affected:
+        await collection.bulk_write([operation(oid) for oid in affected], ordered=False)
+    
+    results = []
+    for index, user_id in enumerate(user_ids):
+        if index in errors:
+            results.append(errors[index])
+        elif ObjectId(user_id) in existing:
+            results.append(BulkItemResult(index=index, id=user_id, status="ok"))
+        else:
+            results.append(BulkItemResult(index=index, id=user_id, status="error", error="User not found"))
+    
+    succeeded = sum(1 for result in results if result.status == "ok")
+    result = BulkResult(processed=len(results), succeeded=succeeded, failed=len(results) - succeeded, results=results)
+    return result, [str(oid) for oid in affected]
+
+@app.post("/users/bulk/status", response_model=BulkResult)
+async def bulk_update_status(request: BulkStatusRequest, current_user: dict = Depends(get_current_user)):
+    """Set the status of many users at once (admin only)."""
+    if current_user["role"] != UserRole.ADMIN:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    
+    collection = get_collection(settings.mongodb_collection)
+    now = datetime.utcnow()
+    result, affected = await _bulk_apply(
+        collection,
+        request.user_ids,
+        lambda oid: UpdateOne({"_id": oid}, {"$set": {"status": request.status, "updated_at": now}})
+    )
+    
+    for user_id in affected:
+        principal_cache.invalidate_user(user_id)
+    if affected and request.status != UserStatus.ACTIVE:
+        await session_store.revoke_users(
+            get_collection(settings.sessions_collection), get_collection(settings.revocations_collection), affected
+        )
+    count_cache.clear()
+    return result
+
+@app.post("/users/bulk/delete", response_model=BulkResult)
+async def bulk_delete_users(request: BulkDeleteRequest, current_user: dict = Depends(get_current_user)):
+    """Delete many users at once (admin only)."""
+    if current_user["role"] != UserRole.ADMIN:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    
+    collection = get_collection(settings.mongodb_collection)
+    result, affected = await _bulk_apply(collection, request.user_ids, lambda oid: DeleteOne({"_id": oid}))
+    
+    for user_id in affected:
+        principal_cache.invalidate_user(user_id)
+    if affected:
+        await session_store.revoke_users(
+            get_collection(settings.sessions_collection), get_collection(settings.revocations_collection), affected
+        )
+    count_cache.clear()
+    return result
 
 @app.put("/users/{user_id}", response_model=User)
 async def update_user(
@@ -188,8 +512,14 @@ async def update_user(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
+    principal_cache.invalidate_user(user_id)
+    count_cache.clear()
+    if update_data.get("status", UserStatus.ACTIVE) != UserStatus.ACTIVE:
+        await session_store.revoke_user(
+            get_collection(settings.sessions_collection), get_collection(settings.revocations_collection), user_id
+        )
     
-    updated_user = await collection.find_one({"_id": ObjectId(user_id)})
+    updated_user = await collection.find_one({"_id": ObjectId(user_id)}, USER_PROJECTION)
     updated_user["id"] = str(updated_user["_id"])
     
     return User(**updated_user)
@@ -211,9 +541,45 @@ async def delete_user(user_id: str, current_user: dict = Depends(get_current_use
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
+    principal_cache.invalidate_user(user_id)
+    count_cache.clear()
+    await session_store.revoke_user(
+        get_collection(settings.sessions_collection), get_collection(settings.revocations_collection), user_id
+    )
     
     return {"message": "User deleted successfully"}
 
+@app.get("/.well-known/jwks.json")
+async def jwks():
+    """Publish the public keys tokens are signed with."""
+    return JSONResponse(
+        key_ring.jwks(),
+        headers={"Cache-Control": f"public, max-age={int(settings.signing_key_refresh_interval)}"}
+    )
+
+@app.post("/keys/rotate")
+async def rotate_signing_key(current_user: dict = Depends(get_current_user)):
+    """Rotate the token signing key (admin only)."""
+    if current_user["role"] != UserRole.ADMIN:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    
+    kid = await key_ring.rotate(get_collection(settings.signing_keys_collection))
+    return {"kid": kid, "message": "Signing key rotated"}
+
+@app.get("/admin/indexes")
+async def index_report(current_user: dict = Depends(get_current_user)):
+    """Report index usage and query shapes that are not served by an index (admin only)."""
+    if current_user["role"] != UserRole.ADMIN:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    
+    return await get_index_report()
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional
+from pydantic import BaseModel, EmailStr, Field
+from typing import List, Optional
 from datetime import datetime
 from enum import Enum
 
@@ -41,12 +41,51 @@ class User(UserBase):
     created_at: datetime
     updated_at: datetime
 
+class UserList(BaseModel):
+    users: List[User]
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
+
+class UserImport(UserBase):
+    """One NDJSON line of a user import: a plain password or an existing bcrypt hash."""
+    password: Optional[str] = None
+    hashed_password: Optional[str] = None
+
+class BulkStatusRequest(BaseModel):
+    user_ids: List[str] = Field(..., min_items=1, max_items=10000)
+    status: UserStatus
+
+class BulkDeleteRequest(BaseModel):
+    user_ids: List[str] = Field(..., min_items=1, max_items=10000)
+
+class BulkItemResult(BaseModel):
+    index: int
+    id: Optional[str] = None
+    status: str
+    error: Optional[str] = None
+
+class BulkResult(BaseModel):
+    processed: int
+    succeeded: int
+    failed: int
+    results: List[BulkItemResult]
+
 class Token(BaseModel):
     access_token: str
     token_type: str
+    expires_in: Optional[int] = None
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 class TokenData(BaseModel):
     username: Optional[str] = None
+    user_id: Optional[str] = None
+    role: Optional[UserRole] = None
+    status: Optional[UserStatus] = None
+    session_id: Optional[str] = None
+    expires: Optional[float] = None
 
 class LoginRequest(BaseModel):
     username: str
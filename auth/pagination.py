@@ -0,0 +1,83 @@
+import base64
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+
+from config import settings
+
+def encode_cursor(value: datetime, doc_id) -> str:
+    """Encode a (sort value, _id) position as an opaque cursor."""
+    payload = json.dumps({"v": value.isoformat(), "id": str(doc_id)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    """Decode an opaque cursor back into a (sort value, _id) position."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        doc_id = payload["id"]
+        return datetime.fromisoformat(payload["v"]), ObjectId(doc_id) if ObjectId.is_valid(doc_id) else doc_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def apply_cursor(filter_query: dict, sort_field: str, direction: int, cursor: Optional[str]) -> dict:
+    """Restrict a filter to the documents that follow ``cursor`` in (sort_field, _id) order."""
+    if not cursor:
+        return filter_query
+
+    value, doc_id = decode_cursor(cursor)
+    op = "$gt" if direction > 0 else "$lt"
+    keyset = {
+        "$or": [
+            {sort_field: {op: value}},
+            {sort_field: value, "_id": {op: doc_id}}
+        ]
+    }
+    if not filter_query:
+        return keyset
+    return {"$and": [filter_query, keyset]}
+
+def sort_spec(sort_field: str, direction: int) -> list:
+    """Get the (sort_field, _id) sort matching ``apply_cursor``."""
+    return [(sort_field, direction), ("_id", direction)]
+
+def next_cursor(documents: list, sort_field: str, limit: int) -> Optional[str]:
+    """Get the cursor for the page after ``documents``, or None on the last page."""
+    if len(documents) < limit:
+        return None
+    last = documents[-1]
+    return encode_cursor(last[sort_field], last["_id"])
+
+class CountCache:
+    """Short-lived cache of count_documents results keyed by filter."""
+
+    def __init__(self, ttl: float, max_size: int = 256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    async def count(self, collection, filter_query: dict) -> int:
+        """Count matching documents, reusing a recent result for the same filter."""
+        key = repr(filter_query)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        total = await collection.count_documents(filter_query)
+        self._entries[key] = (now + self.ttl, total)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return total
+
+    def clear(self):
+        """Drop every cached count, e.g. after a write."""
+        self._entries.clear()
+
+count_cache = CountCache(settings.count_cache_ttl)
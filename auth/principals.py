@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import settings
+
+class PrincipalCache:
+    """Verified users keyed by the signature of the token they presented.
+
+    A hit skips both the JWT verification and the user lookup. Entries live
+    until the token expires, capped at ``ttl`` seconds so changes made
+    through another replica are picked up, and are dropped explicitly when
+    the user is updated or deleted here.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self.generation = 0
+
+    def get(self, token: str) -> Optional[dict]:
+        """Get the cached user for a token, or None."""
+        signature = token.rpartition(".")[2]
+        entry = self._entries.get(signature)
+        if entry is None:
+            return None
+        cached_token, user, expires_at = entry
+        # The signature alone is not proof of the payload it was issued with
+        if cached_token != token or time.time() >= expires_at:
+            self._remove(signature)
+            return None
+        self._entries.move_to_end(signature)
+        return dict(user)
+
+    def put(self, token: str, user: dict, expires: float, generation: int):
+        """Cache a verified user until ``expires`` (epoch seconds).
+
+        ``generation`` is the value read before the user was loaded; if a user
+        was invalidated since, the load may be outdated and is not cached.
+        """
+        if generation != self.generation:
+            return
+        user_id = str(user["_id"])
+        signature = token.rpartition(".")[2]
+        self._remove(signature)
+        self._entries[signature] = (token, dict(user), min(expires, time.time() + self.ttl))
+        self._by_user.setdefault(user_id, set()).add(signature)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: str):
+        """Drop every cached token of a user and any load still in flight."""
+        self.generation += 1
+        for signature in self._by_user.pop(user_id, ()):
+            self._entries.pop(signature, None)
+
+    def _remove(self, signature: str):
+        entry = self._entries.pop(signature, None)
+        if entry is None:
+            return
+        user_id = str(entry[1]["_id"])
+        signatures = self._by_user.get(user_id)
+        if signatures is not None:
+            signatures.discard(signature)
+            if not signatures:
+                del self._by_user[user_id]
+
+principal_cache = PrincipalCache(settings.principal_cache_size, settings.principal_cache_ttl)
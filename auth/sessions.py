@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import logging
+import math
+import secrets
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo import UpdateOne
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+def token_hash(refresh_token: str) -> str:
+    """Hash a refresh token; only hashes are stored."""
+    return hashlib.sha256(refresh_token.encode("utf-8")).hexdigest()
+
+def new_refresh_token(session_id: str) -> str:
+    """Create a refresh token for a session: its id and a random secret."""
+    return f"{session_id}.{secrets.token_urlsafe(32)}"
+
+def session_of(refresh_token: str) -> str:
+    """Get the session id a refresh token belongs to."""
+    return refresh_token.partition(".")[0]
+
+class SessionStore:
+    """Refresh-token sessions kept in Mongo and expired by a TTL index.
+
+    Each refresh rotates the token. Presenting a token that was already
+    rotated away means it leaked, so the whole session is revoked.
+    """
+
+    async def create(self, collection, user_id: str) -> str:
+        """Open a session for a user; returns its refresh token."""
+        session_id = uuid.uuid4().hex
+        refresh_token = new_refresh_token(session_id)
+        now = datetime.utcnow()
+        await collection.insert_one({
+            "_id": session_id,
+            "user_id": user_id,
+            "token_hash": token_hash(refresh_token),
+            "previous_hash": None,
+            "revoked": False,
+            "created_at": now,
+            "expires_at": now + timedelta(days=settings.refresh_token_expire_days),
+        })
+        return refresh_token
+
+    async def rotate(self, collection, revocations, refresh_token: str) -> Optional[tuple[dict, str]]:
+        """Exchange a refresh token for a new one; returns the session and the new token, or None."""
+        session_id = session_of(refresh_token)
+        presented = token_hash(refresh_token)
+        rotated = new_refresh_token(session_id)
+        session = await collection.find_one_and_update(
+            {"_id": session_id, "token_hash": presented, "revoked": False, "expires_at": {"$gt": datetime.utcnow()}},
+            {"$set": {"token_hash": token_hash(rotated), "previous_hash": presented, "rotated_at": datetime.utcnow()}}
+        )
+        if session is not None:
+            return session, rotated
+
+        reused = await collection.find_one({"_id": session_id, "previous_hash": presented, "revoked": False})
+        if reused is not None:
+            logger.warning(f"Refresh token reuse on session {session_id}; revoking it")
+            await self.revoke(collection, revocations, session_id)
+        return None
+
+    async def verify(self, collection, refresh_token: str) -> Optional[dict]:
+        """Get the live session a refresh token belongs to, or None."""
+        return await collection.find_one({
+            "_id": session_of(refresh_token),
+            "token_hash": token_hash(refresh_token),
+            "revoked": False,
+        })
+
+    async def revoke(self, collection, revocations, session_id: str):
+        """Revoke a session and the access tokens issued for it."""
+        await collection.update_one({"_id": session_id}, {"$set": {"revoked": True}})
+        await revocation_set.publish(revocations, [session_id])
+
+    async def revoke_user(self, collection, revocations, user_id: str):
+        """Revoke every session of a user."""
+        await self.revoke_users(collection, revocations, [user_id])
+
+    async def revoke_users(self, collection, revocations, user_ids: list):
+        """Revoke every session of several users."""
+        session_ids = await collection.distinct("_id", {"user_id": {"$in": user_ids}, "revoked": False})
+        if session_ids:
+            await collection.update_many({"_id": {"$in": session_ids}}, {"$set": {"revoked": True}})
+            await revocation_set.publish(revocations, session_ids)
+
+class BloomFilter:
+    """Fixed-size Bloom filter using double hashing over a SHA-256 digest."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.size_bits + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.sha256(item.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size_bits
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+class RevocationSet:
+    """Revoked session ids, checked on every authenticated request.
+
+    A Bloom filter answers the common "not revoked" case in memory; a hit
+    is confirmed against the revocations collection (and remembered), so a
+    false positive costs one lookup rather than a rejected request.
+    Replicas poll the collection for new revocations and rebuild the filter
+    periodically to shed entries whose access tokens have all expired.
+    """
+
+    def __init__(self):
+        self._bloom = BloomFilter(settings.revocation_bloom_capacity, settings.revocation_bloom_error_rate)
+        self._confirmed = OrderedDict()
+        self._synced_until = datetime(1970, 1, 1)
+        self._rebuilt_at = None
+
+    @property
+    def lifetime(self) -> timedelta:
+        """How long a revocation matters: until the last access token of the session expires."""
+        return timedelta(minutes=settings.access_token_expire_minutes)
+
+    async def is_revoked(self, collection, session_id: str) -> bool:
+        """Check whether a session was revoked."""
+        if session_id not in self._bloom:
+            return False
+        revoked = self._confirmed.get(session_id)
+        if revoked is None:
+            revoked = await collection.find_one({"_id": session_id}) is not None
+            self._confirmed[session_id] = revoked
+            while len(self._confirmed) > settings.revocation_confirm_cache_size:
+                self._confirmed.popitem(last=False)
+        return revoked
+
+    async def publish(self, collection, session_ids: list):
+        """Record revocations for every replica, and apply them here right away."""
+        now = datetime.utcnow()
+        await collection.bulk_write([
+            UpdateOne({"_id": session_id}, {"$set": {"revoked_at": now, "expires_at": now + self.lifetime}}, upsert=True)
+            for session_id in session_ids
+        ], ordered=False)
+        for session_id in session_ids:
+            self._bloom.add(session_id)
+            self._confirmed[session_id] = True
+
+    async def sync(self, collection):
+        """Pick up revocations made by other replicas."""
+        if self._rebuilt_at is None or time.monotonic() - self._rebuilt_at > settings.revocation_rebuild_interval:
+            bloom = BloomFilter(settings.revocation_bloom_capacity, settings.revocation_bloom_error_rate)
+            query = {}
+            self._confirmed = OrderedDict()
+        else:
+            bloom = self._bloom
+            # Overlap the previous sync to tolerate clock skew between replicas
+            query = {"revoked_at": {"$gte": self._synced_until - timedelta(seconds=settings.revocation_sync_overlap)}}
+
+        latest = self._synced_until
+        async for revocation in collection.find(query, {"revoked_at": 1}):
+            bloom.add(revocation["_id"])
+            self._confirmed.pop(revocation["_id"], None)
+            latest = max(latest, revocation["revoked_at"])
+
+        if bloom is not self._bloom:
+            self._bloom = bloom
+            self._rebuilt_at = time.monotonic()
+        self._synced_until = latest
+
+    async def run(self, collection):
+        """Sync revocations periodically until cancelled."""
+        while True:
+            try:
+                await self.sync(collection)
+            except Exception as e:
+                logger.error(f"Error syncing revocations: {e}")
+            await asyncio.sleep(settings.revocation_sync_interval)
+
+session_store = SessionStore()
+revocation_set = RevocationSet()
@@ -8,6 +8,45 @@ class Settings(BaseSettings):
     mongodb_collection: str = "events"
     mongodb_username: str = "admin"
     mongodb_password: str = "password"
+    # MongoDB runs as a replica set (change streams, transactions); with its name the client
+    # discovers the members, without it the configured host is connected to directly
+    mongodb_replica_set: str = ""
+    drop_unknown_indexes: bool = False
+    # Token internal callers send as X-Admin-Token to reach /admin/indexes; empty disables it
+    admin_token: str = ""
+    
+    # Pagination
+    count_cache_ttl: float = 5.0
+    
+    # In-memory interval index
+    interval_block_size: int = 512
+    # Seconds between full reloads when there is no change stream (standalone MongoDB)
+    interval_refresh_interval: float = 60.0
+    # Seconds before following the change stream again after an error
+    interval_retry_interval: float = 5.0
+    
+    # Calendar feed
+    tombstones_collection: str = "event_tombstones"
+    # Seconds deletions are kept for delta sync; older ?since= values must resync
+    tombstone_retention: int = 30 * 24 * 3600
+    # Seconds a change marker read from Mongo is reused before checking again
+    calendar_version_ttl: float = 1.0
+    # Seconds a delta reaches back before ?since=, for clock skew between replicas
+    calendar_sync_overlap: float = 5.0
+    calendar_ics_limit: int = 10000
+    # Month and week pages kept rendered
+    calendar_view_cache_size: int = 256
+    
+    # CFP and event transitions
+    # URLs POSTed a JSON notice of each transition, e.g. TRANSITION_WEBHOOK_URLS='["http://hooks/cfp"]'
+    transition_webhook_urls: list[str] = []
+    webhook_timeout: float = 5.0
+    webhook_retries: int = 3
+    webhook_retry_backoff: float = 2.0
+    # Seconds between loads of events changed through other replicas
+    scheduler_reload_interval: float = 60.0
+    scheduler_reload_overlap: float = 5.0
+    scheduler_retry_interval: float = 30.0
     
     class Config:
         env_file = ".env"
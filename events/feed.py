@@ -0,0 +1,157 @@
+import hashlib
+import time
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+from config import settings
+
+def window_filter(start: Optional[datetime], end: Optional[datetime]) -> dict:
+    """Get the filter of events overlapping a calendar window; either bound may be open."""
+    query = {}
+    if end:
+        query["date_start"] = {"$lte": end}
+    if start:
+        query["date_end"] = {"$gte": start}
+    return query
+
+def calendar_entry(event: dict) -> dict:
+    """Format an event for calendar widgets."""
+    return {
+        "id": str(event["_id"]),
+        "title": event["name"],
+        "start": event["date_start"].isoformat(),
+        "end": event["date_end"].isoformat(),
+        "description": event["description"],
+    }
+
+async def record_tombstone(tombstones, event: dict):
+    """Record that an event left the interval it had, by deletion or by moving."""
+    await tombstones.insert_one({
+        "event_id": str(event["_id"]),
+        "date_start": event["date_start"],
+        "date_end": event["date_end"],
+        "deleted_at": datetime.utcnow(),
+    })
+
+def change_marker(updated_at: Optional[datetime], deleted_at: Optional[datetime]) -> str:
+    """Format the change marker of the latest event update and the latest tombstone."""
+    return "|".join([
+        updated_at.isoformat() if updated_at else "",
+        deleted_at.isoformat() if deleted_at else "",
+    ])
+
+async def latest_changes(collection, tombstones) -> tuple[Optional[dict], Optional[dict]]:
+    """Read the latest updated event and the latest tombstone, from their indexes."""
+    latest = await collection.find_one({}, {"updated_at": 1}, sort=[("updated_at", -1)])
+    deleted = await tombstones.find_one({}, {"deleted_at": 1}, sort=[("deleted_at", -1)])
+    return latest, deleted
+
+class FeedVersion:
+    """Change marker of the events collection, from which calendar ETags are derived.
+
+    The marker is the latest ``updated_at`` and the latest tombstone, both
+    read from an index, so every replica derives the same one. It is reused
+    for ``calendar_version_ttl`` seconds, so an idle calendar polled
+    constantly costs at most two index lookups per interval; writes made
+    through this replica drop it right away, and the interval index hands
+    over the marker of every change it streams.
+    """
+
+    def __init__(self):
+        self._marker: Optional[str] = None
+        self._checked_at = 0.0
+        self._writes = 0
+
+    def touch(self):
+        """Note a write made through this replica; the next check reads Mongo."""
+        self._writes += 1
+        self._marker = None
+
+    def advance(self, marker: str):
+        """Take a marker known to be current, without reading Mongo."""
+        self._writes += 1
+        self._marker = marker
+        self._checked_at = time.monotonic()
+
+    async def marker(self, collection, tombstones) -> str:
+        """Get the current change marker."""
+        if self._marker is not None and time.monotonic() - self._checked_at < settings.calendar_version_ttl:
+            return self._marker
+        writes = self._writes
+        latest, deleted = await latest_changes(collection, tombstones)
+        marker = change_marker(latest and latest["updated_at"], deleted and deleted["deleted_at"])
+        # A write made while reading leaves the marker to be read again
+        if writes == self._writes:
+            self._marker = marker
+            self._checked_at = time.monotonic()
+        return marker
+
+def etag(marker: str, *parts) -> str:
+    """Get the ETag of a calendar window: the change marker and what was asked for."""
+    digest = hashlib.sha1("|".join([marker, *map(str, parts)]).encode("utf-8")).hexdigest()
+    return f'"{digest}"'
+
+def not_modified(if_none_match: Optional[str], tag: str) -> bool:
+    """Check an If-None-Match header against an ETag."""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == tag for candidate in candidates)
+
+def ics_escape(text: str) -> str:
+    """Escape a TEXT value (RFC 5545, 3.3.11)."""
+    return (
+        text.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+def ics_datetime(moment: datetime) -> str:
+    """Format a naive UTC datetime as an iCalendar UTC date-time."""
+    return moment.strftime("%Y%m%dT%H%M%SZ")
+
+def ics_line(line: str) -> str:
+    """Fold a content line at 75 octets without splitting a character."""
+    folded = []
+    current, size = [], 0
+    for char in line:
+        width = len(char.encode("utf-8"))
+        if size + width > 75:
+            folded.append("".join(current))
+            # Continuation lines start with a space, which counts toward the limit
+            current, size = [" "], 1
+        current.append(char)
+        size += width
+    folded.append("".join(current))
+    return "\r\n".join(folded) + "\r\n"
+
+def ics_event(event: dict, stamp: str) -> str:
+    """Render an event as a VEVENT component."""
+    return "".join(ics_line(line) for line in (
+        "BEGIN:VEVENT",
+        f"UID:{event['_id']}@events",
+        f"DTSTAMP:{stamp}",
+        f"DTSTART:{ics_datetime(event['date_start'])}",
+        f"DTEND:{ics_datetime(event['date_end'])}",
+        f"LAST-MODIFIED:{ics_datetime(event['updated_at'])}",
+        f"SUMMARY:{ics_escape(event['name'])}",
+        f"DESCRIPTION:{ics_escape(event['description'])}",
+        "END:VEVENT",
+    ))
+
+async def ics_feed(cursor) -> AsyncIterator[bytes]:
+    """Render a cursor of events as an iCalendar document, one event at a time."""
+    yield (
+        "BEGIN:VCALENDAR\r\n"
+        "VERSION:2.0\r\n"
+        "PRODID:-//Blog//Events//EN\r\n"
+        "CALSCALE:GREGORIAN\r\n"
+    ).encode("utf-8")
+    stamp = ics_datetime(datetime.utcnow())
+    async for event in cursor:
+        yield ics_event(event, stamp).encode("utf-8")
+    yield b"END:VCALENDAR\r\n"
+
+feed_version = FeedVersion()
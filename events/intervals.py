@@ -0,0 +1,324 @@
+import asyncio
+import logging
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+from config import settings
+from feed import change_marker, feed_version, latest_changes
+
+logger = logging.getLogger(__name__)
+
+# Server error code of a change stream on a standalone server
+NOT_A_REPLICA_SET = 40573
+
+# Fields of the streamed changes the index reads
+STREAM_FIELDS = (
+    "operationType", "ns", "documentKey",
+    "fullDocument.date_start", "fullDocument.date_end", "fullDocument.updated_at", "fullDocument.deleted_at",
+)
+
+def naive_utc(moment: datetime) -> datetime:
+    """Get a naive UTC datetime, comparable with the ones Mongo returns."""
+    if moment.tzinfo is not None:
+        return moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+async def find_events(collection, event_ids: list) -> list[dict]:
+    """Fetch events by id, in the order of ``event_ids``."""
+    if not event_ids:
+        return []
+    events = await collection.find({"_id": {"$in": [ObjectId(event_id) for event_id in event_ids]}}).to_list(length=None)
+    by_id = {str(event["_id"]): event for event in events}
+    return [by_id[event_id] for event_id in event_ids if event_id in by_id]
+
+class IntervalIndex:
+    """In-memory index of event intervals for overlap, "active at" and "starting after" queries.
+
+    Intervals are kept sorted by start in blocks of bounded size, each
+    block remembering the latest end it contains. An overlap query walks
+    the blocks that start before the window ends and skips every block
+    whose latest end is before the window starts, so finished events cost
+    nothing however many there are. Only (start, end, id) tuples are held;
+    the documents themselves are read from Mongo by _id.
+    """
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._blocks = []
+        self._firsts = []
+        self._max_ends = []
+        self._intervals = {}
+
+    def __len__(self) -> int:
+        return len(self._intervals)
+
+    @classmethod
+    def build(cls, block_size: int, entries: list) -> "IntervalIndex":
+        """Build an index from (start, end, id) tuples in one pass."""
+        index = cls(block_size)
+        entries.sort()
+        for offset in range(0, len(entries), block_size):
+            block = entries[offset:offset + block_size]
+            index._blocks.append(block)
+            index._firsts.append(block[0])
+            index._max_ends.append(max(e[1] for e in block))
+        index._intervals = {entry[2]: entry for entry in entries}
+        return index
+
+    def get(self, event_id: str) -> Optional[tuple]:
+        """Get the (start, end, id) entry of an event, if indexed."""
+        return self._intervals.get(event_id)
+
+    def add(self, event_id: str, start: datetime, end: datetime):
+        """Add or move the interval of an event."""
+        self.remove(event_id)
+        entry = (start, end, event_id)
+        self._intervals[event_id] = entry
+
+        if not self._blocks:
+            self._blocks.append([entry])
+            self._firsts.append(entry)
+            self._max_ends.append(end)
+            return
+
+        i = max(0, bisect_right(self._firsts, entry) - 1)
+        block = self._blocks[i]
+        insort(block, entry)
+        self._firsts[i] = block[0]
+        if end > self._max_ends[i]:
+            self._max_ends[i] = end
+
+        if len(block) > 2 * self.block_size:
+            half = len(block) // 2
+            left, right = block[:half], block[half:]
+            self._blocks[i:i + 1] = [left, right]
+            self._firsts[i:i + 1] = [left[0], right[0]]
+            self._max_ends[i:i + 1] = [max(e[1] for e in left), max(e[1] for e in right)]
+
+    def remove(self, event_id: str):
+        """Remove the interval of an event, if indexed."""
+        entry = self._intervals.pop(event_id, None)
+        if entry is None:
+            return
+        i = max(0, bisect_right(self._firsts, entry) - 1)
+        block = self._blocks[i]
+        position = bisect_left(block, entry)
+        del block[position]
+
+        if not block:
+            del self._blocks[i], self._firsts[i], self._max_ends[i]
+            return
+        self._firsts[i] = block[0]
+        if entry[1] >= self._max_ends[i]:
+            self._max_ends[i] = max(e[1] for e in block)
+
+    def overlapping(self, start: datetime, end: datetime, limit: Optional[int] = None) -> list:
+        """Get the ids of events overlapping [start, end], ordered by start."""
+        ids = []
+        for i, block in enumerate(self._blocks):
+            if block[0][0] > end:
+                break
+            if self._max_ends[i] < start:
+                continue
+            for entry_start, entry_end, event_id in block:
+                if entry_start > end:
+                    break
+                if entry_end >= start:
+                    ids.append(event_id)
+                    if limit is not None and len(ids) >= limit:
+                        return ids
+        return ids
+
+    def active_at(self, moment: datetime, limit: Optional[int] = None) -> list:
+        """Get the ids of events in progress at ``moment``, ordered by start."""
+        return self.overlapping(moment, moment, limit)
+
+    def starting_after(self, moment: datetime, limit: int) -> list:
+        """Get the ids of the next ``limit`` events starting at or after ``moment``."""
+        ids = []
+        i = max(0, bisect_left(self._firsts, (moment,)) - 1)
+        for block in self._blocks[i:]:
+            for entry in block[bisect_left(block, (moment,)):]:
+                ids.append(entry[2])
+                if len(ids) >= limit:
+                    return ids
+        return ids
+
+class EventIntervals:
+    """The interval index of the events collection, kept current from a change stream.
+
+    The index is loaded once, then every insert, update and delete of an
+    event, made through any replica, is applied from a change stream on the
+    database, which carries the tombstones as well. Writes made through
+    this replica are also applied right away, so reads see them before the
+    stream delivers them. Until the first load completes, ``ready`` is
+    False and callers query Mongo instead.
+
+    The index keeps the feed change marker of what it has applied: the
+    latest ``updated_at`` and tombstone loaded or streamed. Responses cached
+    under a marker must only be built from an index at that marker;
+    ``current`` tells whether it is. Listeners are told of every streamed
+    change: the marker before and after it, and the intervals it touched.
+    Without a replica set there is no stream and the index is reloaded
+    periodically instead.
+    """
+
+    def __init__(self):
+        self.index = IntervalIndex(settings.interval_block_size)
+        self.ready = False
+        self._updated_at: Optional[datetime] = None
+        self._deleted_at: Optional[datetime] = None
+        self._latest_tombstone = None
+        self._replay = None
+        self._streaming = False
+        # Intervals events had before a write through this replica, until the stream delivers it
+        self._local = {}
+        self._listeners = []
+
+    def add_listener(self, listener: Callable[[str, str, list], None]):
+        """Call ``listener(previous marker, marker, [(start, end), ...])`` for every change streamed."""
+        self._listeners.append(listener)
+
+    @property
+    def marker(self) -> Optional[str]:
+        return change_marker(self._updated_at, self._deleted_at) if self.ready else None
+
+    def current(self, marker: str) -> bool:
+        """Check whether the index holds every change ``marker`` reflects, and none after."""
+        return self.ready and self.marker == marker
+
+    def upsert(self, event_id: str, start: datetime, end: datetime):
+        """Record the interval of a created or updated event."""
+        start, end = naive_utc(start), naive_utc(end)
+        self._remember(event_id)
+        self.index.add(event_id, start, end)
+        if self._replay is not None:
+            self._replay.append((event_id, start, end))
+
+    def remove(self, event_id: str):
+        """Forget a deleted event."""
+        self._remember(event_id)
+        self.index.remove(event_id)
+        if self._replay is not None:
+            self._replay.append((event_id, None, None))
+
+    def _remember(self, event_id: str):
+        if self._streaming and event_id not in self._local:
+            self._local[event_id] = self.index.get(event_id)
+
+    async def load(self, collection, tombstones):
+        """Rebuild the index from the collection, then swap it in."""
+        self._replay = []
+        try:
+            # Read first: writes made while loading leave the index labelled older than it is
+            latest, deleted = await latest_changes(collection, tombstones)
+            entries = []
+            async for event in collection.find({}, {"date_start": 1, "date_end": 1}):
+                entries.append((event["date_start"], event["date_end"], str(event["_id"])))
+            index = IntervalIndex.build(settings.interval_block_size, entries)
+
+            # Writes made while loading may be missing from what was read
+            for event_id, start, end in self._replay:
+                if start is None:
+                    index.remove(event_id)
+                else:
+                    index.add(event_id, start, end)
+            self.index = index
+            self._local = {}
+            self._updated_at = latest and latest["updated_at"]
+            self._deleted_at = deleted and deleted["deleted_at"]
+            self._latest_tombstone = deleted and deleted["_id"]
+            self.ready = True
+            logger.info(f"Loaded {len(index)} event intervals")
+        finally:
+            self._replay = None
+
+    def _apply(self, change: dict, tombstones_name: str) -> Optional[list]:
+        """Apply a streamed change; returns the intervals it touched, or None when the index must be reloaded."""
+        operation = change["operationType"]
+        if operation in ("drop", "rename", "dropDatabase", "invalidate"):
+            return None
+
+        if change["ns"]["coll"] == tombstones_name:
+            if operation == "insert":
+                deleted_at = change["fullDocument"]["deleted_at"]
+                if self._deleted_at is None or deleted_at >= self._deleted_at:
+                    self._deleted_at, self._latest_tombstone = deleted_at, change["documentKey"]["_id"]
+            elif operation == "delete" and change["documentKey"]["_id"] == self._latest_tombstone:
+                # The latest tombstone expiring moves the marker back to one only Mongo knows
+                return None
+            return []
+
+        event_id = str(change["documentKey"]["_id"])
+        before = self._local.pop(event_id, None) or self.index.get(event_id)
+        touched = [before[:2]] if before else []
+        if operation == "delete":
+            self.index.remove(event_id)
+            return touched
+        event = change.get("fullDocument")
+        if not event or "date_start" not in event:
+            # Deleted before it was looked up; its delete follows
+            return touched
+        start, end = naive_utc(event["date_start"]), naive_utc(event["date_end"])
+        self.index.add(event_id, start, end)
+        touched.append((start, end))
+        updated_at = event.get("updated_at")
+        if updated_at is not None and (self._updated_at is None or updated_at > self._updated_at):
+            self._updated_at = updated_at
+        return touched
+
+    async def _follow(self, collection, tombstones):
+        pipeline = [
+            {"$match": {"ns.coll": {"$in": [collection.name, tombstones.name]}}},
+            {"$project": {field: 1 for field in STREAM_FIELDS}},
+        ]
+        async with collection.database.watch(pipeline, full_document="updateLookup") as stream:
+            # Loaded once the stream is open, so no change falls in between
+            self._streaming = True
+            try:
+                await self.load(collection, tombstones)
+                async for change in stream:
+                    previous = self.marker
+                    touched = self._apply(change, tombstones.name)
+                    if touched is None:
+                        await self.load(collection, tombstones)
+                        continue
+                    feed_version.advance(self.marker)
+                    for listener in self._listeners:
+                        try:
+                            listener(previous, self.marker, touched)
+                        except Exception as e:
+                            logger.error(f"Error in event change listener: {e}")
+            finally:
+                self._streaming = False
+                self._local = {}
+
+    async def run(self, collection, tombstones):
+        """Load the index and keep it current until cancelled."""
+        while True:
+            try:
+                await self._follow(collection, tombstones)
+            except OperationFailure as e:
+                self.ready = False
+                if e.code == NOT_A_REPLICA_SET:
+                    logger.warning("Change streams need a replica set; reloading event intervals periodically")
+                    break
+                logger.error(f"Error following event changes: {e}")
+                await asyncio.sleep(settings.interval_retry_interval)
+            except Exception as e:
+                self.ready = False
+                logger.error(f"Error following event changes: {e}")
+                await asyncio.sleep(settings.interval_retry_interval)
+
+        while True:
+            try:
+                await self.load(collection, tombstones)
+            except Exception as e:
+                logger.error(f"Error loading event intervals: {e}")
+            await asyncio.sleep(settings.interval_refresh_interval)
+
+event_intervals = EventIntervals()
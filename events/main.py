@@ -1,13 +1,23 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Path, Header, Response, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from datetime import datetime, timedelta
 from bson import ObjectId
+import asyncio
+import hmac
+import functools
 import logging
 from typing import List, Optional
 
 from config import settings
-from database import connect_to_mongo, close_mongo_connection, get_collection
+from instrumentation import instrument
+from database import connect_to_mongo, close_mongo_connection, get_collection, get_index_report
+from pagination import apply_cursor, sort_spec, next_cursor, count_cache
 from models import Event, EventCreate, EventUpdate, EventList
+from intervals import event_intervals, find_events, naive_utc
+from feed import feed_version, etag, not_modified, window_filter, calendar_entry, record_tombstone, ics_feed
+from views import calendar_views, month_window, week_window
+from scheduler import transition_scheduler, statuses_at, TRANSITIONS
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,14 +34,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+instrument(app, "events")
+
+interval_refresher: Optional[asyncio.Task] = None
+transition_runner: Optional[asyncio.Task] = None
+
 @app.on_event("startup")
 async def startup_db_client():
+    global interval_refresher, transition_runner
     await connect_to_mongo()
+    collection = get_collection(settings.mongodb_collection)
+    # Calendar pages are brought forward as the interval index streams changes
+    event_intervals.add_listener(functools.partial(calendar_views.changed, collection))
+    interval_refresher = asyncio.create_task(event_intervals.run(collection, get_collection(settings.tombstones_collection)))
+    transition_runner = asyncio.create_task(transition_scheduler.run(collection))
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if interval_refresher:
+        interval_refresher.cancel()
+    if transition_runner:
+        transition_runner.cancel()
     await close_mongo_connection()
 
+# Fields rendered into the iCalendar export
+ICS_PROJECTION = {"name": 1, "description": 1, "date_start": 1, "date_end": 1, "updated_at": 1}
+
 @app.post("/events", response_model=Event)
 async def create_event(event_data: EventCreate):
     """Create a new event."""
@@ -41,9 +69,14 @@ async def create_event(event_data: EventCreate):
         event_dict = event_data.dict()
         event_dict["created_at"] = datetime.utcnow()
         event_dict["updated_at"] = datetime.utcnow()
+        event_dict.update(statuses_at(event_dict, event_dict["created_at"]))
         
         result = await collection.insert_one(event_dict)
+        count_cache.clear()
+        feed_version.touch()
         event_dict["id"] = str(result.inserted_id)
+        event_intervals.upsert(event_dict["id"], event_dict["date_start"], event_dict["date_end"])
+        transition_scheduler.schedule(event_dict)
         
         return Event(**event_dict)
         
@@ -51,39 +84,48 @@ async def create_event(event_data: EventCreate):
         logger.error(f"Error creating event: {e}")
         raise HTTPException(status_code=500, detail=f"Error creating event: {str(e)}")
 
+def time_filter(now: datetime, upcoming: Optional[bool], past: Optional[bool]) -> dict:
+    """Build the filter of the upcoming and past flags relative to ``now``."""
+    filter_query = {}
+    if upcoming is not None:
+        filter_query["date_start"] = {"$gte": now} if upcoming else {"$lt": now}
+    if past is not None:
+        filter_query["date_end"] = {"$lt": now} if past else {"$gte": now}
+    return filter_query
+
 @app.get("/events", response_model=EventList)
 async def list_events(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
     upcoming: Optional[bool] = Query(None),
-    past: Optional[bool] = Query(None)
+    past: Optional[bool] = Query(None),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from a previous page's next_cursor; replaces skip"),
+    with_total: bool = Query(True, description="Include the total count")
 ):
     """List events with optional filtering."""
     try:
         collection = get_collection(settings.mongodb_collection)
         
         # Build filter
-        filter_query = {}
         now = datetime.utcnow()
-        
-        if upcoming is not None:
-            if upcoming:
-                filter_query["date_start"] = {"$gte": now}
-            else:
-                filter_query["date_start"] = {"$lt": now}
-        
-        if past is not None:
-            if past:
-                filter_query["date_end"] = {"$lt": now}
-            else:
-                filter_query["date_end"] = {"$gte": now}
-        
-        # Get total count
-        total = await collection.count_documents(filter_query)
-        
-        # Get events with pagination
-        cursor = collection.find(filter_query).skip(skip).limit(limit).sort("date_start", 1)
-        events = await cursor.to_list(length=limit)
+        filter_query = time_filter(now, upcoming, past)
+        
+        # Get total count (optional, briefly cached); the cache key rounds "now" to the cache TTL
+        # so time-relative filters hit it, while the count and the page use the exact time
+        total = None
+        if with_total:
+            ttl = settings.count_cache_ttl
+            rounded = now
+            if ttl > 0:
+                rounded = datetime.utcfromtimestamp((now - datetime(1970, 1, 1)).total_seconds() // ttl * ttl)
+            total = await count_cache.count(collection, filter_query, key=repr(time_filter(rounded, upcoming, past)))
+        
+        # Get events with keyset pagination when a cursor is given, offset pagination otherwise
+        page_query = apply_cursor(filter_query, "date_start", 1, cursor)
+        db_cursor = collection.find(page_query).sort(sort_spec("date_start", 1)).limit(limit)
+        if not cursor:
+            db_cursor = db_cursor.skip(skip)
+        events = await db_cursor.to_list(length=limit)
         
         # Convert ObjectId to string
         for event in events:
@@ -91,9 +133,12 @@ async def list_events(
         
         return EventList(
             events=[Event(**event) for event in events],
-            total=total
+            total=total,
+            next_cursor=next_cursor(events, "date_start", limit)
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error listing events: {e}")
         raise HTTPException(status_code=500, detail=f"Error listing events: {str(e)}")
@@ -105,8 +150,11 @@ async def get_upcoming_events(limit: int = Query(10, ge=1, le=100)):
         collection = get_collection(settings.mongodb_collection)
         
         now = datetime.utcnow()
-        cursor = collection.find({"date_start": {"$gte": now}}).sort("date_start", 1).limit(limit)
-        events = await cursor.to_list(length=limit)
+        if event_intervals.ready:
+            events = await find_events(collection, event_intervals.index.starting_after(now, limit))
+        else:
+            cursor = collection.find({"date_start": {"$gte": now}}).sort("date_start", 1).limit(limit)
+            events = await cursor.to_list(length=limit)
         
         # Convert ObjectId to string
         for event in events:
@@ -125,11 +173,14 @@ async def get_current_events():
         collection = get_collection(settings.mongodb_collection)
         
         now = datetime.utcnow()
-        cursor = collection.find({
-            "date_start": {"$lte": now},
-            "date_end": {"$gte": now}
-        }).sort("date_start", 1)
-        events = await cursor.to_list(length=100)
+        if event_intervals.ready:
+            events = await find_events(collection, event_intervals.index.active_at(now, 100))
+        else:
+            cursor = collection.find({
+                "date_start": {"$lte": now},
+                "date_end": {"$gte": now}
+            }).sort("date_start", 1)
+            events = await cursor.to_list(length=100)
         
         # Convert ObjectId to string
         for event in events:
@@ -141,6 +192,171 @@ async def get_current_events():
         logger.error(f"Error getting current events: {e}")
         raise HTTPException(status_code=500, detail=f"Error getting current events: {str(e)}")
 
+@app.get("/events/overlapping", response_model=List[Event])
+async def get_overlapping_events(
+    start: datetime = Query(...),
+    end: datetime = Query(...),
+    limit: int = Query(100, ge=1, le=1000)
+):
+    """Get events overlapping the [start, end] window, ordered by start."""
+    start, end = naive_utc(start), naive_utc(end)
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    try:
+        collection = get_collection(settings.mongodb_collection)
+        
+        if event_intervals.ready:
+            events = await find_events(collection, event_intervals.index.overlapping(start, end, limit))
+        else:
+            cursor = collection.find({
+                "date_start": {"$lte": end},
+                "date_end": {"$gte": start}
+            }).sort("date_start", 1).limit(limit)
+            events = await cursor.to_list(length=limit)
+        
+        for event in events:
+            event["id"] = str(event["_id"])
+        
+        return [Event(**event) for event in events]
+        
+    except Exception as e:
+        logger.error(f"Error getting overlapping events: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting overlapping events: {str(e)}")
+
+@app.get("/events/calendar")
+async def get_calendar_events(
+    response: Response,
+    start_date: Optional[datetime] = Query(None),
+    end_date: Optional[datetime] = Query(None),
+    since: Optional[datetime] = Query(None, description="synced_at of a previous response; only changes made since are returned"),
+    if_none_match: Optional[str] = Header(None)
+):
+    """Get events for calendar view.
+    
+    With ``since``, only the events changed since then are returned, with the
+    ids of the events that left the window in ``deleted``; clients apply the
+    deletions first. ``full`` is set when the changes could not be given as a
+    delta and the response holds the whole window instead.
+    """
+    try:
+        collection = get_collection(settings.mongodb_collection)
+        tombstones = get_collection(settings.tombstones_collection)
+        
+        start = naive_utc(start_date) if start_date else None
+        end = naive_utc(end_date) if end_date else None
+        since = naive_utc(since) if since else None
+        # Taken before reading, so writes made meanwhile are in the next delta
+        synced_at = datetime.utcnow()
+        
+        marker = await feed_version.marker(collection, tombstones)
+        tag = etag(marker, "json", start, end, since)
+        if not_modified(if_none_match, tag):
+            return Response(status_code=304, headers={"ETag": tag})
+        response.headers["ETag"] = tag
+        
+        # Deletions older than the tombstones cannot be given as a delta
+        if since is not None and synced_at - since < timedelta(seconds=settings.tombstone_retention):
+            changed_after = since - timedelta(seconds=settings.calendar_sync_overlap)
+            window = window_filter(start, end)
+            cursor = collection.find({**window, "updated_at": {"$gte": changed_after}}).sort("updated_at", 1)
+            events = await cursor.to_list(length=1001)
+            
+            if len(events) <= 1000:
+                deleted = await tombstones.distinct("event_id", {**window, "deleted_at": {"$gte": changed_after}})
+                return {
+                    "events": [calendar_entry(event) for event in events],
+                    "deleted": deleted,
+                    "synced_at": synced_at.isoformat(),
+                    "full": False
+                }
+        
+        # The response is tagged with the marker, so the index must be at it
+        if start and end and event_intervals.current(marker):
+            # Events overlapping the window, not just starting in it
+            events = await find_events(collection, event_intervals.index.overlapping(start, end, 1000))
+        else:
+            cursor = collection.find(window_filter(start, end)).sort("date_start", 1)
+            events = await cursor.to_list(length=1000)
+        
+        return {
+            "events": [calendar_entry(event) for event in events],
+            "deleted": [],
+            "synced_at": synced_at.isoformat(),
+            "full": True
+        }
+        
+    except Exception as e:
+        logger.error(f"Error getting calendar events: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting calendar events: {str(e)}")
+
+async def calendar_page(key: str, window: tuple[datetime, datetime], if_none_match: Optional[str]) -> Response:
+    """Serve a month or week page of the calendar from its rendering."""
+    collection = get_collection(settings.mongodb_collection)
+    marker = await feed_version.marker(collection, get_collection(settings.tombstones_collection))
+    tag = etag(marker, "page", key)
+    if not_modified(if_none_match, tag):
+        return Response(status_code=304, headers={"ETag": tag})
+    body = await calendar_views.page(collection, marker, key, *window)
+    return Response(content=body, media_type="application/json", headers={"ETag": tag})
+
+@app.get("/events/calendar/month/{year}/{month}")
+async def get_calendar_month(
+    year: int = Path(..., ge=1, le=9998),
+    month: int = Path(..., ge=1, le=12),
+    if_none_match: Optional[str] = Header(None)
+):
+    """Get the events overlapping a month, ordered by start."""
+    try:
+        return await calendar_page(f"{year:04d}-{month:02d}", month_window(year, month), if_none_match)
+    except Exception as e:
+        logger.error(f"Error getting calendar month: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting calendar month: {str(e)}")
+
+@app.get("/events/calendar/week/{year}/{week}")
+async def get_calendar_week(
+    year: int = Path(..., ge=1, le=9998),
+    week: int = Path(..., ge=1, le=53),
+    if_none_match: Optional[str] = Header(None)
+):
+    """Get the events overlapping an ISO week, ordered by start."""
+    try:
+        window = week_window(year, week)
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f"{year} has no week {week}")
+    try:
+        return await calendar_page(f"{year:04d}-W{week:02d}", window, if_none_match)
+    except Exception as e:
+        logger.error(f"Error getting calendar week: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting calendar week: {str(e)}")
+
+@app.get("/events/calendar.ics")
+async def export_calendar(
+    start_date: Optional[datetime] = Query(None),
+    end_date: Optional[datetime] = Query(None),
+    if_none_match: Optional[str] = Header(None)
+):
+    """Export events overlapping a window as an iCalendar feed, rendered as it is read."""
+    try:
+        collection = get_collection(settings.mongodb_collection)
+        tombstones = get_collection(settings.tombstones_collection)
+        
+        start = naive_utc(start_date) if start_date else None
+        end = naive_utc(end_date) if end_date else None
+        tag = etag(await feed_version.marker(collection, tombstones), "ics", start, end)
+        if not_modified(if_none_match, tag):
+            return Response(status_code=304, headers={"ETag": tag})
+        
+        cursor = collection.find(window_filter(start, end), ICS_PROJECTION).sort("date_start", 1).limit(settings.calendar_ics_limit)
+        return StreamingResponse(
+            ics_feed(cursor),
+            media_type="text/calendar; charset=utf-8",
+            headers={"ETag": tag, "Content-Disposition": 'attachment; filename="events.ics"'}
+        )
+        
+    except Exception as e:
+        logger.error(f"Error exporting calendar: {e}")
+        raise HTTPException(status_code=500, detail=f"Error exporting calendar: {str(e)}")
+
 @app.get("/events/{event_id}", response_model=Event)
 async def get_event(event_id: str):
     """Get a specific event by ID."""
@@ -175,11 +391,16 @@ async def update_event(event_id: str, event_update: EventUpdate):
         update_data = event_update.dict(exclude_unset=True)
         update_data["updated_at"] = datetime.utcnow()
         
+        # Moved dates can move the statuses either way; transitions are rescheduled below
+        if any(date_field in update_data for date_field, _, _ in TRANSITIONS.values()):
+            update_data.update(statuses_at({**existing_event, **update_data}, update_data["updated_at"]))
+        
         # Update the event
         result = await collection.update_one(
             {"_id": ObjectId(event_id)},
             {"$set": update_data}
         )
+        count_cache.clear()
         
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Event not found")
@@ -187,6 +408,13 @@ async def update_event(event_id: str, event_update: EventUpdate):
         # Get updated event
         updated_event = await collection.find_one({"_id": ObjectId(event_id)})
         updated_event["id"] = str(updated_event["_id"])
+        event_intervals.upsert(event_id, updated_event["date_start"], updated_event["date_end"])
+        transition_scheduler.schedule(updated_event)
+        
+        # A moved event leaves the windows it was in; delta sync learns that from a tombstone
+        if (existing_event["date_start"], existing_event["date_end"]) != (updated_event["date_start"], updated_event["date_end"]):
+            await record_tombstone(get_collection(settings.tombstones_collection), existing_event)
+        feed_version.touch()
         
         return Event(**updated_event)
         
@@ -202,10 +430,15 @@ async def delete_event(event_id: str):
     try:
         collection = get_collection(settings.mongodb_collection)
         
-        result = await collection.delete_one({"_id": ObjectId(event_id)})
+        deleted_event = await collection.find_one_and_delete({"_id": ObjectId(event_id)})
+        count_cache.clear()
         
-        if result.deleted_count == 0:
+        if deleted_event is None:
             raise HTTPException(status_code=404, detail="Event not found")
+        event_intervals.remove(event_id)
+        transition_scheduler.unschedule(event_id)
+        await record_tombstone(get_collection(settings.tombstones_collection), deleted_event)
+        feed_version.touch()
         
         return {"message": "Event deleted successfully"}
         
@@ -249,47 +482,19 @@ async def search_events(query: str, skip: int = Query(0, ge=0), limit: int = Que
         logger.error(f"Error searching events: {e}")
         raise HTTPException(status_code=500, detail=f"Error searching events: {str(e)}")
 
-@app.get("/events/calendar")
-async def get_calendar_events(
-    start_date: Optional[datetime] = Query(None),
-    end_date: Optional[datetime] = Query(None)
-):
-    """Get events for calendar view."""
+def require_admin_token(x_admin_token: Optional[str] = Header(None)):
+    """Only let internal callers presenting the configured admin token through."""
+    if not settings.admin_token or not x_admin_token or not hmac.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+
+@app.get("/admin/indexes", dependencies=[Depends(require_admin_token)])
+async def index_report():
+    """Report index usage and query shapes that are not served by an index (internal callers only)."""
     try:
-        collection = get_collection(settings.mongodb_collection)
-        
-        # Build date filter
-        date_filter = {}
-        if start_date:
-            date_filter["$gte"] = start_date
-        if end_date:
-            date_filter["$lte"] = end_date
-        
-        if date_filter:
-            filter_query = {"date_start": date_filter}
-        else:
-            filter_query = {}
-        
-        cursor = collection.find(filter_query).sort("date_start", 1)
-        events = await cursor.to_list(length=1000)
-        
-        # Convert ObjectId to string and format for calendar
-        calendar_events = []
-        for event in events:
-            event["id"] = str(event["_id"])
-            calendar_events.append({
-                "id": event["id"],
-                "title": event["name"],
-                "start": event["date_start"].isoformat(),
-                "end": event["date_end"].isoformat(),
-                "description": event["description"]
-            })
-        
-        return {"events": calendar_events}
-        
+        return await get_index_report()
     except Exception as e:
-        logger.error(f"Error getting calendar events: {e}")
-        raise HTTPException(status_code=500, detail=f"Error getting calendar events: {str(e)}")
+        logger.error(f"Error getting index report: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting index report: {str(e)}")
 
 @app.get("/health")
 async def health_check():
@@ -25,7 +25,10 @@ class Event(EventBase):
     id: str
     created_at: datetime
     updated_at: datetime
+    status: Optional[str] = None
+    cfp_status: Optional[str] = None
 
 class EventList(BaseModel):
     events: list[Event]
-    total: int 
\ No newline at end of file
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None 
\ No newline at end of file
@@ -0,0 +1,234 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+import httpx
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from config import settings
+from feed import feed_version
+from instrumentation import upstream_hooks
+from intervals import naive_utc
+
+logger = logging.getLogger(__name__)
+
+# Transition name: (date field, status field, status it moves to)
+TRANSITIONS = {
+    "cfp_open": ("call_for_paper_date_start", "cfp_status", "open"),
+    "cfp_close": ("call_for_paper_date_end", "cfp_status", "closed"),
+    "event_start": ("date_start", "status", "live"),
+    "event_end": ("date_end", "status", "finished"),
+}
+
+# Values of each status field, in the order transitions move them
+STATUS_ORDER = {
+    "cfp_status": ["upcoming", "open", "closed"],
+    "status": ["scheduled", "live", "finished"],
+}
+
+SCHEDULE_PROJECTION = {"name": 1, "cfp_status": 1, "status": 1, **{field: 1 for field, _, _ in TRANSITIONS.values()}}
+
+def boundary(moment: Optional[datetime]) -> Optional[datetime]:
+    """Normalize a date as Mongo stores it: naive UTC, millisecond precision."""
+    if moment is None:
+        return None
+    moment = naive_utc(moment)
+    return moment.replace(microsecond=moment.microsecond // 1000 * 1000)
+
+def statuses_at(event: dict, now: datetime) -> dict:
+    """Get the CFP and event statuses an event has at ``now``."""
+    cfp_start = boundary(event.get("call_for_paper_date_start"))
+    cfp_end = boundary(event.get("call_for_paper_date_end"))
+    if cfp_start is None and cfp_end is None:
+        cfp_status = None
+    elif cfp_end is not None and cfp_end <= now:
+        cfp_status = "closed"
+    elif cfp_start is None or cfp_start <= now:
+        cfp_status = "open"
+    else:
+        cfp_status = "upcoming"
+
+    if boundary(event["date_end"]) <= now:
+        status = "finished"
+    elif boundary(event["date_start"]) <= now:
+        status = "live"
+    else:
+        status = "scheduled"
+    return {"cfp_status": cfp_status, "status": status}
+
+def _rank(status_field: str, value: Optional[str]) -> int:
+    order = STATUS_ORDER[status_field]
+    return order.index(value) if value in order else -1
+
+class TransitionScheduler:
+    """Fires CFP and event transitions at their dates.
+
+    Upcoming transitions sit in a heap ordered by when they are due, so
+    scheduling costs O(log n) and the loop sleeps until the earliest one.
+    Rescheduling or deleting an event does not search the heap: the live
+    date of each transition is kept aside and heap entries that disagree
+    with it are skipped when popped.
+
+    Firing sets the status field with an update conditional on the date and
+    on the status not being there yet. Only the replica whose update lands
+    calls the webhooks, so each transition is announced once however many
+    replicas schedule it. Transitions missed while no replica was running
+    fire on the next start.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._scheduled = {}
+        self._sequence = itertools.count()
+        self._wake = asyncio.Event()
+        self._loaded_until: Optional[datetime] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._deliveries = set()
+
+    def schedule(self, event: dict):
+        """Schedule the pending transitions of a created or updated event, replacing earlier ones."""
+        event_id = str(event["_id"])
+        pending = {}
+        for name, (date_field, status_field, target) in TRANSITIONS.items():
+            when = boundary(event.get(date_field))
+            if when is None or _rank(status_field, event.get(status_field)) >= _rank(status_field, target):
+                continue
+            pending[name] = when
+            self._push(when, event_id, name, when)
+
+        if pending:
+            self._scheduled[event_id] = pending
+        else:
+            self._scheduled.pop(event_id, None)
+        if self._heap and self._heap[0][2] == event_id:
+            self._wake.set()
+        self._compact()
+
+    def _push(self, due: datetime, event_id: str, name: str, when: datetime):
+        heapq.heappush(self._heap, (due, next(self._sequence), event_id, name, when))
+
+    def unschedule(self, event_id: str):
+        """Drop the transitions of a deleted event."""
+        self._scheduled.pop(event_id, None)
+        self._compact()
+
+    def _compact(self):
+        live = sum(len(pending) for pending in self._scheduled.values())
+        if len(self._heap) > 2 * live + 64:
+            self._heap = [entry for entry in self._heap if self._scheduled.get(entry[2], {}).get(entry[3]) == entry[4]]
+            heapq.heapify(self._heap)
+
+    async def load(self, collection):
+        """Schedule the events changed since the last load; the first load reads them all.
+
+        Events stored before statuses existed get the ones they have now,
+        without firing the transitions that led there.
+        """
+        started = datetime.utcnow()
+        query = {}
+        if self._loaded_until is not None:
+            # Overlap the previous load to tolerate clock skew between replicas
+            query = {"updated_at": {"$gte": self._loaded_until - timedelta(seconds=settings.scheduler_reload_overlap)}}
+
+        backfill = []
+        async for event in collection.find(query, SCHEDULE_PROJECTION):
+            if "status" not in event:
+                statuses = statuses_at(event, started)
+                event.update(statuses)
+                backfill.append(UpdateOne({"_id": event["_id"], "status": {"$exists": False}}, {"$set": statuses}))
+            self.schedule(event)
+
+        if backfill:
+            await collection.bulk_write(backfill, ordered=False)
+            logger.info(f"Set statuses on {len(backfill)} events")
+        self._loaded_until = started
+
+    async def _fire(self, collection, event_id: str, name: str, when: datetime):
+        date_field, status_field, target = TRANSITIONS[name]
+        reached = STATUS_ORDER[status_field][_rank(status_field, target):]
+        now = datetime.utcnow()
+        event = await collection.find_one_and_update(
+            {"_id": ObjectId(event_id), date_field: when, status_field: {"$nin": reached}},
+            {"$set": {status_field: target, "updated_at": now}},
+            projection={"name": 1}
+        )
+        if event is None:
+            # Another replica fired it, or the event changed since it was scheduled
+            return
+
+        logger.info(f"Event {event_id}: {name}")
+        feed_version.touch()
+        payload = {
+            "event_id": event_id,
+            "name": event.get("name"),
+            "transition": name,
+            status_field: target,
+            "at": when.isoformat(),
+            "fired_at": now.isoformat(),
+        }
+        for url in settings.transition_webhook_urls:
+            delivery = asyncio.create_task(self._deliver(url, payload))
+            self._deliveries.add(delivery)
+            delivery.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, url: str, payload: dict):
+        for attempt in range(settings.webhook_retries + 1):
+            try:
+                r = await self._client.post(url, json=payload)
+                r.raise_for_status()
+                return
+            except Exception as e:
+                logger.warning(f"Webhook {url} failed (attempt {attempt + 1}): {e!r}")
+                await asyncio.sleep(settings.webhook_retry_backoff * 2 ** attempt)
+        logger.error(f"Giving up on webhook {url} for {payload['transition']} of event {payload['event_id']}")
+
+    async def run(self, collection):
+        """Fire transitions as they come due, until cancelled."""
+        self._client = httpx.AsyncClient(timeout=settings.webhook_timeout, event_hooks=upstream_hooks("webhooks"))
+        reload_at = 0.0
+        try:
+            while True:
+                if time.monotonic() >= reload_at:
+                    try:
+                        await self.load(collection)
+                    except Exception as e:
+                        logger.error(f"Error loading transitions: {e}")
+                    reload_at = time.monotonic() + settings.scheduler_reload_interval
+
+                now = datetime.utcnow()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, event_id, name, when = heapq.heappop(self._heap)
+                    pending = self._scheduled.get(event_id)
+                    if pending is None or pending.get(name) != when:
+                        continue
+                    try:
+                        await self._fire(collection, event_id, name, when)
+                    except Exception as e:
+                        logger.error(f"Error firing {name} of event {event_id}: {e}")
+                        self._push(now + timedelta(seconds=settings.scheduler_retry_interval), event_id, name, when)
+                        continue
+                    # The event may have been rescheduled while firing
+                    if pending.get(name) == when:
+                        del pending[name]
+                        if not pending and self._scheduled.get(event_id) is pending:
+                            del self._scheduled[event_id]
+
+                delay = reload_at - time.monotonic()
+                if self._heap:
+                    delay = min(delay, (self._heap[0][0] - datetime.utcnow()).total_seconds())
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=max(0.0, delay))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for delivery in list(self._deliveries):
+                delivery.cancel()
+            await self._client.aclose()
+
+transition_scheduler = TransitionScheduler()
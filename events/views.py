@@ -0,0 +1,96 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from config import settings
+from feed import calendar_entry, window_filter
+from intervals import event_intervals, find_events
+
+logger = logging.getLogger(__name__)
+
+def month_window(year: int, month: int) -> tuple[datetime, datetime]:
+    """Get the first and last moment of a month; raises ValueError for an invalid month."""
+    start = datetime(year, month, 1)
+    following = datetime(year + month // 12, month % 12 + 1, 1)
+    return start, following - timedelta(milliseconds=1)
+
+def week_window(year: int, week: int) -> tuple[datetime, datetime]:
+    """Get the first and last moment of an ISO week; raises ValueError for an invalid week."""
+    start = datetime.fromisocalendar(year, week, 1)
+    return start, start + timedelta(weeks=1) - timedelta(milliseconds=1)
+
+class CalendarViews:
+    """Month and week pages of the calendar, rendered once and served from memory.
+
+    A page is keyed by its period and stamped with the feed's change marker;
+    it is served as long as the marker is unchanged, so a hit is one lookup
+    and no serialization. Pages are kept current on write: for every change
+    the interval index streams, through this replica or another one, the
+    pages overlapping the intervals it touched are rendered again in the
+    background and the others are restamped with the new marker. A page
+    the stream could not bring forward is rendered on its next request.
+    Concurrent requests for a page being rendered share the rendering.
+    """
+
+    def __init__(self, max_pages: int):
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self._rendering = {}
+
+    async def page(self, collection, marker: str, key: str, start: datetime, end: datetime) -> bytes:
+        """Get the rendered page of a period, as JSON."""
+        entry = self._pages.get(key)
+        if entry is not None and entry[0] == marker:
+            self._pages.move_to_end(key)
+            return entry[1]
+
+        body = await asyncio.shield(self._rendering_task(collection, marker, key, start, end))
+        self._pages[key] = (marker, body, start, end)
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+        return body
+
+    def changed(self, collection, previous: str, marker: str, touched: list):
+        """Bring the pages at ``previous`` to ``marker`` after a change to the events in ``touched``."""
+        for key, (page_marker, body, start, end) in list(self._pages.items()):
+            if page_marker != previous:
+                continue
+            if any(event_start <= end and event_end >= start for event_start, event_end in touched):
+                self._rendering_task(collection, marker, key, start, end)
+            else:
+                self._pages[key] = (marker, body, start, end)
+
+    def _rendering_task(self, collection, marker: str, key: str, start: datetime, end: datetime) -> asyncio.Task:
+        task = self._rendering.get((key, marker))
+        if task is None:
+            task = asyncio.create_task(self._render(collection, marker, key, start, end))
+            self._rendering[(key, marker)] = task
+            task.add_done_callback(lambda done: self._rendered(done, marker, key, start, end))
+        return task
+
+    def _rendered(self, task: asyncio.Task, marker: str, key: str, start: datetime, end: datetime):
+        self._rendering.pop((key, marker), None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.warning(f"Rendering calendar page {key} failed: {task.exception()!r}")
+            return
+        self._pages[key] = (marker, task.result(), start, end)
+
+    async def _render(self, collection, marker: str, key: str, start: datetime, end: datetime) -> bytes:
+        # An index behind the marker would be cached under it; read Mongo until it catches up
+        if event_intervals.current(marker):
+            events = await find_events(collection, event_intervals.index.overlapping(start, end))
+        else:
+            events = await collection.find(window_filter(start, end)).sort("date_start", 1).to_list(length=None)
+        return json.dumps({
+            "period": key,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "events": [calendar_entry(event) for event in events],
+        }, separators=(",", ":")).encode("utf-8")
+
+calendar_views = CalendarViews(settings.calendar_view_cache_size)
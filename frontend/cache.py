@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# A loader returns the value and whether it may be cached (degraded results are not)
+Loader = Callable[[], Awaitable[tuple[Any, bool]]]
+
+class ResponseCache:
+    """In-memory page and fragment cache.
+
+    Entries are fresh for ``ttl`` seconds and then served stale for up to
+    ``stale_ttl`` more while a single background request revalidates them.
+    Concurrent misses for the same key share one upstream load, and the
+    least recently used entries are evicted beyond ``max_entries``.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, stale_ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict()
+        self._loads = {}
+        self._generation = 0
+
+    async def get_or_load(self, key: str, loader: Loader) -> Any:
+        """Get a cached value, loading it (once, however many callers wait) when missing."""
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fresh_until, stale_until = entry
+            if now < fresh_until:
+                self._entries.move_to_end(key)
+                return value
+            if now < stale_until:
+                # Serve stale and refresh in the background
+                self._entries.move_to_end(key)
+                self._start_load(key, loader)
+                return value
+
+        return await asyncio.shield(self._start_load(key, loader))
+
+    def invalidate(self, *keys: str):
+        """Drop the given keys (every key when none are given).
+
+        Loads already in flight will not store their now outdated results.
+        """
+        self._generation += 1
+        if not keys:
+            self._entries.clear()
+            return
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def _start_load(self, key: str, loader: Loader) -> asyncio.Task:
+        task = self._loads.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader, self._generation))
+            self._loads[key] = task
+            task.add_done_callback(lambda done: self._load_done(key, done))
+        return task
+
+    def _load_done(self, key: str, task: asyncio.Task):
+        if self._loads.get(key) is task:
+            del self._loads[key]
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Cache load for {key} failed: {task.exception()!r}")
+
+    async def _load(self, key: str, loader: Loader, generation: int) -> Any:
+        value, cacheable = await loader()
+        if cacheable and generation == self._generation:
+            now = time.monotonic()
+            self._entries[key] = (value, now + self.ttl, now + self.ttl + self.stale_ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+page_cache = ResponseCache(settings.page_cache_max_entries, settings.page_cache_ttl, settings.page_cache_stale_ttl)
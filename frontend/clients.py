@@ -0,0 +1,59 @@
+import asyncio
+import logging
+from typing import Any, Optional
+
+import httpx
+
+from config import settings
+from instrumentation import upstream_hooks
+
+logger = logging.getLogger(__name__)
+
+UPSTREAMS = ("auth", "medias", "posts", "ads", "events", "polls", "metrics")
+
+class UpstreamClients:
+    """Application-lifetime pooled HTTP clients, one per upstream service.
+
+    Each upstream gets its own connection pool so a slow service cannot
+    exhaust the connections of the others.
+    """
+
+    def __init__(self):
+        self._clients = {}
+
+    def start(self):
+        """Open one keep-alive client per upstream."""
+        for name in UPSTREAMS:
+            self._clients[name] = httpx.AsyncClient(
+                base_url=getattr(settings, f"{name}_url"),
+                http2=settings.upstream_http2,
+                limits=httpx.Limits(
+                    max_connections=settings.upstream_max_connections,
+                    max_keepalive_connections=settings.upstream_max_keepalive_connections,
+                    keepalive_expiry=settings.upstream_keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(settings.upstream_timeout, connect=settings.upstream_connect_timeout),
+                event_hooks=upstream_hooks(name),
+            )
+
+    async def close(self):
+        """Close every client and its pooled connections."""
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients = {}
+
+    def __getitem__(self, name: str) -> httpx.AsyncClient:
+        return self._clients[name]
+
+upstreams = UpstreamClients()
+
+async def fetch_json(upstream: str, path: str, default: Any, deadline: Optional[float] = None) -> Any:
+    """GET JSON from an upstream within a deadline, falling back to ``default`` on any failure."""
+    try:
+        r = await asyncio.wait_for(upstreams[upstream].get(path), deadline or settings.upstream_deadline)
+        if r.status_code != 200:
+            return default
+        return r.json()
+    except Exception as e:
+        logger.warning(f"Upstream {upstream} {path} failed: {e!r}")
+        return default
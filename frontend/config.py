@@ -10,6 +10,29 @@ class Settings(BaseSettings):
     metrics_url: str = "http://metrics:8000"
     secret_key: str = "frontend-secret"
     
+    # Upstream HTTP clients
+    upstream_http2: bool = True
+    upstream_max_connections: int = 100
+    upstream_max_keepalive_connections: int = 20
+    upstream_keepalive_expiry: float = 30.0
+    upstream_timeout: float = 10.0
+    upstream_connect_timeout: float = 2.0
+    upstream_deadline: float = 2.0
+    media_transfer_timeout: float = 300.0
+    
+    # Seconds the refresh token cookie is kept (the session itself expires in auth)
+    refresh_cookie_max_age: int = 14 * 86400
+    
+    # Token verification keys published by auth
+    jwks_refresh_interval: float = 300.0
+    # Minimum seconds between refreshes triggered by an unknown key id
+    jwks_min_refresh_interval: float = 10.0
+    
+    # Page cache
+    page_cache_ttl: float = 30.0
+    page_cache_stale_ttl: float = 300.0
+    page_cache_max_entries: int = 256
+    
     class Config:
         env_file = ".env"
 
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from jose import JWTError, jwt
+
+from config import settings
+from clients import upstreams
+
+logger = logging.getLogger(__name__)
+
+class KeySet:
+    """The auth service's public signing keys, cached for local token verification.
+
+    The key set is refreshed in the background; a token signed with a key
+    not seen yet triggers an immediate refresh, rate limited so forged
+    ``kid`` values cannot turn into a request per page view.
+    """
+
+    def __init__(self):
+        self._keys = {}
+        self._refreshed_at = 0.0
+        self._refresh: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start refreshing the key set in the background."""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background refresh."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def refresh(self):
+        """Fetch the key set now, sharing a refresh already in flight."""
+        if self._refresh is None:
+            self._refresh = asyncio.create_task(self._fetch())
+        task = self._refresh
+        try:
+            await asyncio.shield(task)
+        finally:
+            if self._refresh is task and task.done():
+                self._refresh = None
+
+    async def _fetch(self):
+        r = await upstreams["auth"].get("/.well-known/jwks.json")
+        r.raise_for_status()
+        self._keys = {key["kid"]: key for key in r.json()["keys"]}
+        self._refreshed_at = time.monotonic()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Could not refresh signing keys: {e!r}")
+            await asyncio.sleep(settings.jwks_refresh_interval)
+
+    async def verify(self, token: str) -> Optional[dict]:
+        """Get the claims of a valid token, or None."""
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except JWTError:
+            return None
+
+        key = self._keys.get(kid)
+        if key is None and time.monotonic() - self._refreshed_at > settings.jwks_min_refresh_interval:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Could not refresh signing keys: {e!r}")
+            key = self._keys.get(kid)
+        if key is None:
+            return None
+
+        try:
+            return jwt.decode(token, key, algorithms=["RS256"])
+        except JWTError:
+            return None
+
+key_set = KeySet()
@@ -1,14 +1,22 @@
 from fastapi import FastAPI, Request, Form, Depends, status, HTTPException
-from fastapi.responses import RedirectResponse, HTMLResponse, Response
+from fastapi.responses import RedirectResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-import httpx
+import asyncio
+import logging
 import os
+from typing import Optional
 from config import settings
+from instrumentation import instrument
+from clients import upstreams, fetch_json
+from cache import page_cache
+from jwks import key_set
+from starlette.background import BackgroundTask
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request as StarletteRequest
-import jwt
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Blog Frontend", version="1.0.0")
 
@@ -20,44 +28,71 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+instrument(app, "frontend")
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
 app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
 
+@app.on_event("startup")
+async def startup_http_clients():
+    upstreams.start()
+    key_set.start()
+
+@app.on_event("shutdown")
+async def shutdown_http_clients():
+    await key_set.stop()
+    await upstreams.close()
+
 # --- Helper functions ---
 async def get_metrics():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.metrics_url}/metrics")
-        return r.json() if r.status_code == 200 else {}
+    return await fetch_json("metrics", "/metrics", {})
 
 async def get_posts():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.posts_url}/posts?is_active=true&limit=10")
-        return r.json().get("posts", []) if r.status_code == 200 else []
+    data = await fetch_json("posts", "/posts?is_active=true&limit=10", None)
+    return data.get("posts", []) if data is not None else None
 
 async def get_ads():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.ads_url}/ads/active")
-        return r.json() if r.status_code == 200 else []
+    return await fetch_json("ads", "/ads/active", None)
 
 async def get_events():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.events_url}/events?limit=10")
-        return r.json().get("events", []) if r.status_code == 200 else []
+    data = await fetch_json("events", "/events?limit=10", None)
+    return data.get("events", []) if data is not None else None
 
 async def get_polls():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.polls_url}/polls/active")
-        return r.json() if r.status_code == 200 else []
+    return await fetch_json("polls", "/polls/active", None)
+
+# Home page fragments; each helper returns None when its upstream failed
+HOME_FRAGMENTS = {"posts": get_posts, "ads": get_ads, "events": get_events, "polls": get_polls}
+
+def fragment_loader(fetch):
+    async def load():
+        value = await fetch()
+        return value, value is not None
+    return load
+
+async def render_home(request: Request):
+    """Render the home page from cached fragments; degraded pages are not cached."""
+    # Fan out concurrently; each dependency has its own deadline and fallback
+    values = await asyncio.gather(*[
+        page_cache.get_or_load(f"fragment:{name}", fragment_loader(fetch))
+        for name, fetch in HOME_FRAGMENTS.items()
+    ])
+    context = {"request": request}
+    for name, value in zip(HOME_FRAGMENTS, values):
+        context[name] = value if value is not None else []
+    html = templates.get_template("home.html").render(context)
+    return html, all(value is not None for value in values)
+
+def invalidate_home(fragment: str):
+    """Drop the cached home page and the fragment a write changed."""
+    page_cache.invalidate("page:home", f"fragment:{fragment}")
 
 # --- Routes ---
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    posts = await get_posts()
-    ads = await get_ads()
-    events = await get_events()
-    polls = await get_polls()
-    return templates.TemplateResponse("home.html", {"request": request, "posts": posts, "ads": ads, "events": events, "polls": polls})
+    html = await page_cache.get_or_load("page:home", lambda: render_home(request))
+    return HTMLResponse(html)
 
 @app.get("/admin", response_class=HTMLResponse)
 async def admin_dashboard(request: Request):
@@ -84,6 +119,29 @@ async def manage_events(request: Request):
 async def manage_polls(request: Request):
     return templates.TemplateResponse("polls.html", {"request": request})
 
+def set_auth_cookies(response: Response, tokens: dict):
+    """Store the tokens returned by the auth service in cookies."""
+    response.set_cookie(key="access_token", value=tokens["access_token"], httponly=True, samesite="lax")
+    if tokens.get("refresh_token"):
+        response.set_cookie(
+            key="refresh_token",
+            value=tokens["refresh_token"],
+            max_age=settings.refresh_cookie_max_age,
+            httponly=True,
+            samesite="lax",
+        )
+
+async def refresh_tokens(refresh_token: str) -> Optional[dict]:
+    """Get new tokens from the auth service, or None if the session is over."""
+    try:
+        r = await upstreams["auth"].post("/token/refresh", json={"refresh_token": refresh_token})
+    except Exception as e:
+        logger.warning(f"Token refresh failed: {e!r}")
+        return None
+    if r.status_code != 200:
+        return None
+    return r.json()
+
 @app.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
@@ -91,233 +149,236 @@ async def login_page(request: Request):
 @app.post("/login")
 async def login(request: Request, username: str = Form(...), password: str = Form(...)):
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.post(f"{settings.auth_url}/login", json={"username": username, "password": password})
-            print(f"Auth service response status: {r.status_code}")
-            print(f"Auth service response: {r.text}")
+        r = await upstreams["auth"].post("/login", json={"username": username, "password": password})
+        
+        if r.status_code == 200:
+            response_data = r.json()
             
-            if r.status_code == 200:
-                response_data = r.json()
-                print(f"Response data: {response_data}")
-                
-                # In production, set a secure cookie or session
-                response = RedirectResponse(url="/admin", status_code=status.HTTP_302_FOUND)
-                response.set_cookie(key="access_token", value=response_data["access_token"])
-                return response
-            else:
-                error_msg = "Invalid credentials"
-                try:
-                    error_data = r.json()
-                    error_msg = error_data.get("detail", "Invalid credentials")
-                except:
-                    pass
-                return templates.TemplateResponse("login.html", {"request": request, "error": error_msg})
+            response = RedirectResponse(url="/admin", status_code=status.HTTP_302_FOUND)
+            set_auth_cookies(response, response_data)
+            return response
+        else:
+            # Only the status is logged; the body may carry tokens
+            logger.info(f"Login rejected by the auth service: {r.status_code}")
+            error_msg = "Invalid credentials"
+            try:
+                error_data = r.json()
+                error_msg = error_data.get("detail", "Invalid credentials")
+            except:
+                pass
+            return templates.TemplateResponse("login.html", {"request": request, "error": error_msg})
     except Exception as e:
-        print(f"Login error: {e}")
+        logger.warning(f"Login failed: {e!r}")
         return templates.TemplateResponse("login.html", {"request": request, "error": f"Login error: {str(e)}"})
 
 @app.get("/logout")
-async def logout():
+async def logout(request: Request):
+    refresh_token = request.cookies.get("refresh_token")
+    if refresh_token:
+        try:
+            await upstreams["auth"].post("/logout", json={"refresh_token": refresh_token})
+        except Exception as e:
+            logger.warning(f"Logout failed: {e!r}")
     response = RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
     response.delete_cookie("access_token")
+    response.delete_cookie("refresh_token")
     return response
 
 # --- API Routes for Posts CRUD ---
 @app.get("/api/posts")
 async def api_get_posts():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.posts_url}/posts")
-        return r.json() if r.status_code == 200 else {"posts": []}
+    r = await upstreams["posts"].get("/posts")
+    return r.json() if r.status_code == 200 else {"posts": []}
 
 @app.get("/api/posts/{post_id}")
 async def api_get_post(post_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.posts_url}/posts/{post_id}")
-        return r.json() if r.status_code == 200 else {}
+    r = await upstreams["posts"].get(f"/posts/{post_id}")
+    return r.json() if r.status_code == 200 else {}
 
 @app.post("/api/posts")
 async def api_create_post(request: Request):
     data = await request.json()
-    async with httpx.AsyncClient() as client:
-        r = await client.post(f"{settings.posts_url}/posts", json=data)
-        return r.json() if r.status_code == 200 else {"error": "Failed to create post"}
+    r = await upstreams["posts"].post("/posts", json=data)
+    invalidate_home("posts")
+    return r.json() if r.status_code == 200 else {"error": "Failed to create post"}
 
 @app.put("/api/posts/{post_id}")
 async def api_update_post(post_id: str, request: Request):
     data = await request.json()
-    async with httpx.AsyncClient() as client:
-        r = await client.put(f"{settings.posts_url}/posts/{post_id}", json=data)
-        return r.json() if r.status_code == 200 else {"error": "Failed to update post"}
+    r = await upstreams["posts"].put(f"/posts/{post_id}", json=data)
+    invalidate_home("posts")
+    return r.json() if r.status_code == 200 else {"error": "Failed to update post"}
 
 @app.delete("/api/posts/{post_id}")
 async def api_delete_post(post_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.delete(f"{settings.posts_url}/posts/{post_id}")
-        return r.json() if r.status_code == 200 else {"error": "Failed to delete post"}
+    r = await upstreams["posts"].delete(f"/posts/{post_id}")
+    invalidate_home("posts")
+    return r.json() if r.status_code == 200 else {"error": "Failed to delete post"}
 
 # --- API Routes for Ads CRUD ---
 @app.get("/api/ads")
 async def api_get_ads():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.ads_url}/ads")
-        return r.json() if r.status_code == 200 else {"ads": []}
+    r = await upstreams["ads"].get("/ads")
+    return r.json() if r.status_code == 200 else {"ads": []}
 
 @app.get("/api/ads/{ad_id}")
 async def api_get_ad(ad_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.ads_url}/ads/{ad_id}")
-        return r.json() if r.status_code == 200 else {}
+    r = await upstreams["ads"].get(f"/ads/{ad_id}")
+    return r.json() if r.status_code == 200 else {}
 
 @app.post("/api/ads")
 async def api_create_ad(request: Request):
     data = await request.json()
-    async with httpx.AsyncClient() as client:
-        r = await client.post(f"{settings.ads_url}/ads", json=data)
-        return r.json() if r.status_code == 200 else {"error": "Failed to create ad"}
+    r = await upstreams["ads"].post("/ads", json=data)
+    invalidate_home("ads")
+    return r.json() if r.status_code == 200 else {"error": "Failed to create ad"}
 
 @app.put("/api/ads/{ad_id}")
 async def api_update_ad(ad_id: str, request: Request):
     data = await request.json()
-    async with httpx.AsyncClient() as client:
-        r = await client.put(f"{settings.ads_url}/ads/{ad_id}", json=data)
-        return r.json() if r.status_code == 200 else {"error": "Failed to update ad"}
+    r = await upstreams["ads"].put(f"/ads/{ad_id}", json=data)
+    invalidate_home("ads")
+    return r.json() if r.status_code == 200 else {"error": "Failed to update ad"}
 
 @app.delete("/api/ads/{ad_id}")
 async def api_delete_ad(ad_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.delete(f"{settings.ads_url}/ads/{ad_id}")
-        return r.json() if r.status_code == 200 else {"error": "Failed to delete ad"}
+    r = await upstreams["ads"].delete(f"/ads/{ad_id}")
+    invalidate_home("ads")
+    return r.json() if r.status_code == 200 else {"error": "Failed to delete ad"}
 
 # --- API Routes for Events CRUD ---
 @app.get("/api/events")
 async def api_get_events():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.events_url}/events")
-        return r.json() if r.status_code == 200 else {"events": []}
+    r = await upstreams["events"].get("/events")
+    return r.json() if r.status_code == 200 else {"events": []}
 
 @app.get("/api/events/{event_id}")
 async def api_get_event(event_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.events_url}/events/{event_id}")
-        return r.json() if r.status_code == 200 else {}
+    r = await upstreams["events"].get(f"/events/{event_id}")
+    return r.json() if r.status_code == 200 else {}
 
 @app.post("/api/events")
 async def api_create_event(request: Request):
     data = await request.json()
-    async with httpx.AsyncClient() as client:
-        r = await client.post(f"{settings.events_url}/events", json=data)
-        return r.json() if r.status_code == 200 else {"error": "Failed to create event"}
+    r = await upstreams["events"].post("/events", json=data)
+    invalidate_home("events")
+    return r.json() if r.status_code == 200 else {"error": "Failed to create event"}
 
 @app.put("/api/events/{event_id}")
 async def api_update_event(event_id: str, request: Request):
     data = await request.json()
-    async with httpx.AsyncClient() as client:
-        r = await client.put(f"{settings.events_url}/events/{event_id}", json=data)
-        return r.json() if r.status_code == 200 else {"error": "Failed to update event"}
+    r = await upstreams["events"].put(f"/events/{event_id}", json=data)
+    invalidate_home("events")
+    return r.json() if r.status_code == 200 else {"error": "Failed to update event"}
 
 @app.delete("/api/events/{event_id}")
 async def api_delete_event(event_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.delete(f"{settings.events_url}/events/{event_id}")
-        return r.json() if r.status_code == 200 else {"error": "Failed to delete event"}
+    r = await upstreams["events"].delete(f"/events/{event_id}")
+    invalidate_home("events")
+    return r.json() if r.status_code == 200 else {"error": "Failed to delete event"}
 
 # --- API Routes for Polls CRUD ---
 @app.get("/api/polls")
 async def api_get_polls():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.polls_url}/polls")
-        return r.json() if r.status_code == 200 else {"polls": []}
+    r = await upstreams["polls"].get("/polls")
+    return r.json() if r.status_code == 200 else {"polls": []}
 
 @app.get("/api/polls/{poll_id}")
 async def api_get_poll(poll_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.polls_url}/polls/{poll_id}")
-        return r.json() if r.status_code == 200 else {}
+    r = await upstreams["polls"].get(f"/polls/{poll_id}")
+    return r.json() if r.status_code == 200 else {}
 
 @app.post("/api/polls")
 async def api_create_poll(request: Request):
     data = await request.json()
-    async with httpx.AsyncClient() as client:
-        r = await client.post(f"{settings.polls_url}/polls", json=data)
-        return r.json() if r.status_code == 200 else {"error": "Failed to create poll"}
+    r = await upstreams["polls"].post("/polls", json=data)
+    invalidate_home("polls")
+    return r.json() if r.status_code == 200 else {"error": "Failed to create poll"}
 
 @app.put("/api/polls/{poll_id}")
 async def api_update_poll(poll_id: str, request: Request):
     data = await request.json()
-    async with httpx.AsyncClient() as client:
-        r = await client.put(f"{settings.polls_url}/polls/{poll_id}", json=data)
-        return r.json() if r.status_code == 200 else {"error": "Failed to update poll"}
+    r = await upstreams["polls"].put(f"/polls/{poll_id}", json=data)
+    invalidate_home("polls")
+    return r.json() if r.status_code == 200 else {"error": "Failed to update poll"}
 
 @app.delete("/api/polls/{poll_id}")
 async def api_delete_poll(poll_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.delete(f"{settings.polls_url}/polls/{poll_id}")
-        return r.json() if r.status_code == 200 else {"error": "Failed to delete poll"}
+    r = await upstreams["polls"].delete(f"/polls/{poll_id}")
+    invalidate_home("polls")
+    return r.json() if r.status_code == 200 else {"error": "Failed to delete poll"}
 
 @app.get("/api/polls/{poll_id}/results")
 async def api_get_poll_results(poll_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.polls_url}/polls/{poll_id}/results")
-        return r.json() if r.status_code == 200 else {"error": "Failed to get poll results"}
+    r = await upstreams["polls"].get(f"/polls/{poll_id}/results")
+    return r.json() if r.status_code == 200 else {"error": "Failed to get poll results"}
 
 # --- API Routes for Medias CRUD ---
 @app.get("/api/medias")
 async def api_get_medias():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.medias_url}/files")
-        return r.json() if r.status_code == 200 else {"medias": []}
+    r = await upstreams["medias"].get("/files")
+    return r.json() if r.status_code == 200 else {"medias": []}
 
 @app.get("/api/medias/{media_id}")
 async def api_get_media(media_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.medias_url}/files/{media_id}")
-        return r.json() if r.status_code == 200 else {}
+    r = await upstreams["medias"].get(f"/files/{media_id}")
+    return r.json() if r.status_code == 200 else {}
 
 @app.post("/api/medias/upload")
 async def api_upload_media(request: Request):
-    form = await request.form()
-    file = form.get("file")
-    folder = form.get("folder", "general")
-    
-    if not file:
+    # Pass the multipart body through chunk by chunk instead of buffering the file
+    content_type = request.headers.get("content-type", "")
+    if not content_type.startswith("multipart/form-data"):
         return {"error": "No file provided"}
     
-    # Read the file content
-    file_content = await file.read()
-    
-    # Create the files tuple with the file content
-    files = {"file": (file.filename, file_content, file.content_type)}
-    data = {"folder": folder}
+    headers = {"content-type": content_type}
+    if "content-length" in request.headers:
+        headers["content-length"] = request.headers["content-length"]
     
-    async with httpx.AsyncClient() as client:
-        r = await client.post(f"{settings.medias_url}/upload", files=files, data=data)
-        return r.json() if r.status_code == 200 else {"error": "Failed to upload file"}
+    r = await upstreams["medias"].post("/upload", content=request.stream(), headers=headers, timeout=settings.media_transfer_timeout)
+    return r.json() if r.status_code == 200 else {"error": "Failed to upload file"}
 
 @app.delete("/api/medias/{media_id}")
 async def api_delete_media(media_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.delete(f"{settings.medias_url}/files/{media_id}")
-        return r.json() if r.status_code == 200 else {"error": "Failed to delete media"}
+    r = await upstreams["medias"].delete(f"/files/{media_id}")
+    return r.json() if r.status_code == 200 else {"error": "Failed to delete media"}
 
 @app.get("/api/medias/{media_id}/download")
-async def api_download_media(media_id: str):
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"{settings.medias_url}/files/{media_id}/download")
-        if r.status_code == 200:
-            return Response(content=r.content, media_type=r.headers.get("content-type"))
+async def api_download_media(media_id: str, request: Request):
+    headers = {}
+    if "range" in request.headers:
+        headers["range"] = request.headers["range"]
+    
+    client = upstreams["medias"]
+    upstream_request = client.build_request("GET", f"/files/{media_id}/content", headers=headers, timeout=settings.media_transfer_timeout)
+    r = await client.send(upstream_request, stream=True)
+    if r.status_code not in (200, 206):
+        await r.aclose()
         return {"error": "Failed to download file"}
+    
+    passthrough = {
+        name: r.headers[name]
+        for name in ("content-length", "content-range", "accept-ranges")
+        if name in r.headers
+    }
+    return StreamingResponse(
+        r.aiter_raw(),
+        status_code=r.status_code,
+        media_type=r.headers.get("content-type"),
+        headers=passthrough,
+        background=BackgroundTask(r.aclose)
+    )
 
 @app.get("/test-login")
 async def test_login():
     """Test endpoint to check login with default admin credentials."""
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.post(f"{settings.auth_url}/login", json={"username": "admin", "password": "admin123"})
-            return {
-                "status_code": r.status_code,
-                "response": r.text,
-                "headers": dict(r.headers)
-            }
+        r = await upstreams["auth"].post("/login", json={"username": "admin", "password": "admin123"})
+        return {
+            "status_code": r.status_code,
+            "response": r.text,
+            "headers": dict(r.headers)
+        }
     except Exception as e:
         return {"error": f"Login test failed: {str(e)}"}
 
@@ -325,9 +386,8 @@ async def test_login():
 async def test_auth():
     """Test endpoint to check if auth service is reachable."""
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(f"{settings.auth_url}/health")
-            return {"auth_service_status": r.status_code, "auth_service_response": r.text}
+        r = await upstreams["auth"].get("/health")
+        return {"auth_service_status": r.status_code, "auth_service_response": r.text}
     except Exception as e:
         return {"error": f"Auth service not reachable: {str(e)}"}
 
@@ -340,22 +400,28 @@ class AuthMiddleware(BaseHTTPMiddleware):
         # Only protect /admin routes (except /login)
         if request.url.path.startswith("/admin") and request.url.path != "/login":
             token = request.cookies.get("access_token")
-            if not token:
-                return RedirectResponse(url="/login", status_code=302)
+            # Verified locally against the auth service's published keys
+            claims = await key_set.verify(token) if token else None
             
-            # For now, skip JWT verification to allow login to work
-            # In production, you should properly verify the JWT token
-            try:
-                # Basic token validation - just check if it exists and has the right format
-                if not token or len(token.split('.')) != 3:
-                    return RedirectResponse(url="/login", status_code=302)
-                
-                # Optional: Verify JWT signature (requires the same secret key as auth service)
-                # jwt.decode(token, settings.secret_key, algorithms=["HS256"])
-                
-            except Exception as e:
-                print(f"Token verification error: {e}")
-                return RedirectResponse(url="/login", status_code=302)
+            tokens = None
+            if claims is None:
+                # Expired or missing: renew it once from the refresh token
+                refresh_token = request.cookies.get("refresh_token")
+                tokens = await refresh_tokens(refresh_token) if refresh_token else None
+                if tokens is not None:
+                    claims = await key_set.verify(tokens["access_token"])
+            
+            if claims is None:
+                response = RedirectResponse(url="/login", status_code=302)
+                response.delete_cookie("access_token")
+                response.delete_cookie("refresh_token")
+                return response
+            request.state.user = claims
+            
+            response = await call_next(request)
+            if tokens is not None:
+                set_auth_cookies(response, tokens)
+            return response
         
         response = await call_next(request)
         return response
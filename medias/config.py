@@ -1,6 +1,23 @@
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
+    # MongoDB Configuration
+    mongodb_host: str = "localhost"
+    mongodb_port: int = 27017
+    mongodb_database: str = "blog_medias"
+    mongodb_collection: str = "medias"
+    mongodb_username: str = "admin"
+    mongodb_password: str = "password"
+    # MongoDB runs as a replica set (change streams, transactions); with its name the client
+    # discovers the members, without it the configured host is connected to directly
+    mongodb_replica_set: str = ""
+    drop_unknown_indexes: bool = False
+    # Token internal callers send as X-Admin-Token to reach /admin/indexes; empty disables it
+    admin_token: str = ""
+    
+    # Pagination
+    count_cache_ttl: float = 5.0
+    
     # MinIO Configuration
     minio_host: str = "localhost"
     minio_port: int = 9000
@@ -8,6 +25,14 @@ class Settings(BaseSettings):
     minio_access_key: str = "minioadmin"
     minio_secret_key: str = "minioadmin"
     minio_secure: bool = False
+    minio_part_size: int = 10 * 1024 * 1024
+    stream_chunk_size: int = 256 * 1024
+    minio_max_workers: int = 16
+    minio_connect_timeout: float = 5.0
+    minio_read_timeout: float = 300.0
+    minio_init_retries: int = 5
+    minio_init_backoff: float = 1.0
+    reconcile_batch_size: int = 1000
     
     class Config:
         env_file = ".env"
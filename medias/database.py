@@ -0,0 +1,154 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from config import settings
+from instrumentation import mongo_listener
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Database:
+    client: AsyncIOMotorClient = None
+    database = None
+
+db = Database()
+
+# Indexes the service's queries rely on, reconciled at startup
+INDEXES = [
+    IndexModel([("object_name", ASCENDING)], name="object_name_unique", unique=True),
+    IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at"),
+    IndexModel([("folder", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="folder_created_at"),
+    IndexModel([("content_type", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="content_type_created_at"),
+    IndexModel([("reconciled_at", ASCENDING)], name="reconciled_at"),
+]
+
+# Query shapes the service issues, checked by the index report
+QUERY_SHAPES = [
+    {"name": "list_files", "filter": {}, "sort": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "list_files_by_folder", "filter": {"folder": "general"}, "sort": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "list_files_by_content_type", "filter": {"content_type": {"$regex": "^image/"}}, "sort": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "file_by_object_name", "filter": {"object_name": "general/file"}},
+]
+
+async def connect_to_mongo():
+    """Create database connection."""
+    try:
+        options = f"replicaSet={settings.mongodb_replica_set}" if settings.mongodb_replica_set else "directConnection=true"
+        connection_string = f"mongodb://{settings.mongodb_username}:{settings.mongodb_password}@{settings.mongodb_host}:{settings.mongodb_port}/?{options}"
+        db.client = AsyncIOMotorClient(connection_string, event_listeners=[mongo_listener])
+        db.database = db.client[settings.mongodb_database]
+        logger.info("Connected to MongoDB.")
+    except Exception as e:
+        logger.error(f"Could not connect to MongoDB: {e}")
+        raise e
+    
+    await ensure_indexes()
+
+async def close_mongo_connection():
+    """Close database connection."""
+    if db.client:
+        db.client.close()
+        logger.info("Closed MongoDB connection.")
+
+def get_collection(collection_name: str):
+    """Get collection from database."""
+    return db.database[collection_name]
+
+_INDEX_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression", "weights")
+
+def _index_signature(spec: dict) -> tuple:
+    """Get a comparable signature of an index definition or of an existing index."""
+    key = spec["key"]
+    items = list(key.items()) if hasattr(key, "items") else list(key)
+    if any(value == "text" or field == "_fts" for field, value in items):
+        # Text indexes are stored as _fts/_ftsx keys; their weights identify them
+        key_signature = "text"
+    else:
+        key_signature = tuple((field, value if isinstance(value, str) else int(value)) for field, value in items)
+    
+    options = []
+    for option in _INDEX_OPTIONS:
+        value = spec.get(option)
+        # Not "in (None, False)": 0 == False, and expireAfterSeconds=0 is a real setting
+        if value is None or value is False:
+            continue
+        if hasattr(value, "items"):
+            value = tuple(sorted(value.items()))
+        options.append((option, value))
+    return key_signature, tuple(options)
+
+async def ensure_indexes():
+    """Reconcile the collection's indexes with the ones declared in INDEXES."""
+    collection = get_collection(settings.mongodb_collection)
+    existing = await collection.index_information()
+    declared = set()
+    
+    for index in INDEXES:
+        spec = index.document
+        name = spec["name"]
+        declared.add(name)
+        
+        current = existing.get(name)
+        if current is not None:
+            if _index_signature(current) == _index_signature(spec):
+                continue
+            logger.info(f"Rebuilding index {name}: definition changed")
+            await collection.drop_index(name)
+        
+        try:
+            await collection.create_indexes([index])
+            logger.info(f"Created index {name}")
+        except OperationFailure as e:
+            logger.error(f"Could not create index {name}: {e}")
+    
+    unknown = set(existing) - declared - {"_id_"}
+    for name in unknown:
+        if settings.drop_unknown_indexes:
+            await collection.drop_index(name)
+            logger.info(f"Dropped undeclared index {name}")
+        else:
+            logger.warning(f"Undeclared index {name} left in place")
+
+def _plan_stages(plan: dict) -> list[str]:
+    """Flatten the stage names of an explain plan tree."""
+    stages = [plan.get("stage", "")]
+    for child in ("inputStage", "queryPlan"):
+        if child in plan:
+            stages.extend(_plan_stages(plan[child]))
+    for child in plan.get("inputStages", []):
+        stages.extend(_plan_stages(child))
+    return stages
+
+async def get_index_report() -> dict:
+    """Report index usage and flag query shapes that Mongo cannot serve from an index."""
+    collection = get_collection(settings.mongodb_collection)
+    
+    indexes = []
+    async for stat in collection.aggregate([{"$indexStats": {}}]):
+        indexes.append({
+            "name": stat["name"],
+            "key": dict(stat["key"]),
+            "ops": int(stat["accesses"]["ops"]),
+            "since": stat["accesses"]["since"],
+        })
+    
+    query_shapes = []
+    for shape in QUERY_SHAPES:
+        cursor = collection.find(shape["filter"]).limit(1)
+        if shape.get("sort"):
+            cursor = cursor.sort(shape["sort"])
+        explain = await cursor.explain()
+        stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+        query_shapes.append({
+            "name": shape["name"],
+            "stages": stages,
+            "collection_scan": "COLLSCAN" in stages,
+            "in_memory_sort": "SORT" in stages,
+        })
+    
+    return {
+        "collection": settings.mongodb_collection,
+        "indexes": indexes,
+        "query_shapes": query_shapes,
+        "unindexed": [shape["name"] for shape in query_shapes if shape["collection_scan"] or shape["in_memory_sort"]],
+    }
@@ -0,0 +1,209 @@
+import threading
+import time
+from bisect import bisect_left
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+
+try:
+    from pymongo import monitoring
+except ImportError:
+    monitoring = None
+
+# Latency bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Cumulative-on-export histogram over fixed, pre-allocated buckets."""
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class Registry:
+    """Counters, gauges and histograms keyed by label values.
+
+    Mongo commands are recorded from the driver's threads while requests are
+    recorded on the event loop, and ``d[k] += v`` is not atomic under the
+    GIL, so updates hold a lock; it is uncontended nearly always and costs
+    far less than the dictionary lookups. ``render`` copies the values
+    under the lock and formats them outside it.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    def inc(self, name: str, labels: tuple, value: float = 1):
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def add(self, name: str, labels: tuple, value: float):
+        with self._lock:
+            series = self.gauges.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram()
+            histogram.observe(value)
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        with self._lock:
+            scalars = [
+                (name, list(series.items()))
+                for kind_metrics in (self.counters, self.gauges)
+                for name, series in kind_metrics.items()
+            ]
+            histograms = [
+                (name, [(labels, histogram.bounds, list(histogram.counts), histogram.sum) for labels, histogram in series.items()])
+                for name, series in self.histograms.items()
+            ]
+
+        lines = []
+        for name, series in scalars:
+            self._header(lines, name)
+            for labels, value in series:
+                lines.append(f"{name}{_labels(labels)} {value}")
+
+        for name, series in histograms:
+            self._header(lines, name)
+            for labels, bounds, counts, total in series:
+                cumulative = 0
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {cumulative}")
+                cumulative += counts[-1]
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {total}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: list, name: str):
+        kind, text = self.help.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+registry = Registry()
+registry.describe("http_requests_total", "counter", "HTTP requests by route and status.")
+registry.describe("http_requests_in_flight", "gauge", "HTTP requests being served.")
+registry.describe("http_request_duration_seconds", "histogram", "HTTP request latency by route.")
+registry.describe("mongodb_commands_total", "counter", "MongoDB commands by command and outcome.")
+registry.describe("mongodb_command_duration_seconds", "histogram", "MongoDB command latency by command.")
+registry.describe("upstream_requests_total", "counter", "Upstream HTTP calls by upstream and status.")
+registry.describe("upstream_request_duration_seconds", "histogram", "Upstream HTTP latency until response headers.")
+
+class InstrumentationMiddleware:
+    """Pure ASGI middleware recording request counts, latencies and in-flight requests per route.
+
+    Requests are labelled with the matched route template rather than the
+    raw path, so ids in URLs do not create new series.
+    """
+
+    def __init__(self, app, service: str):
+        self.app = app
+        self.service = service
+        self._routes = None
+        self._in_flight = (("service", service),)
+
+    def _route_template(self, scope) -> str:
+        if self._routes is None:
+            # Endpoint -> path template, built once the app's routes are final
+            self._routes = {route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")}
+        return self._routes.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        registry.add("http_requests_in_flight", self._in_flight, 1)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            registry.add("http_requests_in_flight", self._in_flight, -1)
+            route = (("service", self.service), ("method", scope["method"]), ("route", self._route_template(scope)))
+            registry.inc("http_requests_total", route + (("status", status),))
+            registry.observe("http_request_duration_seconds", route, elapsed)
+
+if monitoring is not None:
+    class MongoCommandListener(monitoring.CommandListener):
+        """Records the duration and outcome of every MongoDB command."""
+
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            self._record(event, "success")
+
+        def failed(self, event):
+            self._record(event, "failure")
+
+        def _record(self, event, outcome: str):
+            labels = (("command", event.command_name),)
+            registry.inc("mongodb_commands_total", labels + (("outcome", outcome),))
+            registry.observe("mongodb_command_duration_seconds", labels, event.duration_micros / 1e6)
+
+    mongo_listener = MongoCommandListener()
+else:
+    mongo_listener = None
+
+def upstream_hooks(upstream: str) -> dict:
+    """httpx event hooks timing calls to an upstream until its response headers arrive."""
+
+    async def on_request(request):
+        request.extensions["instrumentation_start"] = time.perf_counter()
+
+    async def on_response(response):
+        start = response.request.extensions.get("instrumentation_start")
+        if start is None:
+            return
+        labels = (("upstream", upstream), ("method", response.request.method))
+        registry.inc("upstream_requests_total", labels + (("status", response.status_code),))
+        registry.observe("upstream_request_duration_seconds", labels, time.perf_counter() - start)
+
+    return {"request": [on_request], "response": [on_response]}
+
+def instrument(app: FastAPI, service: str):
+    """Add the instrumentation middleware and the /metrics/prometheus endpoint to an app."""
+    app.add_middleware(InstrumentationMiddleware, service=service)
+
+    @app.get("/metrics/prometheus", include_in_schema=False)
+    async def prometheus_metrics():
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -1,13 +1,23 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import asyncio
+import hmac
 import logging
+import mimetypes
 import os
+import re
 from typing import List, Optional
 
 from config import settings
-from models import Media, MediaList
+from instrumentation import instrument
+from database import connect_to_mongo, close_mongo_connection, get_collection, get_index_report
+from pagination import apply_cursor, sort_spec, next_cursor, count_cache
+from models import Media, MediaList, ReconcileResult
 from minio_client import minio_client
 
 # Configure logging
@@ -25,8 +35,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory storage for media metadata (in production, use a database)
-media_storage = {}
+instrument(app, "medias")
+
+@app.on_event("startup")
+async def startup_storage():
+    await connect_to_mongo()
+    await minio_client.initialize()
+
+@app.on_event("shutdown")
+async def shutdown_storage():
+    minio_client.close()
+    await close_mongo_connection()
+
+async def to_media(media_data: dict) -> Media:
+    """Build the API model from a metadata document, with a fresh presigned URL."""
+    media_data["id"] = media_data["_id"]
+    media_data["url"] = await minio_client.get_file_url(media_data["object_name"])
+    return Media(**media_data)
+
+async def find_media(media_id: str) -> dict:
+    """Get a metadata document by ID or raise 404."""
+    media_data = await get_collection(settings.mongodb_collection).find_one({"_id": media_id})
+    if not media_data:
+        raise HTTPException(status_code=404, detail="File not found")
+    return media_data
 
 @app.post("/upload", response_model=Media)
 async def upload_file(
@@ -35,8 +67,10 @@ async def upload_file(
 ):
     """Upload a file to MinIO."""
     try:
-        # Read file content
-        file_content = await file.read()
+        # The upload is spooled to a temporary file; stream it from there
+        file.file.seek(0, os.SEEK_END)
+        size = file.file.tell()
+        file.file.seek(0)
         
         # Generate unique filename
         timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
@@ -44,7 +78,8 @@ async def upload_file(
         
         # Upload to MinIO
         object_name = await minio_client.upload_file(
-            file_content,
+            file.file,
+            size,
             filename,
             folder,
             file.content_type
@@ -53,20 +88,21 @@ async def upload_file(
         # Store metadata
         media_id = f"{folder}_{timestamp}_{file.filename}"
         media_data = {
-            "id": media_id,
+            "_id": media_id,
             "filename": filename,
             "folder": folder,
             "content_type": file.content_type,
-            "size": len(file_content),
-            "url": minio_client.get_file_url(object_name),
+            "size": size,
             "object_name": object_name,
             "created_at": datetime.utcnow(),
             "updated_at": datetime.utcnow()
         }
         
-        media_storage[media_id] = media_data
+        collection = get_collection(settings.mongodb_collection)
+        await collection.replace_one({"_id": media_id}, media_data, upsert=True)
+        count_cache.clear()
         
-        return Media(**media_data)
+        return await to_media(media_data)
         
     except Exception as e:
         logger.error(f"Error uploading file: {e}")
@@ -75,64 +111,193 @@ async def upload_file(
 @app.get("/files", response_model=MediaList)
 async def list_files(
     folder: Optional[str] = Query(None, description="Filter by folder"),
+    content_type: Optional[str] = Query(None, description="Filter by content type prefix, e.g. image/"),
     skip: int = Query(0, ge=0),
-    limit: int = Query(100, ge=1, le=1000)
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from a previous page's next_cursor; replaces skip"),
+    with_total: bool = Query(True, description="Include the (briefly cached) total count")
 ):
-    """List uploaded files."""
+    """List uploaded files, newest first."""
     try:
-        filtered_medias = []
+        collection = get_collection(settings.mongodb_collection)
+        
+        # Build filter
+        filter_query = {}
+        if folder is not None:
+            filter_query["folder"] = folder
+        if content_type:
+            filter_query["content_type"] = {"$regex": f"^{re.escape(content_type)}"}
         
-        for media_id, media_data in media_storage.items():
-            if folder is None or media_data["folder"] == folder:
-                filtered_medias.append(media_data)
+        # Get total count (optional, briefly cached)
+        total = await count_cache.count(collection, filter_query) if with_total else None
         
-        # Apply pagination
-        total = len(filtered_medias)
-        paginated_medias = filtered_medias[skip:skip + limit]
+        # Get files with keyset pagination when a cursor is given, offset pagination otherwise
+        page_query = apply_cursor(filter_query, "created_at", -1, cursor)
+        db_cursor = collection.find(page_query).sort(sort_spec("created_at", -1)).limit(limit)
+        if not cursor:
+            db_cursor = db_cursor.skip(skip)
+        medias = await db_cursor.to_list(length=limit)
         
+        page_cursor = next_cursor(medias, "created_at", limit)
         return MediaList(
-            medias=[Media(**media) for media in paginated_medias],
-            total=total
+            medias=await asyncio.gather(*[to_media(media) for media in medias]),
+            total=total,
+            next_cursor=page_cursor
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error listing files: {e}")
         raise HTTPException(status_code=500, detail=f"Error listing files: {str(e)}")
 
+@app.post("/files/reconcile", response_model=ReconcileResult)
+async def reconcile_files(
+    folder: Optional[str] = Query(None, description="Only reconcile this folder"),
+    prune: bool = Query(False, description="Delete metadata of objects missing from the bucket")
+):
+    """Rebuild file metadata from the objects actually stored in MinIO."""
+    try:
+        collection = get_collection(settings.mongodb_collection)
+        started_at = datetime.utcnow()
+        scanned = 0
+        inserted = 0
+        
+        async for batch in minio_client.iter_objects(folder, settings.reconcile_batch_size):
+            operations = []
+            for obj in batch:
+                object_folder, _, filename = obj.object_name.rpartition("/")
+                object_folder = object_folder or "general"
+                content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                created_at = obj.last_modified.replace(tzinfo=None) if obj.last_modified else started_at
+                operations.append(UpdateOne(
+                    {"object_name": obj.object_name},
+                    {
+                        "$setOnInsert": {
+                            "_id": f"{object_folder}_{filename}",
+                            "filename": filename,
+                            "folder": object_folder,
+                            "content_type": content_type,
+                            "created_at": created_at,
+                        },
+                        "$set": {"size": obj.size, "updated_at": started_at, "reconciled_at": started_at},
+                    },
+                    upsert=True
+                ))
+            if operations:
+                try:
+                    result = await collection.bulk_write(operations, ordered=False)
+                    inserted += result.upserted_count
+                except BulkWriteError as e:
+                    # e.g. an id already used by another object; the rest of the batch is applied
+                    inserted += e.details.get("nUpserted", 0)
+                    logger.warning(f"Reconcile skipped {len(e.details.get('writeErrors', []))} objects")
+            scanned += len(batch)
+        
+        pruned = 0
+        if prune:
+            prune_filter = {"$or": [{"reconciled_at": {"$lt": started_at}}, {"reconciled_at": {"$exists": False}}]}
+            if folder is not None:
+                prune_filter = {"$and": [{"folder": folder}, prune_filter]}
+            result = await collection.delete_many(prune_filter)
+            pruned = result.deleted_count
+        
+        count_cache.clear()
+        return ReconcileResult(scanned=scanned, inserted=inserted, pruned=pruned)
+        
+    except Exception as e:
+        logger.error(f"Error reconciling files: {e}")
+        raise HTTPException(status_code=500, detail=f"Error reconciling files: {str(e)}")
+
 @app.get("/files/{media_id}", response_model=Media)
 async def get_file(media_id: str):
     """Get file information by ID."""
-    if media_id not in media_storage:
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    media_data = media_storage[media_id]
-    return Media(**media_data)
+    media_data = await find_media(media_id)
+    return await to_media(media_data)
 
 @app.get("/files/{media_id}/download")
 async def download_file(media_id: str):
     """Download a file by ID."""
-    if media_id not in media_storage:
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    media_data = media_storage[media_id]
-    download_url = minio_client.get_file_url(media_data["object_name"])
+    media_data = await find_media(media_id)
+    download_url = await minio_client.get_file_url(media_data["object_name"])
     
     return RedirectResponse(url=download_url)
 
+def _parse_range(range_header: str, size: int) -> Optional[tuple[int, int]]:
+    """Parse a single ``bytes=start-end`` range into inclusive offsets, or None if absent."""
+    if not range_header:
+        return None
+    try:
+        unit, _, spec = range_header.partition("=")
+        if unit.strip() != "bytes" or "," in spec:
+            raise ValueError
+        start, _, end = spec.strip().partition("-")
+        if start:
+            first = int(start)
+            last = int(end) if end else size - 1
+        else:
+            # Suffix range: the last N bytes
+            first = max(0, size - int(end))
+            last = size - 1
+        last = min(last, size - 1)
+        if first > last:
+            raise ValueError
+        return first, last
+    except ValueError:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+
+@app.get("/files/{media_id}/content")
+async def stream_file(media_id: str, range: Optional[str] = Header(None)):
+    """Stream a file's content through the service, honouring a Range header."""
+    media_data = await find_media(media_id)
+    size = media_data["size"]
+    byte_range = _parse_range(range, size)
+    
+    headers = {"Accept-Ranges": "bytes"}
+    if byte_range:
+        first, last = byte_range
+        length = last - first + 1
+        status_code = 206
+        headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    else:
+        first, length = 0, size
+        status_code = 200
+    headers["Content-Length"] = str(length)
+    
+    try:
+        response = await minio_client.open_file(media_data["object_name"], offset=first, length=length if byte_range else 0)
+    except Exception as e:
+        logger.error(f"Error streaming file: {e}")
+        raise HTTPException(status_code=500, detail=f"Error streaming file: {str(e)}")
+    
+    def close():
+        response.close()
+        response.release_conn()
+    
+    return StreamingResponse(
+        response.stream(settings.stream_chunk_size),
+        status_code=status_code,
+        media_type=media_data["content_type"],
+        headers=headers,
+        background=BackgroundTask(close)
+    )
+
 @app.delete("/files/{media_id}")
 async def delete_file(media_id: str):
     """Delete a file by ID."""
-    if media_id not in media_storage:
-        raise HTTPException(status_code=404, detail="File not found")
+    media_data = await find_media(media_id)
     
     try:
-        media_data = media_storage[media_id]
-        
         # Delete from MinIO
         await minio_client.delete_file(media_data["object_name"])
         
-        # Remove from storage
-        del media_storage[media_id]
+        # Remove metadata
+        await get_collection(settings.mongodb_collection).delete_one({"_id": media_id})
+        count_cache.clear()
         
         return {"message": "File deleted successfully"}
         
@@ -143,11 +308,24 @@ async def delete_file(media_id: str):
 @app.get("/folders")
 async def list_folders():
     """List all folders."""
-    folders = set()
-    for media_data in media_storage.values():
-        folders.add(media_data["folder"])
+    # Served from the folder index
+    folders = await get_collection(settings.mongodb_collection).distinct("folder")
     
-    return {"folders": list(folders)}
+    return {"folders": folders}
+
+def require_admin_token(x_admin_token: Optional[str] = Header(None)):
+    """Only let internal callers presenting the configured admin token through."""
+    if not settings.admin_token or not x_admin_token or not hmac.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+
+@app.get("/admin/indexes", dependencies=[Depends(require_admin_token)])
+async def index_report():
+    """Report index usage and query shapes that are not served by an index (internal callers only)."""
+    try:
+        return await get_index_report()
+    except Exception as e:
+        logger.error(f"Error getting index report: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting index report: {str(e)}")
 
 @app.get("/health")
 async def health_check():
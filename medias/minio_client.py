@@ -1,81 +1,153 @@
 from minio import Minio
 from minio.error import S3Error
+import asyncio
 import logging
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+from itertools import islice
 from config import settings
-from io import BytesIO
+from typing import BinaryIO, Optional
 
 logger = logging.getLogger(__name__)
 
 class MinioClient:
+    """Async facade over the blocking MinIO SDK.
+
+    Every SDK call runs on a bounded thread pool so transfers never block the
+    event loop; the pool size is also the number of concurrent S3 requests.
+    """
+
     def __init__(self):
+        # No network I/O here: the bucket is checked in initialize() at startup
         self.client = Minio(
             f"{settings.minio_host}:{settings.minio_port}",
             access_key=settings.minio_access_key,
             secret_key=settings.minio_secret_key,
-            secure=settings.minio_secure
+            secure=settings.minio_secure,
+            http_client=urllib3.PoolManager(
+                maxsize=settings.minio_max_workers,
+                timeout=urllib3.Timeout(connect=settings.minio_connect_timeout, read=settings.minio_read_timeout),
+                retries=urllib3.Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+            )
         )
         self.bucket_name = settings.minio_bucket
-        self._ensure_bucket_exists()
-    
-    def _ensure_bucket_exists(self):
-        """Ensure the bucket exists, create if it doesn't."""
-        try:
-            if not self.client.bucket_exists(self.bucket_name):
-                self.client.make_bucket(self.bucket_name)
-                logger.info(f"Created bucket: {self.bucket_name}")
-        except S3Error as e:
-            logger.error(f"Error ensuring bucket exists: {e}")
-            raise e
-    
-    async def upload_file(self, file_data: bytes, filename: str, folder: str, content_type: str):
-        """Upload a file to MinIO."""
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=settings.minio_max_workers, thread_name_prefix="minio")
+        return self._executor
+
+    async def _run(self, func, *args, **kwargs):
+        """Run a blocking SDK call on the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), partial(func, *args, **kwargs))
+
+    async def initialize(self):
+        """Ensure the bucket exists, create if it doesn't, retrying while MinIO starts up."""
+        delay = settings.minio_init_backoff
+        for attempt in range(1, settings.minio_init_retries + 1):
+            try:
+                if not await self._run(self.client.bucket_exists, self.bucket_name):
+                    await self._run(self.client.make_bucket, self.bucket_name)
+                    logger.info(f"Created bucket: {self.bucket_name}")
+                return
+            except Exception as e:
+                if attempt == settings.minio_init_retries:
+                    logger.error(f"Error ensuring bucket exists: {e}")
+                    raise e
+                logger.warning(f"MinIO not ready (attempt {attempt}): {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    def close(self):
+        """Shut down the executor."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def upload_file(self, file_stream: BinaryIO, length: int, filename: str, folder: str, content_type: str):
+        """Upload a file-like object to MinIO, streaming it in multipart chunks."""
         try:
             object_name = f"{folder}/{filename}"
-            
-            # Convert bytes to file-like object
-            file_stream = BytesIO(file_data)
-            
-            self.client.put_object(
+
+            await self._run(
+                self.client.put_object,
                 self.bucket_name,
                 object_name,
                 file_stream,
-                length=len(file_data),
-                content_type=content_type
+                length=length,
+                content_type=content_type,
+                part_size=settings.minio_part_size
             )
             return object_name
         except S3Error as e:
             logger.error(f"Error uploading file: {e}")
             raise e
-    
+
+    async def open_file(self, object_name: str, offset: int = 0, length: int = 0):
+        """Open a streaming response for an object, optionally for a byte range only."""
+        try:
+            return await self._run(self.client.get_object, self.bucket_name, object_name, offset=offset, length=length)
+        except S3Error as e:
+            logger.error(f"Error opening file: {e}")
+            raise e
+
     async def delete_file(self, object_name: str):
         """Delete a file from MinIO."""
         try:
-            self.client.remove_object(self.bucket_name, object_name)
+            await self._run(self.client.remove_object, self.bucket_name, object_name)
             return True
         except S3Error as e:
             logger.error(f"Error deleting file: {e}")
             raise e
-    
-    def get_file_url(self, object_name: str, expires: int = 3600):
+
+    async def get_file_url(self, object_name: str, expires: int = 3600):
         """Get a presigned URL for a file."""
         try:
-            return self.client.presigned_get_object(
+            # Signing may look up the bucket region over the network
+            return await self._run(
+                self.client.presigned_get_object,
                 self.bucket_name,
                 object_name,
-                expires=expires
+                expires=timedelta(seconds=expires)
             )
         except S3Error as e:
             logger.error(f"Error getting file URL: {e}")
             raise e
-    
+
     async def list_files(self, folder: str = None):
         """List files in a folder."""
         try:
             prefix = f"{folder}/" if folder else ""
-            objects = self.client.list_objects(self.bucket_name, prefix=prefix, recursive=True)
-            return [obj.object_name for obj in objects]
+
+            def list_names():
+                objects = self.client.list_objects(self.bucket_name, prefix=prefix, recursive=True)
+                return [obj.object_name for obj in objects]
+
+            return await self._run(list_names)
         except S3Error as e:
             logger.error(f"Error listing files: {e}")
             raise e
 
-minio_client = MinioClient() 
\ No newline at end of file
+    async def iter_objects(self, folder: str = None, batch_size: int = 1000):
+        """Yield batches of bucket objects (name, size, last_modified) without loading the whole listing."""
+        prefix = f"{folder}/" if folder else ""
+        objects = self.client.list_objects(self.bucket_name, prefix=prefix, recursive=True)
+
+        def next_batch():
+            return list(islice(objects, batch_size))
+
+        while True:
+            try:
+                batch = await self._run(next_batch)
+            except S3Error as e:
+                logger.error(f"Error listing files: {e}")
+                raise e
+            if not batch:
+                return
+            yield batch
+
+minio_client = MinioClient()
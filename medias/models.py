@@ -19,4 +19,10 @@ class Media(MediaBase):
 
 class MediaList(BaseModel):
     medias: list[Media]
-    total: int 
\ No newline at end of file
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
+
+class ReconcileResult(BaseModel):
+    scanned: int
+    inserted: int
+    pruned: int 
\ No newline at end of file
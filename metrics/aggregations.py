@@ -0,0 +1,54 @@
+import asyncio
+
+from database import get_collection
+
+USER_STATUSES = ["active", "inactive", "pending"]
+
+async def group_counts(service: str, field: str) -> dict:
+    """Count a collection's documents per value of ``field`` in a single $group pass."""
+    pipeline = [{"$group": {"_id": f"${field}", "count": {"$sum": 1}}}]
+    counts = {}
+    async for group in get_collection(service).aggregate(pipeline):
+        counts[group["_id"]] = group["count"]
+    return counts
+
+async def total_count(service: str) -> int:
+    """Count a collection's documents with a single $count pass."""
+    async for result in get_collection(service).aggregate([{"$count": "total"}]):
+        return result["total"]
+    return 0
+
+def format_user_counts(groups: dict) -> dict:
+    """Users per status, plus the total, from {status: count}."""
+    user_counts = {status: groups.get(status, 0) for status in USER_STATUSES}
+    user_counts["total"] = sum(groups.values())
+    return user_counts
+
+def format_ad_counts(groups: dict) -> dict:
+    """Ads per activity flag, plus the total, from {is_active: count}."""
+    return {
+        "active": groups.get(True, 0),
+        "inactive": groups.get(False, 0),
+        "total": sum(groups.values()),
+    }
+
+def format_metrics(users: dict, posts: int, ads: dict, events: int, polls: int) -> dict:
+    """Build the /metrics response from per-collection counts."""
+    return {
+        "users": format_user_counts(users),
+        "posts": {"total": posts},
+        "ads": format_ad_counts(ads),
+        "events": {"total": events},
+        "polls": {"total": polls}
+    }
+
+async def compute_metrics() -> dict:
+    """Compute every metric with one aggregation per collection, run concurrently."""
+    users, posts, ads, events, polls = await asyncio.gather(
+        group_counts('users', "status"),
+        total_count('posts'),
+        group_counts('ads', "is_active"),
+        total_count('events'),
+        total_count('polls'),
+    )
+    return format_metrics(users, posts, ads, events, polls)
@@ -0,0 +1,38 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+class CachedValue:
+    """A value recomputed at most once per ``ttl`` seconds.
+
+    Concurrent callers during a recomputation share the same in-flight load
+    instead of each running the loader.
+    """
+
+    def __init__(self, ttl: float, loader: Callable[[], Awaitable[Any]]):
+        self.ttl = ttl
+        self.loader = loader
+        self._value: Any = None
+        self._expires_at = 0.0
+        self._load: Optional[asyncio.Task] = None
+
+    async def get(self) -> Any:
+        """Get the cached value, loading it if it expired."""
+        if time.monotonic() < self._expires_at:
+            return self._value
+        if self._load is None:
+            self._load = asyncio.create_task(self._refresh())
+        return await asyncio.shield(self._load)
+
+    def invalidate(self):
+        """Force the next get() to reload."""
+        self._expires_at = 0.0
+
+    async def _refresh(self) -> Any:
+        try:
+            value = await self.loader()
+            self._value = value
+            self._expires_at = time.monotonic() + self.ttl
+            return value
+        finally:
+            self._load = None
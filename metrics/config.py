@@ -6,6 +6,9 @@ class Settings(BaseSettings):
     mongodb_database: str = "blog_metrics"
     mongodb_username: str = "admin"
     mongodb_password: str = "password"
+    # MongoDB runs as a replica set (change streams, transactions); with its name the client
+    # discovers the members, without it the configured host is connected to directly
+    mongodb_replica_set: str = ""
     # Collections for each microservice
     users_collection: str = "users"
     posts_collection: str = "posts"
@@ -19,6 +22,25 @@ class Settings(BaseSettings):
     events_db: str = "blog_events"
     polls_db: str = "blog_polls"
     
+    # Seconds a computed /metrics response is reused
+    metrics_cache_ttl: float = 5.0
+    
+    # Counters maintained from change streams (needs a replica set)
+    change_streams_enabled: bool = True
+    counters_collection: str = "counters"
+    # Seconds between persisting counters and resume tokens
+    counters_persist_interval: float = 5.0
+    counters_retry_interval: float = 5.0
+    
+    # Time series rollups
+    series_collection_prefix: str = "series_"
+    # Seconds minute and hour buckets are kept; day buckets are kept forever
+    series_minute_retention: int = 7 * 86400
+    series_hour_retention: int = 90 * 86400
+    series_flush_interval: float = 5.0
+    series_snapshot_interval: float = 60.0
+    series_max_points: int = 2000
+    
     class Config:
         env_file = ".env"
 
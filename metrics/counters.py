@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Callable, Optional
+
+from pymongo.errors import OperationFailure
+
+from config import settings
+from database import get_collection, get_service_database, get_metrics_collection
+from aggregations import group_counts, total_count, format_metrics
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ("users", "posts", "ads", "events", "polls")
+
+# Collections whose counts are split by a field; the others only keep a total
+GROUP_FIELDS = {"users": "status", "ads": "is_active"}
+
+# Server error codes
+CHANGE_STREAM_FATAL = 280
+CHANGE_STREAM_HISTORY_LOST = 286
+NOT_A_REPLICA_SET = 40573
+
+class Resync(Exception):
+    """The counters of a collection can no longer be maintained incrementally."""
+
+class PreImagesUnavailable(Exception):
+    """The change stream does not carry the pre-images grouped counters need."""
+
+class CounterStore:
+    """Collection counters maintained incrementally from change streams.
+
+    Each collection is recounted once, then followed through its change
+    stream. Counts and the stream's resume token are persisted together, so
+    a restart resumes where it stopped; a full recount only happens when the
+    token is missing or the oplog no longer holds it.
+
+    When ``checkpointed``, the state is not persisted periodically: the
+    series store saves it (``checkpoint``/``save``) in the transaction that
+    stores the changes it recorded, so a restart replays exactly those not
+    stored yet.
+
+    Grouped counters need pre-images to tell which group a deleted or
+    changed document left. Without them (before Mongo 6, or when collMod is
+    not permitted) every such change would force a recount, so the store
+    gives up on the first one and /metrics stays on the aggregations.
+    """
+
+    def __init__(self):
+        self.counts = {service: {} for service in SERVICES}
+        self.ready = set()
+        self.disabled = False
+        self.unsupported = set()
+        self._tokens = {}
+        self._saved_tokens = {}
+        self._persisted_at = {}
+        self.checkpointed = False
+        self._tasks = []
+        self._listeners = []
+        self._pre_images = set(GROUP_FIELDS)
+
+    def add_listener(self, listener: Callable[[str, dict], None], pre_images: tuple = ()):
+        """Call ``listener(service, change)`` for every change applied.
+
+        ``pre_images`` names the services whose changes the listener needs
+        the previous version of the document for.
+        """
+        self._listeners.append(listener)
+        self._pre_images.update(pre_images)
+
+    def start(self):
+        """Start following every collection."""
+        self._tasks = [asyncio.create_task(self._follow(service)) for service in SERVICES]
+
+    async def stop(self):
+        """Stop following and persist the current state, unless the series store checkpoints it."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if not self.checkpointed:
+            for service in list(self.ready):
+                try:
+                    await self._persist(service)
+                except Exception as e:
+                    logger.error(f"Error persisting {service} counters: {e}")
+        self.ready.clear()
+
+    def snapshot(self) -> Optional[dict]:
+        """Get the /metrics response from the counters, or None until every collection is followed."""
+        if self.unsupported or len(self.ready) < len(SERVICES):
+            return None
+        return format_metrics(
+            self.counts["users"],
+            self.counts["posts"].get(None, 0),
+            self.counts["ads"],
+            self.counts["events"].get(None, 0),
+            self.counts["polls"].get(None, 0),
+        )
+
+    async def resync(self, service: str):
+        """Drop the persisted state of a collection so it is recounted."""
+        self._tokens.pop(service, None)
+        await get_metrics_collection(settings.counters_collection).update_one(
+            {"_id": service}, {"$unset": {"resume_token": ""}}
+        )
+
+    async def _follow(self, service: str):
+        pre_images = service in self._pre_images
+        while not self.disabled and service not in self.unsupported:
+            try:
+                # After an error, resume after the last change applied rather than the last one
+                # persisted, so listeners do not see a change twice
+                resume_token = self._tokens.get(service)
+                if resume_token is None:
+                    state = await get_metrics_collection(settings.counters_collection).find_one({"_id": service})
+                    resume_token = state.get("resume_token") if state else None
+                    if resume_token is not None:
+                        self.counts[service] = {group["value"]: group["count"] for group in state["groups"]}
+                        self._tokens[service] = self._saved_tokens[service] = resume_token
+                if pre_images and not await self._enable_pre_images(service) and service in GROUP_FIELDS:
+                    raise PreImagesUnavailable("could not enable pre-images")
+
+                async with get_collection(service).watch(
+                    full_document="updateLookup",
+                    full_document_before_change="whenAvailable" if pre_images else None,
+                    resume_after=resume_token,
+                ) as stream:
+                    if resume_token is None:
+                        # Recount once the stream is open so no change is missed
+                        self.counts[service] = await self._recount(service)
+                        self._tokens[service] = stream.resume_token
+                        await self._persist(service)
+                    self.ready.add(service)
+                    logger.info(f"Following {service} changes")
+
+                    async for change in stream:
+                        self._apply(service, change)
+                        self._tokens[service] = stream.resume_token
+                        if (not self.checkpointed
+                                and time.monotonic() - self._persisted_at.get(service, 0) > settings.counters_persist_interval):
+                            await self._persist(service)
+
+            except asyncio.CancelledError:
+                raise
+            except PreImagesUnavailable as e:
+                logger.warning(f"Not following {service} changes ({e}); serving metrics from aggregations")
+                self.ready.discard(service)
+                self.unsupported.add(service)
+                return
+            except Resync as e:
+                logger.warning(f"Recounting {service}: {e}")
+                self.ready.discard(service)
+                await self.resync(service)
+            except OperationFailure as e:
+                self.ready.discard(service)
+                if e.code == NOT_A_REPLICA_SET:
+                    logger.warning("Change streams need a replica set; serving metrics from aggregations")
+                    self.disabled = True
+                    return
+                if e.code in (CHANGE_STREAM_HISTORY_LOST, CHANGE_STREAM_FATAL):
+                    logger.warning(f"Resume token for {service} lost; recounting")
+                    await self.resync(service)
+                    continue
+                logger.error(f"Error following {service} changes: {e}")
+                await asyncio.sleep(settings.counters_retry_interval)
+            except Exception as e:
+                self.ready.discard(service)
+                logger.error(f"Error following {service} changes: {e}")
+                await asyncio.sleep(settings.counters_retry_interval)
+
+    async def _enable_pre_images(self, service: str) -> bool:
+        # Pre-images tell which group an updated or deleted document left, and what a counter was
+        try:
+            await get_service_database(service).command(
+                "collMod", get_collection(service).name,
+                changeStreamPreAndPostImages={"enabled": True}
+            )
+            return True
+        except OperationFailure as e:
+            logger.warning(f"Could not enable pre-images on {service}: {e}")
+            return False
+
+    async def _recount(self, service: str) -> dict:
+        field = GROUP_FIELDS.get(service)
+        if field:
+            return await group_counts(service, field)
+        return {None: await total_count(service)}
+
+    def _apply(self, service: str, change: dict):
+        operation = change["operationType"]
+        field = GROUP_FIELDS.get(service)
+
+        if operation == "insert":
+            self._increment(service, change["fullDocument"], 1)
+        elif operation == "delete":
+            self._increment(service, self._before(service, change), -1)
+        elif operation in ("update", "replace") and field is not None:
+            # Only a change of the grouped field moves a document between groups
+            description = change.get("updateDescription")
+            if (description is None or field in description.get("updatedFields", {})
+                    or field in description.get("removedFields", [])):
+                self._increment(service, self._before(service, change), -1)
+                if change.get("fullDocument") is not None:
+                    self._increment(service, change["fullDocument"], 1)
+        elif operation in ("drop", "rename", "dropDatabase", "invalidate"):
+            raise Resync(f"collection {operation}")
+
+        for listener in self._listeners:
+            try:
+                listener(service, change)
+            except Exception as e:
+                logger.error(f"Error in change listener: {e}")
+
+    def _before(self, service: str, change: dict) -> Optional[dict]:
+        if GROUP_FIELDS.get(service) is None:
+            return {}
+        before = change.get("fullDocumentBeforeChange")
+        if before is None:
+            raise PreImagesUnavailable("pre-image missing from a change")
+        return before
+
+    def _increment(self, service: str, document: dict, delta: int):
+        field = GROUP_FIELDS.get(service)
+        group = document.get(field) if field else None
+        counts = self.counts[service]
+        counts[group] = counts.get(group, 0) + delta
+
+    def checkpoint(self, services: tuple = SERVICES) -> dict:
+        """Capture the counts and resume tokens that changed since they were saved."""
+        return {
+            service: (self._tokens[service], [{"value": value, "count": count} for value, count in self.counts[service].items()])
+            for service in services
+            if service in self._tokens and self._tokens[service] != self._saved_tokens.get(service)
+        }
+
+    async def save(self, checkpoint: dict, session=None):
+        """Write a checkpoint, within ``session``'s transaction if given; call ``saved`` once it is durable."""
+        for service, (token, groups) in checkpoint.items():
+            await get_metrics_collection(settings.counters_collection).update_one(
+                {"_id": service},
+                {"$set": {"groups": groups, "resume_token": token, "updated_at": datetime.utcnow()}},
+                upsert=True,
+                session=session
+            )
+
+    def saved(self, checkpoint: dict):
+        """Note that a checkpoint was written."""
+        for service, (token, _) in checkpoint.items():
+            self._saved_tokens[service] = token
+            self._persisted_at[service] = time.monotonic()
+
+    async def _persist(self, service: str):
+        checkpoint = self.checkpoint((service,))
+        await self.save(checkpoint)
+        self.saved(checkpoint)
+
+counter_store = CounterStore()
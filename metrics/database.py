@@ -1,5 +1,6 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from config import settings
+from instrumentation import mongo_listener
 import logging
 
 logger = logging.getLogger(__name__)
@@ -7,13 +8,15 @@ logger = logging.getLogger(__name__)
 class Database:
     client: AsyncIOMotorClient = None
     dbs = {}
+    metrics_db = None
 
 db = Database()
 
 async def connect_to_mongo():
     try:
-        connection_string = f"mongodb://{settings.mongodb_username}:{settings.mongodb_password}@{settings.mongodb_host}:{settings.mongodb_port}"
-        db.client = AsyncIOMotorClient(connection_string)
+        options = f"replicaSet={settings.mongodb_replica_set}" if settings.mongodb_replica_set else "directConnection=true"
+        connection_string = f"mongodb://{settings.mongodb_username}:{settings.mongodb_password}@{settings.mongodb_host}:{settings.mongodb_port}/?{options}"
+        db.client = AsyncIOMotorClient(connection_string, event_listeners=[mongo_listener])
         # Connect to all relevant databases
         db.dbs = {
             'users': db.client[settings.users_db],
@@ -22,6 +25,8 @@ async def connect_to_mongo():
             'events': db.client[settings.events_db],
             'polls': db.client[settings.polls_db],
         }
+        # The metrics service's own database, for the state it persists
+        db.metrics_db = db.client[settings.mongodb_database]
         logger.info("Connected to MongoDB for metrics.")
     except Exception as e:
         logger.error(f"Could not connect to MongoDB: {e}")
@@ -41,4 +46,16 @@ def get_collection(service: str):
         'events': settings.events_collection,
         'polls': settings.polls_collection,
     }
-    return db.dbs[service][collections[service]] 
\ No newline at end of file
+    return db.dbs[service][collections[service]]
+
+def get_client():
+    """Get the Mongo client, e.g. to start a session."""
+    return db.client
+
+def get_service_database(service: str):
+    """Get the database of a microservice."""
+    return db.dbs[service]
+
+def get_metrics_collection(collection_name: str):
+    """Get a collection from the metrics service's own database."""
+    return db.metrics_db[collection_name]
@@ -1,7 +1,15 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 import logging
-from database import connect_to_mongo, close_mongo_connection, get_collection
+from datetime import datetime
+from config import settings
+from instrumentation import instrument
+from database import connect_to_mongo, close_mongo_connection
+from aggregations import compute_metrics
+from cache import CachedValue
+from counters import counter_store, SERVICES
+from series import series_store, choose_rollup, AGGREGATES
+from models import MetricSamples, Series
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -16,57 +24,85 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+instrument(app, "metrics")
+
+metrics_cache = CachedValue(settings.metrics_cache_ttl, compute_metrics)
+
 @app.on_event("startup")
 async def startup_db_client():
     await connect_to_mongo()
+    await series_store.ensure_indexes()
+    series_store.follow(counter_store)
+    if settings.change_streams_enabled:
+        counter_store.start()
+    series_store.start(current_metrics)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Stop following first, so the final series flush saves the last resume tokens
+    await counter_store.stop()
+    await series_store.stop()
     await close_mongo_connection()
 
+async def current_metrics() -> dict:
+    """Get the current counts, from the change stream counters when they are available."""
+    snapshot = counter_store.snapshot()
+    if snapshot is not None:
+        return snapshot
+    return await metrics_cache.get()
+
 @app.get("/metrics")
 async def get_metrics():
     """Return counts for users, posts, ads, events, and polls."""
     try:
-        # Users by status
-        users_col = get_collection('users')
-        user_statuses = ["active", "inactive", "pending"]
-        user_counts = {}
-        for status in user_statuses:
-            user_counts[status] = await users_col.count_documents({"status": status})
-        total_users = await users_col.count_documents({})
-        user_counts["total"] = total_users
-
-        # Posts
-        posts_col = get_collection('posts')
-        total_posts = await posts_col.count_documents({})
+        return await current_metrics()
+    except Exception as e:
+        logger.error(f"Error getting metrics: {e}")
+        return {"error": str(e)}
 
-        # Ads by status
-        ads_col = get_collection('ads')
-        ad_statuses = [True, False]
-        ad_counts = {"active": 0, "inactive": 0}
-        ad_counts["active"] = await ads_col.count_documents({"is_active": True})
-        ad_counts["inactive"] = await ads_col.count_documents({"is_active": False})
-        ad_counts["total"] = await ads_col.count_documents({})
+@app.post("/metrics/recount")
+async def recount_metrics():
+    """Recount every collection from scratch; counters restart from the new totals."""
+    await counter_store.stop()
+    for service in SERVICES:
+        await counter_store.resync(service)
+    counter_store.counts = {service: {} for service in SERVICES}
+    # Counts cached before the recount must not be served until they expire
+    metrics_cache.invalidate()
+    if settings.change_streams_enabled:
+        counter_store.start()
+    return {"message": "Recount started"}
 
-        # Events
-        events_col = get_collection('events')
-        total_events = await events_col.count_documents({})
+@app.post("/metrics/record")
+async def record_metrics(request: MetricSamples):
+    """Record samples (increments or gauge readings) into the time series."""
+    for sample in request.samples:
+        series_store.record(sample.metric, sample.value, sample.timestamp)
+    return {"recorded": len(request.samples)}
 
-        # Polls
-        polls_col = get_collection('polls')
-        total_polls = await polls_col.count_documents({})
+@app.get("/metrics/series", response_model=Series)
+async def get_series(
+    metric: str,
+    start: datetime = Query(..., alias="from"),
+    end: datetime = Query(..., alias="to"),
+    step: int = Query(3600, ge=60),
+    aggregate: str = Query("sum")
+):
+    """Get a metric over a time range, one point per ``step`` seconds."""
+    if aggregate not in AGGREGATES:
+        raise HTTPException(status_code=400, detail=f"aggregate must be one of {', '.join(AGGREGATES)}")
+    if choose_rollup(step) is None:
+        raise HTTPException(status_code=400, detail="step must be a multiple of 60 seconds")
+    if end <= start:
+        raise HTTPException(status_code=400, detail="to must be after from")
+    if (end - start).total_seconds() / step > settings.series_max_points:
+        raise HTTPException(status_code=400, detail=f"Range too large for step: at most {settings.series_max_points} points")
 
-        return {
-            "users": user_counts,
-            "posts": {"total": total_posts},
-            "ads": ad_counts,
-            "events": {"total": total_events},
-            "polls": {"total": total_polls}
-        }
+    try:
+        return await series_store.query(metric, start, end, step, aggregate)
     except Exception as e:
-        logger.error(f"Error getting metrics: {e}")
-        return {"error": str(e)}
+        logger.error(f"Error querying series: {e}")
+        raise HTTPException(status_code=500, detail=f"Error querying series: {str(e)}")
 
 @app.get("/health")
 async def health_check():
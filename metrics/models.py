@@ -0,0 +1,22 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from datetime import datetime
+
+class MetricSample(BaseModel):
+    metric: str = Field(..., min_length=1, max_length=200)
+    value: float = 1
+    timestamp: Optional[datetime] = None
+
+class MetricSamples(BaseModel):
+    samples: List[MetricSample] = Field(..., min_items=1, max_items=1000)
+
+class SeriesPoint(BaseModel):
+    timestamp: datetime
+    value: Optional[float] = None
+
+class Series(BaseModel):
+    metric: str
+    rollup: str
+    step: int
+    aggregate: str
+    points: List[SeriesPoint]
@@ -0,0 +1,294 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from pymongo import IndexModel, ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from config import settings
+from database import get_client, get_metrics_collection
+
+logger = logging.getLogger(__name__)
+
+# Rollup name, bucket width in seconds and retention in seconds (None keeps forever)
+ROLLUPS = [
+    ("minute", 60, settings.series_minute_retention),
+    ("hour", 3600, settings.series_hour_retention),
+    ("day", 86400, None),
+]
+
+AGGREGATES = ("sum", "count", "avg", "min", "max", "last")
+
+# Counter fields whose increments are recorded as events: service -> {field: metric}
+EVENT_FIELDS = {
+    "polls": {"total_votes": "polls.votes"},
+    "ads": {"clicks": "ads.clicks"},
+}
+
+EPOCH = datetime(1970, 1, 1)
+
+# Server error code of a transaction on a standalone server
+ILLEGAL_OPERATION = 20
+
+def to_utc(timestamp: datetime) -> datetime:
+    """Get a naive UTC datetime, as stored by Mongo."""
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+def bucket_start(timestamp: datetime, width: int) -> datetime:
+    """Get the start of the bucket of the given width (in seconds) holding a timestamp."""
+    seconds = int((to_utc(timestamp) - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % width)
+
+def flatten(metrics: dict, prefix: str = "") -> dict:
+    """Flatten the nested /metrics response into {"users.active": 3, ...}."""
+    flat = {}
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def choose_rollup(step: int) -> Optional[tuple]:
+    """Get the coarsest rollup whose buckets evenly divide ``step``."""
+    fitting = [rollup for rollup in ROLLUPS if step % rollup[1] == 0]
+    return fitting[-1] if fitting else None
+
+class Bucket:
+    """Pre-aggregated samples of one metric over one rollup bucket."""
+
+    __slots__ = ("sum", "count", "min", "max", "last", "last_at")
+
+    def __init__(self):
+        self.sum = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.last_at = None
+
+    def add(self, value: float, timestamp: datetime):
+        self.sum += value
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if self.last_at is None or timestamp >= self.last_at:
+            self.last = value
+            self.last_at = timestamp
+
+    def merge(self, other: "Bucket"):
+        self.sum += other.sum
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        if self.last_at is None or other.last_at >= self.last_at:
+            self.last, self.last_at = other.last, other.last_at
+
+def pending_buckets() -> dict:
+    """Get empty pending buckets: {rollup name: {(metric, start): Bucket}}."""
+    return {name: defaultdict(Bucket) for name, _, _ in ROLLUPS}
+
+class SeriesStore:
+    """Time series kept as minute, hour and day rollup documents.
+
+    Samples are aggregated in memory per metric and bucket of every rollup,
+    then merged into the rollups with one upsert per bucket, so a year of
+    daily data is 365 small documents regardless of how many samples were
+    recorded. Minute and hour rollups expire through TTL indexes.
+
+    A flush writes every rollup in one transaction, together with the
+    counter store's resume tokens when it follows one: a failed flush
+    writes nothing and is retried whole, and after a restart the change
+    streams replay exactly the changes the series does not hold yet.
+    """
+
+    def __init__(self):
+        self._pending = pending_buckets()
+        self._tasks = []
+        self._counters = None
+        self._transactions = True
+
+    def follow(self, counters):
+        """Record the changes a counter store applies, saving its state with every flush."""
+        counters.add_listener(self.record_change, pre_images=tuple(EVENT_FIELDS))
+        counters.checkpointed = True
+        self._counters = counters
+
+    def record(self, metric: str, value: float = 1, timestamp: Optional[datetime] = None):
+        """Add a sample (an increment or a gauge reading) to a metric."""
+        timestamp = to_utc(timestamp) if timestamp else datetime.utcnow()
+        for name, width, _ in ROLLUPS:
+            self._pending[name][(metric, bucket_start(timestamp, width))].add(value, timestamp)
+
+    def record_change(self, service: str, change: dict):
+        """Record the events a collection change represents (counter store listener)."""
+        operation = change["operationType"]
+        # Changes replayed after a restart fall in the buckets they happened in
+        timestamp = change["clusterTime"].as_datetime() if "clusterTime" in change else None
+        if operation == "insert":
+            self.record(f"{service}.created", 1, timestamp)
+        elif operation == "delete":
+            self.record(f"{service}.deleted", 1, timestamp)
+        elif operation == "update":
+            updated = change["updateDescription"]["updatedFields"]
+            before = change.get("fullDocumentBeforeChange") or {}
+            for field, metric in EVENT_FIELDS.get(service, {}).items():
+                if field in updated:
+                    delta = updated[field] - before.get(field, 0)
+                    if before and delta > 0:
+                        self.record(metric, delta, timestamp)
+
+    async def ensure_indexes(self):
+        """Create the unique bucket index and the retention TTL of every rollup."""
+        for name, width, retention in ROLLUPS:
+            indexes = [IndexModel([("metric", ASCENDING), ("start", ASCENDING)], name="metric_start", unique=True)]
+            if retention:
+                indexes.append(IndexModel([("start", ASCENDING)], name="retention", expireAfterSeconds=retention))
+            await get_metrics_collection(f"{settings.series_collection_prefix}{name}").create_indexes(indexes)
+
+    async def flush(self):
+        """Merge the pending buckets into every rollup; failed writes are retried next time."""
+        checkpoint = self._counters.checkpoint() if self._counters else {}
+        if not any(self._pending.values()) and not checkpoint:
+            return
+        pending, self._pending = self._pending, pending_buckets()
+
+        if self._transactions:
+            try:
+                async with await get_client().start_session() as session:
+                    async with session.start_transaction():
+                        for name, _, _ in ROLLUPS:
+                            await self._write(name, pending[name], session)
+                        if checkpoint:
+                            await self._counters.save(checkpoint, session)
+            except OperationFailure as e:
+                if e.code != ILLEGAL_OPERATION:
+                    self._restore(pending)
+                    raise
+                # Nothing was written; without transactions the rollups are written one by one
+                logger.warning("Transactions need a replica set; series rollups are flushed without them")
+                self._transactions = False
+            except Exception:
+                self._restore(pending)
+                raise
+            else:
+                if checkpoint:
+                    self._counters.saved(checkpoint)
+                return
+
+        for i, (name, _, _) in enumerate(ROLLUPS):
+            try:
+                await self._write(name, pending[name])
+            except BulkWriteError as e:
+                # Only the failed updates of this rollup were not applied
+                keys = list(pending[name])
+                failed = [keys[error["index"]] for error in e.details.get("writeErrors", [])]
+                self._restore({name: {key: pending[name][key] for key in failed}})
+                self._restore({later: pending[later] for later, _, _ in ROLLUPS[i + 1:]})
+                raise
+            except Exception:
+                self._restore({later: pending[later] for later, _, _ in ROLLUPS[i:]})
+                raise
+
+    async def _write(self, name: str, buckets: dict, session=None):
+        if not buckets:
+            return
+        # A pipeline update, so "last" only moves when this flush holds a later sample than
+        # the stored one; fields referenced in the stage are read before it is applied
+        operations = [
+            UpdateOne(
+                {"metric": metric, "start": start},
+                [{"$set": {
+                    "sum": {"$add": [{"$ifNull": ["$sum", 0]}, {"$literal": bucket.sum}]},
+                    "count": {"$add": [{"$ifNull": ["$count", 0]}, {"$literal": bucket.count}]},
+                    "min": {"$min": ["$min", {"$literal": bucket.min}]},
+                    "max": {"$max": ["$max", {"$literal": bucket.max}]},
+                    "last": {"$cond": [
+                        {"$gte": [{"$literal": bucket.last_at}, {"$ifNull": ["$last_at", None]}]},
+                        {"$literal": bucket.last},
+                        "$last",
+                    ]},
+                    "last_at": {"$max": ["$last_at", {"$literal": bucket.last_at}]},
+                }}],
+                upsert=True
+            )
+            for (metric, start), bucket in buckets.items()
+        ]
+        await get_metrics_collection(f"{settings.series_collection_prefix}{name}").bulk_write(
+            operations, ordered=False, session=session
+        )
+
+    def _restore(self, pending: dict):
+        for name, buckets in pending.items():
+            for key, bucket in buckets.items():
+                self._pending[name][key].merge(bucket)
+
+    async def query(self, metric: str, start: datetime, end: datetime, step: int, aggregate: str) -> dict:
+        """Get a metric between ``start`` and ``end`` in ``step``-second points, from the coarsest rollup that fits."""
+        name, width, _ = choose_rollup(step)
+        step_ms = step * 1000
+        start_ms = {"$toLong": "$start"}
+        pipeline = [
+            {"$match": {"metric": metric, "start": {"$gte": bucket_start(start, width), "$lt": to_utc(end)}}},
+            {"$sort": {"start": 1}},
+            {"$group": {
+                "_id": {"$toDate": {"$subtract": [start_ms, {"$mod": [start_ms, step_ms]}]}},
+                "sum": {"$sum": "$sum"},
+                "count": {"$sum": "$count"},
+                "min": {"$min": "$min"},
+                "max": {"$max": "$max"},
+                "last": {"$last": "$last"},
+            }},
+            {"$sort": {"_id": 1}},
+        ]
+
+        points = []
+        async for group in get_metrics_collection(f"{settings.series_collection_prefix}{name}").aggregate(pipeline):
+            if aggregate == "avg":
+                value = group["sum"] / group["count"] if group["count"] else None
+            else:
+                value = group[aggregate]
+            points.append({"timestamp": group["_id"], "value": value})
+        return {"metric": metric, "rollup": name, "step": step, "aggregate": aggregate, "points": points}
+
+    def start(self, snapshot: Callable[[], Awaitable[dict]]):
+        """Start flushing samples and recording a snapshot of ``snapshot()`` periodically."""
+        self._tasks = [
+            asyncio.create_task(self._run_flush()),
+            asyncio.create_task(self._run_snapshots(snapshot)),
+        ]
+
+    async def stop(self):
+        """Stop the periodic tasks and flush what is pending."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Error flushing series: {e}")
+
+    async def _run_flush(self):
+        while True:
+            await asyncio.sleep(settings.series_flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing series: {e}")
+
+    async def _run_snapshots(self, snapshot: Callable[[], Awaitable[dict]]):
+        while True:
+            try:
+                for metric, value in flatten(await snapshot()).items():
+                    self.record(metric, value)
+            except Exception as e:
+                logger.error(f"Error recording metrics snapshot: {e}")
+            await asyncio.sleep(settings.series_snapshot_interval)
+
+series_store = SeriesStore()
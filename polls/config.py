@@ -8,6 +8,33 @@ class Settings(BaseSettings):
     mongodb_collection: str = "polls"
     mongodb_username: str = "admin"
     mongodb_password: str = "password"
+    # MongoDB runs as a replica set (change streams, transactions); with its name the client
+    # discovers the members, without it the configured host is connected to directly
+    mongodb_replica_set: str = ""
+    drop_unknown_indexes: bool = False
+    # Token internal callers send as X-Admin-Token to reach /admin/indexes; empty disables it
+    admin_token: str = ""
+    
+    # Pagination
+    count_cache_ttl: float = 5.0
+    
+    # Voting
+    vote_flush_interval: float = 1.0
+    poll_meta_ttl: float = 5.0
+    
+    # Voter deduplication
+    dedupe_votes: bool = True
+    voter_cookie_name: str = "voter"
+    voter_cookie_secret: str = "voter-secret"
+    voter_cookie_max_age: int = 365 * 24 * 3600
+    # Addresses or networks of the proxies whose X-Forwarded-For is trusted
+    trusted_proxies: list[str] = []
+    voters_collection: str = "poll_voters"
+    voter_exact_limit: int = 4096
+    voter_bloom_error_rate: float = 0.001
+    voter_cache_polls: int = 1000
+    voter_flush_interval: float = 5.0
+    voter_refresh_overlap: float = 5.0
     
     class Config:
         env_file = ".env"
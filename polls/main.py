@@ -1,13 +1,19 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime
 from bson import ObjectId
+import asyncio
+import hmac
 import logging
 from typing import List, Optional
 
 from config import settings
-from database import connect_to_mongo, close_mongo_connection, get_collection
+from instrumentation import instrument
+from database import connect_to_mongo, close_mongo_connection, get_collection, get_index_report
+from pagination import apply_cursor, sort_spec, next_cursor, count_cache
 from models import Poll, PollCreate, PollUpdate, PollList, VoteRequest
+from votes import poll_meta, vote_buffer, vote_update
+from voters import voter_registry, voter_hash, voter_identity, voter_cookie
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,12 +30,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+instrument(app, "polls")
+
+vote_flusher: Optional[asyncio.Task] = None
+voter_flusher: Optional[asyncio.Task] = None
+
 @app.on_event("startup")
 async def startup_db_client():
+    global vote_flusher, voter_flusher
     await connect_to_mongo()
+    vote_flusher = asyncio.create_task(vote_buffer.run(get_collection(settings.mongodb_collection)))
+    voter_flusher = asyncio.create_task(voter_registry.run(get_collection(settings.voters_collection)))
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in (vote_flusher, voter_flusher):
+        if task:
+            task.cancel()
+    try:
+        await vote_buffer.flush(get_collection(settings.mongodb_collection))
+        await voter_registry.flush(get_collection(settings.voters_collection))
+    except Exception as e:
+        logger.error(f"Error flushing votes on shutdown: {e}")
     await close_mongo_connection()
 
 @app.post("/polls", response_model=Poll)
@@ -49,6 +71,7 @@ async def create_poll(poll_data: PollCreate):
         poll_dict = {
             "question": poll_data.question,
             "is_active": poll_data.is_active,
+            "high_traffic": poll_data.high_traffic,
             "answers": answers,
             "total_votes": 0,
             "created_at": datetime.utcnow(),
@@ -56,6 +79,7 @@ async def create_poll(poll_data: PollCreate):
         }
         
         result = await collection.insert_one(poll_dict)
+        count_cache.clear()
         poll_dict["id"] = str(result.inserted_id)
         
         return Poll(**poll_dict)
@@ -68,7 +92,9 @@ async def create_poll(poll_data: PollCreate):
 async def list_polls(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
-    is_active: Optional[bool] = Query(None)
+    is_active: Optional[bool] = Query(None),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from a previous page's next_cursor; replaces skip"),
+    with_total: bool = Query(True, description="Include the (briefly cached) total count")
 ):
     """List polls with optional filtering."""
     try:
@@ -79,12 +105,15 @@ async def list_polls(
         if is_active is not None:
             filter_query["is_active"] = is_active
         
-        # Get total count
-        total = await collection.count_documents(filter_query)
+        # Get total count (optional, briefly cached)
+        total = await count_cache.count(collection, filter_query) if with_total else None
         
-        # Get polls with pagination
-        cursor = collection.find(filter_query).skip(skip).limit(limit).sort("created_at", -1)
-        polls = await cursor.to_list(length=limit)
+        # Get polls with keyset pagination when a cursor is given, offset pagination otherwise
+        page_query = apply_cursor(filter_query, "created_at", -1, cursor)
+        db_cursor = collection.find(page_query).sort(sort_spec("created_at", -1)).limit(limit)
+        if not cursor:
+            db_cursor = db_cursor.skip(skip)
+        polls = await db_cursor.to_list(length=limit)
         
         # Convert ObjectId to string
         for poll in polls:
@@ -92,9 +121,12 @@ async def list_polls(
         
         return PollList(
             polls=[Poll(**poll) for poll in polls],
-            total=total
+            total=total,
+            next_cursor=next_cursor(polls, "created_at", limit)
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error listing polls: {e}")
         raise HTTPException(status_code=500, detail=f"Error listing polls: {str(e)}")
@@ -157,6 +189,8 @@ async def update_poll(poll_id: str, poll_update: PollUpdate):
             {"_id": ObjectId(poll_id)},
             {"$set": update_data}
         )
+        count_cache.clear()
+        poll_meta.invalidate(poll_id)
         
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Poll not found")
@@ -180,6 +214,10 @@ async def delete_poll(poll_id: str):
         collection = get_collection(settings.mongodb_collection)
         
         result = await collection.delete_one({"_id": ObjectId(poll_id)})
+        count_cache.clear()
+        poll_meta.invalidate(poll_id)
+        vote_buffer.discard(poll_id)
+        await voter_registry.discard(get_collection(settings.voters_collection), poll_id)
         
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Poll not found")
@@ -193,43 +231,51 @@ async def delete_poll(poll_id: str):
         raise HTTPException(status_code=500, detail=f"Error deleting poll: {str(e)}")
 
 @app.post("/polls/{poll_id}/vote")
-async def vote_poll(poll_id: str, vote_data: VoteRequest):
-    """Vote on a poll."""
+async def vote_poll(poll_id: str, vote_data: VoteRequest, request: Request, response: Response):
+    """Vote on a poll.
+
+    Each voter (signed voter cookie, else client address) can vote once.
+    Votes are applied with an atomic $inc; polls flagged high_traffic are
+    buffered in memory and flushed in batches instead.
+    """
     try:
         collection = get_collection(settings.mongodb_collection)
         
-        # Get the poll
-        poll = await collection.find_one({"_id": ObjectId(poll_id)})
-        if not poll:
+        # Validate against cached poll metadata
+        meta = await poll_meta.get(collection, poll_id)
+        if meta is None:
             raise HTTPException(status_code=404, detail="Poll not found")
         
-        if not poll["is_active"]:
+        if not meta["is_active"]:
             raise HTTPException(status_code=400, detail="Poll is not active")
         
-        # Find the answer and update votes
-        answer_found = False
-        for answer in poll["answers"]:
-            if answer["id"] == vote_data.answer_id:
-                answer["votes"] += 1
-                answer_found = True
-                break
-        
-        if not answer_found:
+        if vote_data.answer_id not in meta["answer_ids"]:
             raise HTTPException(status_code=404, detail="Answer not found")
         
-        # Update total votes
-        poll["total_votes"] += 1
-        poll["updated_at"] = datetime.utcnow()
-        
-        # Update the poll in database
-        await collection.update_one(
-            {"_id": ObjectId(poll_id)},
-            {"$set": {
-                "answers": poll["answers"],
-                "total_votes": poll["total_votes"],
-                "updated_at": poll["updated_at"]
-            }}
-        )
+        voter = None
+        if settings.dedupe_votes:
+            identity = voter_identity(request)
+            voter = voter_hash(poll_id, identity)
+            if not await voter_registry.claim(get_collection(settings.voters_collection), poll_id, voter):
+                raise HTTPException(status_code=409, detail="Already voted")
+            # Follows the voter across networks; it only ever carries this identity
+            response.set_cookie(
+                settings.voter_cookie_name,
+                voter_cookie(identity),
+                max_age=settings.voter_cookie_max_age,
+                httponly=True,
+                samesite="lax"
+            )
+        
+        # The voter is only recorded once the vote is applied
+        try:
+            await apply_vote(collection, poll_id, vote_data.answer_id, meta["high_traffic"])
+        except BaseException:
+            if voter is not None:
+                voter_registry.release(poll_id, voter)
+            raise
+        if voter is not None:
+            voter_registry.commit(poll_id, voter)
         
         return {"message": "Vote recorded successfully"}
         
@@ -239,6 +285,27 @@ async def vote_poll(poll_id: str, vote_data: VoteRequest):
         logger.error(f"Error voting on poll: {e}")
         raise HTTPException(status_code=500, detail=f"Error voting on poll: {str(e)}")
 
+async def apply_vote(collection, poll_id: str, answer_id: str, high_traffic: bool):
+    """Count a vote, buffered or with an atomic $inc."""
+    if high_traffic:
+        vote_buffer.add(poll_id, answer_id)
+        return
+    
+    # Increment the answer and the total in a single atomic update
+    update, array_filters = vote_update({answer_id: 1})
+    result = await collection.update_one(
+        {"_id": ObjectId(poll_id), "is_active": True},
+        update,
+        array_filters=array_filters
+    )
+    
+    if result.matched_count == 0:
+        # The cached metadata was stale: the poll was closed or deleted meanwhile
+        poll_meta.invalidate(poll_id)
+        if await collection.find_one({"_id": ObjectId(poll_id)}, {"_id": 1}) is None:
+            raise HTTPException(status_code=404, detail="Poll not found")
+        raise HTTPException(status_code=400, detail="Poll is not active")
+
 @app.get("/polls/{poll_id}/results")
 async def get_poll_results(poll_id: str):
     """Get poll results with percentages."""
@@ -249,15 +316,18 @@ async def get_poll_results(poll_id: str):
         if not poll:
             raise HTTPException(status_code=404, detail="Poll not found")
         
-        total_votes = poll["total_votes"]
+        # Include votes buffered on this replica but not flushed yet
+        pending = vote_buffer.pending_for(poll_id)
+        total_votes = poll["total_votes"] + sum(pending.values())
         results = []
         
         for answer in poll["answers"]:
-            percentage = (answer["votes"] / total_votes * 100) if total_votes > 0 else 0
+            votes = answer["votes"] + pending.get(answer["id"], 0)
+            percentage = (votes / total_votes * 100) if total_votes > 0 else 0
             results.append({
                 "id": answer["id"],
                 "text": answer["text"],
-                "votes": answer["votes"],
+                "votes": votes,
                 "percentage": round(percentage, 2)
             })
         
@@ -274,6 +344,20 @@ async def get_poll_results(poll_id: str):
         logger.error(f"Error getting poll results: {e}")
         raise HTTPException(status_code=500, detail=f"Error getting poll results: {str(e)}")
 
+def require_admin_token(x_admin_token: Optional[str] = Header(None)):
+    """Only let internal callers presenting the configured admin token through."""
+    if not settings.admin_token or not x_admin_token or not hmac.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+
+@app.get("/admin/indexes", dependencies=[Depends(require_admin_token)])
+async def index_report():
+    """Report index usage and query shapes that are not served by an index (internal callers only)."""
+    try:
+        return await get_index_report()
+    except Exception as e:
+        logger.error(f"Error getting index report: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting index report: {str(e)}")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
@@ -15,15 +15,18 @@ class Answer(AnswerBase):
 class PollBase(BaseModel):
     question: str = Field(..., min_length=1, max_length=500)
     is_active: bool = True
+    high_traffic: bool = False
 
 class PollCreate(BaseModel):
     question: str = Field(..., min_length=1, max_length=500)
     answers: List[AnswerCreate] = Field(..., min_items=2)
     is_active: bool = True
+    high_traffic: bool = False
 
 class PollUpdate(BaseModel):
     question: Optional[str] = Field(None, min_length=1, max_length=500)
     is_active: Optional[bool] = None
+    high_traffic: Optional[bool] = None
 
 class Poll(PollBase):
     id: str
@@ -34,7 +37,8 @@ class Poll(PollBase):
 
 class PollList(BaseModel):
     polls: List[Poll]
-    total: int
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
 
 class VoteRequest(BaseModel):
     answer_id: str 
\ No newline at end of file
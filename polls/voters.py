@@ -0,0 +1,273 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import ipaddress
+import logging
+import math
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo.errors import BulkWriteError
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+def voter_hash(poll_id: str, identity: str) -> str:
+    """Hash a voter identity, salted with the poll so hashes are not linkable across polls."""
+    return hashlib.sha256(f"{poll_id}:{identity}".encode("utf-8")).hexdigest()[:32]
+
+def _sign(value: str) -> str:
+    return hmac.new(settings.voter_cookie_secret.encode("utf-8"), value.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def voter_cookie(identity: str) -> str:
+    """Get the signed voter cookie carrying an identity the service attributed a vote to."""
+    value = base64.urlsafe_b64encode(identity.encode("utf-8")).decode("ascii").rstrip("=")
+    return f"{value}.{_sign(value)}"
+
+def cookie_identity(cookie: str) -> Optional[str]:
+    """Get the identity of a voter cookie, or None if it was not issued by this service."""
+    value, _, signature = cookie.rpartition(".")
+    if not value or not hmac.compare_digest(signature, _sign(value)):
+        return None
+    try:
+        return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode("utf-8")
+    except ValueError:
+        return None
+
+def _trusted(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in ipaddress.ip_network(proxy, strict=False) for proxy in settings.trusted_proxies)
+
+def client_address(request) -> str:
+    """Get the client address; X-Forwarded-For is only read when the peer is a trusted proxy."""
+    address = request.client.host if request.client else "unknown"
+    if not _trusted(address):
+        return address
+    # The rightmost entry not added by one of our proxies is the client
+    for hop in reversed(request.headers.get("x-forwarded-for", "").split(",")):
+        hop = hop.strip()
+        if hop and not _trusted(hop):
+            return hop
+    return address
+
+def voter_identity(request) -> str:
+    """Get the identity a vote is attributed to: the signed voter cookie, then the client address.
+
+    The cookie only ever carries an identity a vote was already attributed
+    to, so clearing or forging cookies cannot mint new voters.
+    """
+    cookie = request.cookies.get(settings.voter_cookie_name)
+    if cookie:
+        identity = cookie_identity(cookie)
+        if identity:
+            return identity
+    return f"ip:{client_address(request)}"
+
+class BloomFilter:
+    """Fixed-size Bloom filter using double hashing over a SHA-256 digest."""
+
+    def __init__(self, size_bits: int, hash_count: int, bits: Optional[bytes] = None):
+        self.size_bits = size_bits
+        self.hash_count = hash_count
+        self.bits = bytearray(bits) if bits is not None else bytearray((size_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, error_rate: float) -> "BloomFilter":
+        """Create a filter sized for ``capacity`` items at the given false positive rate."""
+        size_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hash_count = max(1, round(size_bits / capacity * math.log(2)))
+        return cls(size_bits, hash_count)
+
+    def _positions(self, item: str):
+        digest = hashlib.sha256(item.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size_bits
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+class VoterSet:
+    """Voter hashes of one poll: an exact set, or a Bloom filter sized for the poll once it outgrows the limit.
+
+    A filter filled past its capacity is ``full``; the registry then drops it
+    so the next use rebuilds it from the stored voters at twice the size,
+    keeping the false positive rate bounded however large the poll grows.
+    """
+
+    def __init__(self, expected: int = 0):
+        self.members = set()
+        self.count = 0
+        self.bloom = None
+        self.capacity = 0
+        self.pending = set()
+        # A poll known to be large starts as a filter, so loading it never holds every voter
+        if expected > settings.voter_exact_limit:
+            self._to_bloom(expected)
+
+    @property
+    def full(self) -> bool:
+        return self.bloom is not None and self.count > self.capacity
+
+    def __contains__(self, voter: str) -> bool:
+        if self.bloom is not None:
+            return voter in self.bloom
+        return voter in self.members
+
+    def add(self, voter: str) -> bool:
+        """Record a voter; returns False if they were already known."""
+        if voter in self:
+            return False
+        if self.bloom is not None:
+            self.bloom.add(voter)
+        else:
+            self.members.add(voter)
+        self.count += 1
+        if self.bloom is None and self.count > settings.voter_exact_limit:
+            self._to_bloom()
+        return True
+
+    def _to_bloom(self, expected: int = 0):
+        self.capacity = 2 * max(self.count, expected)
+        self.bloom = BloomFilter.for_capacity(self.capacity, settings.voter_bloom_error_rate)
+        for member in self.members:
+            self.bloom.add(member)
+        self.members = set()
+
+class VoterRegistry:
+    """Per-poll voter sets kept in memory, backed by one document per voter.
+
+    The dedup check is an in-memory lookup. A voter is claimed while their
+    vote is written and only recorded once it is applied, so a failed write
+    does not lock them out. Recorded voters are inserted in the background,
+    and the sets loaded here pick up the voters other replicas recorded on
+    every flush, so replicas converge within a flush interval.
+    """
+
+    def __init__(self, max_polls: int):
+        self.max_polls = max_polls
+        self._sets = OrderedDict()
+        self._locks = {}
+        self._claims = {}
+        self._refreshed_at = datetime.utcnow()
+
+    async def load(self, collection, poll_id: str) -> VoterSet:
+        """Get the voter set of a poll, loading it from Mongo on first use."""
+        voters = self._sets.get(poll_id)
+        if voters is not None:
+            self._sets.move_to_end(poll_id)
+            return voters
+
+        lock = self._locks.setdefault(poll_id, asyncio.Lock())
+        async with lock:
+            voters = self._sets.get(poll_id)
+            if voters is None:
+                voters = VoterSet(await collection.count_documents({"poll_id": poll_id}))
+                async for document in collection.find({"poll_id": poll_id}, {"voter": 1}):
+                    voters.add(document["voter"])
+                self._sets[poll_id] = voters
+                self._evict()
+        self._locks.pop(poll_id, None)
+        return voters
+
+    def _evict(self):
+        # Sets with voters not stored yet, or votes in flight, must stay
+        for poll_id in list(self._sets):
+            if len(self._sets) <= self.max_polls:
+                break
+            if self._evictable(poll_id):
+                del self._sets[poll_id]
+
+    def _evictable(self, poll_id: str) -> bool:
+        return not self._sets[poll_id].pending and not self._claims.get(poll_id)
+
+    async def claim(self, collection, poll_id: str, voter: str) -> bool:
+        """Reserve a voter while their vote is applied; returns False if they already voted."""
+        voters = await self.load(collection, poll_id)
+        claims = self._claims.setdefault(poll_id, set())
+        if voter in voters or voter in claims:
+            return False
+        claims.add(voter)
+        return True
+
+    def release(self, poll_id: str, voter: str):
+        """Give a claim back after the vote failed."""
+        claims = self._claims.get(poll_id)
+        if claims is not None:
+            claims.discard(voter)
+            if not claims:
+                del self._claims[poll_id]
+
+    def commit(self, poll_id: str, voter: str):
+        """Record a claimed voter once their vote is applied."""
+        voters = self._sets.get(poll_id)
+        self.release(poll_id, voter)
+        if voters is not None and voters.add(voter):
+            voters.pending.add(voter)
+
+    async def discard(self, collection, poll_id: str):
+        """Forget the voters of a deleted poll."""
+        self._sets.pop(poll_id, None)
+        await collection.delete_many({"poll_id": poll_id})
+
+    async def flush(self, collection):
+        """Insert the voters recorded here since the last flush."""
+        now = datetime.utcnow()
+        for poll_id, voters in list(self._sets.items()):
+            if not voters.pending:
+                continue
+            pending, voters.pending = list(voters.pending), set()
+            try:
+                await collection.insert_many([
+                    {"_id": f"{poll_id}:{voter}", "poll_id": poll_id, "voter": voter, "at": now}
+                    for voter in pending
+                ], ordered=False)
+            except BulkWriteError as e:
+                # Voters another replica stored first are duplicates, not failures
+                failed = [error for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+                voters.pending.update(pending[error["index"]] for error in failed)
+                if failed:
+                    raise
+            except Exception:
+                voters.pending.update(pending)
+                raise
+
+    async def refresh(self, collection):
+        """Add the voters other replicas stored to the sets loaded here."""
+        started = datetime.utcnow()
+        if self._sets:
+            # Overlap the previous refresh for clock skew and inserts still in flight
+            since = self._refreshed_at - timedelta(seconds=settings.voter_refresh_overlap)
+            async for document in collection.find({"poll_id": {"$in": list(self._sets)}, "at": {"$gte": since}}, {"poll_id": 1, "voter": 1}):
+                voters = self._sets.get(document["poll_id"])
+                if voters is not None:
+                    voters.add(document["voter"])
+        self._refreshed_at = started
+
+        # Full filters are rebuilt larger from the stored voters on next use
+        for poll_id, voters in list(self._sets.items()):
+            if voters.full and self._evictable(poll_id):
+                del self._sets[poll_id]
+
+    async def run(self, collection):
+        """Store recorded voters and pick up other replicas' periodically until cancelled."""
+        while True:
+            await asyncio.sleep(settings.voter_flush_interval)
+            try:
+                await self.flush(collection)
+                await self.refresh(collection)
+            except Exception as e:
+                logger.error(f"Error syncing voters: {e}")
+
+voter_registry = VoterRegistry(settings.voter_cache_polls)
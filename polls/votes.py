@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+def vote_update(votes: dict) -> tuple[dict, list]:
+    """Build an atomic $inc update (and its array filters) for {answer_id: count}."""
+    increments = {"total_votes": sum(votes.values())}
+    array_filters = []
+    for i, (answer_id, count) in enumerate(votes.items()):
+        increments[f"answers.$[a{i}].votes"] = count
+        array_filters.append({f"a{i}.id": answer_id})
+    return {"$inc": increments, "$set": {"updated_at": datetime.utcnow()}}, array_filters
+
+class PollMetaCache:
+    """Short-lived cache of the poll fields the vote path validates against."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}
+
+    async def get(self, collection, poll_id: str) -> Optional[dict]:
+        """Get the vote metadata of a poll, or None if the poll does not exist."""
+        entry = self._entries.get(poll_id)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        poll = await collection.find_one(
+            {"_id": ObjectId(poll_id)},
+            {"is_active": 1, "high_traffic": 1, "answers.id": 1}
+        )
+        if poll is None:
+            self._entries.pop(poll_id, None)
+            return None
+
+        meta = {
+            "is_active": poll["is_active"],
+            "high_traffic": poll.get("high_traffic", False),
+            "answer_ids": {answer["id"] for answer in poll["answers"]},
+        }
+        self._entries[poll_id] = (now + self.ttl, meta)
+        return meta
+
+    def invalidate(self, poll_id: str):
+        """Forget the cached metadata of a poll."""
+        self._entries.pop(poll_id, None)
+
+class VoteBuffer:
+    """In-memory vote counts, flushed to Mongo in batches of atomic $inc updates.
+
+    Increments commute, so every replica can buffer and flush independently
+    without losing votes.
+    """
+
+    def __init__(self):
+        self._pending = defaultdict(lambda: defaultdict(int))
+        self._in_flight = {}
+
+    def add(self, poll_id: str, answer_id: str, count: int = 1):
+        """Buffer votes for an answer."""
+        self._pending[poll_id][answer_id] += count
+
+    def pending_for(self, poll_id: str) -> dict:
+        """Get the buffered, not yet flushed votes of a poll as {answer_id: count}."""
+        votes = dict(self._pending.get(poll_id, {}))
+        for answer_id, count in self._in_flight.get(poll_id, {}).items():
+            votes[answer_id] = votes.get(answer_id, 0) + count
+        return votes
+
+    def discard(self, poll_id: str):
+        """Drop the buffered votes of a poll, e.g. after it was deleted."""
+        self._pending.pop(poll_id, None)
+
+    async def flush(self, collection) -> int:
+        """Write every buffered vote with one bulk_write; returns the number of votes written."""
+        if not self._pending:
+            return 0
+
+        pending, self._pending = self._pending, defaultdict(lambda: defaultdict(int))
+        self._in_flight = pending
+        poll_ids = list(pending)
+        operations = []
+        for poll_id in poll_ids:
+            update, array_filters = vote_update(pending[poll_id])
+            operations.append(UpdateOne({"_id": ObjectId(poll_id)}, update, array_filters=array_filters))
+
+        try:
+            await collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Only the failed updates were not applied; keep them for the next flush
+            for error in e.details.get("writeErrors", []):
+                self._restore(poll_ids[error["index"]], pending[poll_ids[error["index"]]])
+            raise
+        except Exception:
+            for poll_id in poll_ids:
+                self._restore(poll_id, pending[poll_id])
+            raise
+        finally:
+            self._in_flight = {}
+
+        return sum(sum(votes.values()) for votes in pending.values())
+
+    def _restore(self, poll_id: str, votes: dict):
+        for answer_id, count in votes.items():
+            self._pending[poll_id][answer_id] += count
+
+    async def run(self, collection):
+        """Flush buffered votes periodically until cancelled."""
+        while True:
+            await asyncio.sleep(settings.vote_flush_interval)
+            try:
+                await self.flush(collection)
+            except Exception as e:
+                logger.error(f"Error flushing votes: {e}")
+
+poll_meta = PollMetaCache(settings.poll_meta_ttl)
+vote_buffer = VoteBuffer()
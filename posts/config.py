@@ -8,6 +8,28 @@ class Settings(BaseSettings):
     mongodb_collection: str = "posts"
     mongodb_username: str = "admin"
     mongodb_password: str = "password"
+    # MongoDB runs as a replica set (change streams, transactions); with its name the client
+    # discovers the members, without it the configured host is connected to directly
+    mongodb_replica_set: str = ""
+    drop_unknown_indexes: bool = False
+    # Token internal callers send as X-Admin-Token to reach /admin/indexes; empty disables it
+    admin_token: str = ""
+    
+    # Pagination
+    count_cache_ttl: float = 5.0
+    
+    # Markdown rendering
+    markdown_cache_size: int = 1024
+    markdown_render_workers: int = 2
+    markdown_render_queue_factor: int = 4
+    markdown_offload_threshold: int = 20000
+    markdown_render_batch_size: int = 100
+    
+    # Search
+    search_mode: str = "text"
+    search_language: str = "english"
+    search_count_limit: int = 1000
+    search_snippet_width: int = 160
     
     class Config:
         env_file = ".env"
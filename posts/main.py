@@ -1,14 +1,20 @@
-from fastapi import FastAPI, HTTPException, Query, Depends
+from fastapi import FastAPI, HTTPException, Query, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime
 from bson import ObjectId
+from pymongo import UpdateOne
+import asyncio
+import hmac
 import logging
 from typing import List, Optional
 
 from config import settings
-from database import connect_to_mongo, close_mongo_connection, get_collection
-from models import Post, PostCreate, PostUpdate, PostList
-from utils import markdown_to_html
+from instrumentation import instrument
+from database import connect_to_mongo, close_mongo_connection, get_collection, get_index_report
+from pagination import apply_cursor, sort_spec, next_cursor, count_cache
+from models import Post, PostCreate, PostUpdate, PostList, PostSearchHit, PostSearchList, RenderRequest, RenderResult
+from search import extract_terms, highlight_post
+from utils import render_markdown, render_cache, shutdown_renderer
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,6 +31,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+instrument(app, "posts")
+
 @app.on_event("startup")
 async def startup_db_client():
     await connect_to_mongo()
@@ -32,6 +40,7 @@ async def startup_db_client():
 @app.on_event("shutdown")
 async def shutdown_db_client():
     await close_mongo_connection()
+    shutdown_renderer()
 
 @app.post("/posts", response_model=Post)
 async def create_post(post_data: PostCreate):
@@ -42,9 +51,10 @@ async def create_post(post_data: PostCreate):
         post_dict = post_data.dict()
         post_dict["created_at"] = datetime.utcnow()
         post_dict["updated_at"] = datetime.utcnow()
-        post_dict["html_content"] = markdown_to_html(post_data.content)
+        post_dict["html_content"] = await render_markdown(post_data.content)
         
         result = await collection.insert_one(post_dict)
+        count_cache.clear()
         post_dict["id"] = str(result.inserted_id)
         
         return Post(**post_dict)
@@ -53,12 +63,66 @@ async def create_post(post_data: PostCreate):
         logger.error(f"Error creating post: {e}")
         raise HTTPException(status_code=500, detail=f"Error creating post: {str(e)}")
 
+@app.post("/posts/render", response_model=RenderResult)
+async def render_posts(render_request: RenderRequest):
+    """Re-render the HTML of stored posts, e.g. after a markdown extension upgrade."""
+    try:
+        collection = get_collection(settings.mongodb_collection)
+        batch_size = render_request.batch_size or settings.markdown_render_batch_size
+        
+        if render_request.clear_cache:
+            render_cache.clear()
+        
+        # Build filter
+        filter_query = {}
+        if render_request.post_ids:
+            invalid = [post_id for post_id in render_request.post_ids if not ObjectId.is_valid(post_id)]
+            if invalid:
+                raise HTTPException(status_code=400, detail=f"Invalid post ids: {', '.join(invalid)}")
+            filter_query["_id"] = {"$in": [ObjectId(post_id) for post_id in render_request.post_ids]}
+        
+        rendered = 0
+        updated = 0
+        batch = []
+        cursor = collection.find(filter_query, {"content": 1}).batch_size(batch_size)
+        async for post in cursor:
+            batch.append(post)
+            if len(batch) >= batch_size:
+                updated += await _rerender_batch(collection, batch)
+                rendered += len(batch)
+                batch = []
+        if batch:
+            updated += await _rerender_batch(collection, batch)
+            rendered += len(batch)
+        
+        return RenderResult(rendered=rendered, updated=updated, cache=render_cache.stats())
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rendering posts: {e}")
+        raise HTTPException(status_code=500, detail=f"Error rendering posts: {str(e)}")
+
+async def _rerender_batch(collection, posts: list) -> int:
+    """Render a batch of posts on the process pool and write the HTML back in one round trip."""
+    html_contents = await asyncio.gather(
+        *[render_markdown(post.get("content", ""), offload=True) for post in posts]
+    )
+    operations = [
+        UpdateOne({"_id": post["_id"]}, {"$set": {"html_content": html}})
+        for post, html in zip(posts, html_contents)
+    ]
+    result = await collection.bulk_write(operations, ordered=False)
+    return result.modified_count
+
 @app.get("/posts", response_model=PostList)
 async def list_posts(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
     is_active: Optional[bool] = Query(None),
-    author: Optional[str] = Query(None)
+    author: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from a previous page's next_cursor; replaces skip"),
+    with_total: bool = Query(True, description="Include the (briefly cached) total count")
 ):
     """List blog posts with optional filtering."""
     try:
@@ -71,12 +135,15 @@ async def list_posts(
         if author:
             filter_query["author"] = {"$regex": author, "$options": "i"}
         
-        # Get total count
-        total = await collection.count_documents(filter_query)
+        # Get total count (optional, briefly cached)
+        total = await count_cache.count(collection, filter_query) if with_total else None
         
-        # Get posts with pagination
-        cursor = collection.find(filter_query).skip(skip).limit(limit).sort("created_at", -1)
-        posts = await cursor.to_list(length=limit)
+        # Get posts with keyset pagination when a cursor is given, offset pagination otherwise
+        page_query = apply_cursor(filter_query, "created_at", -1, cursor)
+        db_cursor = collection.find(page_query).sort(sort_spec("created_at", -1)).limit(limit)
+        if not cursor:
+            db_cursor = db_cursor.skip(skip)
+        posts = await db_cursor.to_list(length=limit)
         
         # Convert ObjectId to string
         for post in posts:
@@ -84,9 +151,12 @@ async def list_posts(
         
         return PostList(
             posts=[Post(**post) for post in posts],
-            total=total
+            total=total,
+            next_cursor=next_cursor(posts, "created_at", limit)
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error listing posts: {e}")
         raise HTTPException(status_code=500, detail=f"Error listing posts: {str(e)}")
@@ -127,13 +197,14 @@ async def update_post(post_id: str, post_update: PostUpdate):
         
         # Update HTML content if content is being updated
         if "content" in update_data:
-            update_data["html_content"] = markdown_to_html(update_data["content"])
+            update_data["html_content"] = await render_markdown(update_data["content"])
         
         # Update the post
         result = await collection.update_one(
             {"_id": ObjectId(post_id)},
             {"$set": update_data}
         )
+        count_cache.clear()
         
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Post not found")
@@ -157,6 +228,7 @@ async def delete_post(post_id: str):
         collection = get_collection(settings.mongodb_collection)
         
         result = await collection.delete_one({"_id": ObjectId(post_id)})
+        count_cache.clear()
         
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Post not found")
@@ -187,42 +259,93 @@ async def get_post_html(post_id: str):
         logger.error(f"Error getting post HTML: {e}")
         raise HTTPException(status_code=500, detail=f"Error getting post HTML: {str(e)}")
 
-@app.get("/posts/search/{query}")
-async def search_posts(query: str, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)):
-    """Search posts by title, description, or content."""
+@app.get("/posts/search/{query}", response_model=PostSearchList)
+async def search_posts(
+    query: str,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    mode: str = Query(settings.search_mode, pattern="^(text|regex)$")
+):
+    """Search posts by title, description, content, or author.
+
+    The default ``text`` mode uses the weighted text index and returns hits ranked
+    by relevance with highlighted snippets; ``regex`` keeps the legacy substring scan.
+    """
     try:
         collection = get_collection(settings.mongodb_collection)
         
-        # Create search filter
-        search_filter = {
-            "$or": [
-                {"title": {"$regex": query, "$options": "i"}},
-                {"description": {"$regex": query, "$options": "i"}},
-                {"content": {"$regex": query, "$options": "i"}},
-                {"author": {"$regex": query, "$options": "i"}}
-            ]
-        }
+        if mode == "regex":
+            return await _regex_search(collection, query, skip, limit)
         
-        # Get total count
-        total = await collection.count_documents(search_filter)
+        search_filter = {"$text": {"$search": query}}
+        score = {"$meta": "textScore"}
         
-        # Get posts with pagination
-        cursor = collection.find(search_filter).skip(skip).limit(limit).sort("created_at", -1)
-        posts = await cursor.to_list(length=limit)
+        # Count is capped so it stays cheap for broad queries
+        cursor = collection.find(search_filter, {"score": score}).sort([("score", score)]).skip(skip).limit(limit)
+        total, posts = await asyncio.gather(
+            collection.count_documents(search_filter, limit=settings.search_count_limit),
+            cursor.to_list(length=limit)
+        )
         
-        # Convert ObjectId to string
+        terms = extract_terms(query)
+        hits = []
         for post in posts:
             post["id"] = str(post["_id"])
+            post["highlights"] = highlight_post(post, terms)
+            hits.append(PostSearchHit(**post))
         
-        return PostList(
-            posts=[Post(**post) for post in posts],
-            total=total
+        return PostSearchList(
+            posts=hits,
+            total=total,
+            total_is_estimate=total >= settings.search_count_limit
         )
         
     except Exception as e:
         logger.error(f"Error searching posts: {e}")
         raise HTTPException(status_code=500, detail=f"Error searching posts: {str(e)}")
 
+async def _regex_search(collection, query: str, skip: int, limit: int) -> PostSearchList:
+    """Legacy unindexed substring search over the four text fields."""
+    # Create search filter
+    search_filter = {
+        "$or": [
+            {"title": {"$regex": query, "$options": "i"}},
+            {"description": {"$regex": query, "$options": "i"}},
+            {"content": {"$regex": query, "$options": "i"}},
+            {"author": {"$regex": query, "$options": "i"}}
+        ]
+    }
+    
+    # Get total count
+    total = await collection.count_documents(search_filter)
+    
+    # Get posts with pagination
+    cursor = collection.find(search_filter).skip(skip).limit(limit).sort("created_at", -1)
+    posts = await cursor.to_list(length=limit)
+    
+    # Convert ObjectId to string
+    for post in posts:
+        post["id"] = str(post["_id"])
+    
+    return PostSearchList(
+        posts=[PostSearchHit(**post) for post in posts],
+        total=total
+    )
+
+def require_admin_token(x_admin_token: Optional[str] = Header(None)):
+    """Only let internal callers presenting the configured admin token through."""
+    if not settings.admin_token or not x_admin_token or not hmac.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+
+@app.get("/admin/indexes", dependencies=[Depends(require_admin_token)])
+async def index_report():
+    """Report index usage and query shapes that are not served by an index (internal callers only)."""
+    try:
+        return await get_index_report()
+    except Exception as e:
+        logger.error(f"Error getting index report: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting index report: {str(e)}")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 
 class PostBase(BaseModel):
@@ -27,4 +27,24 @@ class Post(PostBase):
 
 class PostList(BaseModel):
     posts: List[Post]
-    total: int 
\ No newline at end of file
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
+
+class PostSearchHit(Post):
+    score: Optional[float] = None
+    highlights: Dict[str, str] = {}
+
+class PostSearchList(BaseModel):
+    posts: List[PostSearchHit]
+    total: int
+    total_is_estimate: bool = False
+
+class RenderRequest(BaseModel):
+    post_ids: Optional[List[str]] = None
+    batch_size: Optional[int] = Field(None, ge=1, le=1000)
+    clear_cache: bool = False
+
+class RenderResult(BaseModel):
+    rendered: int
+    updated: int
+    cache: dict
@@ -0,0 +1,93 @@
+import html
+import re
+from typing import Optional
+
+from config import settings
+
+TEXT_INDEX_NAME = "posts_text"
+TEXT_INDEX_WEIGHTS = {"title": 10, "description": 5, "author": 3, "content": 1}
+
+def extract_terms(query: str) -> list[str]:
+    """Extract the positive search terms from a text query."""
+    terms = []
+    for term in re.findall(r'-?"[^"]+"|-?\S+', query):
+        if term.startswith("-"):
+            continue
+        term = term.strip('"').strip()
+        if term:
+            terms.append(term)
+    return terms
+
+# English inflections stripped from a word to find the stem $text matches it by, longest first
+_SUFFIXES = ("ingly", "edly", "ings", "ing", "ies", "ied", "ers", "est", "ed", "es", "er", "ly", "s", "y")
+
+def word_stem(word: str) -> str:
+    """Approximate the stem $text reduces an English word to, as a prefix of its other forms.
+
+    A light suffix stripper rather than Snowball: it only has to find the
+    prefix shared by "run", "runs" and "running", so a stem slightly too
+    short costs an extra highlight, never a missing one.
+    """
+    word = word.lower()
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            break
+    # "running" -> "runn" -> "run"
+    if len(word) > 3 and word[-1] == word[-2] and word[-1] not in "aeiouls":
+        word = word[:-1]
+    return word
+
+def _term_pattern(term: str) -> str:
+    # Phrases match as written; single words by their stem, so any inflection $text matched is highlighted
+    if " " in term or settings.search_language not in ("english", "en"):
+        return re.escape(term)
+    return re.escape(word_stem(term)) + r"\w*"
+
+def _terms_pattern(terms: list[str]) -> Optional[re.Pattern]:
+    if not terms:
+        return None
+    alternatives = sorted((_term_pattern(term) for term in terms), key=len, reverse=True)
+    return re.compile(r"\b(?:" + "|".join(alternatives) + ")", re.IGNORECASE)
+
+def highlight(text: str, terms: list[str], width: Optional[int] = None) -> Optional[str]:
+    """Return an HTML-escaped snippet of ``text`` around the first match, with matches in <mark>.
+
+    Returns None when no term occurs in the text.
+    """
+    pattern = _terms_pattern(terms)
+    if not text or pattern is None:
+        return None
+
+    first = pattern.search(text)
+    if first is None:
+        return None
+
+    width = width or settings.search_snippet_width
+    start = max(0, first.start() - width // 2)
+    end = min(len(text), start + width)
+    window = text[start:end]
+
+    parts = []
+    position = 0
+    for match in pattern.finditer(window):
+        parts.append(html.escape(window[position:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group(0))}</mark>")
+        position = match.end()
+    parts.append(html.escape(window[position:]))
+
+    snippet = "".join(parts)
+    if start > 0:
+        snippet = "…" + snippet
+    if end < len(text):
+        snippet = snippet + "…"
+    return snippet
+
+def highlight_post(post: dict, terms: list[str]) -> dict:
+    """Build highlighted snippets for every searchable field of a post that matches."""
+    highlights = {}
+    for field in TEXT_INDEX_WEIGHTS:
+        snippet = highlight(post.get(field, ""), terms)
+        if snippet is not None:
+            highlights[field] = snippet
+    return highlights
@@ -1,10 +1,142 @@
-import markdown
+import asyncio
+import hashlib
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 
+import markdown
+
+from config import settings
+
+MARKDOWN_EXTENSIONS = ['extra', 'codehilite', 'toc']
+
+# One pre-built Markdown instance per thread (and per pool worker process)
+_local = threading.local()
+
+def _get_markdown() -> markdown.Markdown:
+    """Get the reusable Markdown instance for the current thread."""
+    md = getattr(_local, "md", None)
+    if md is None:
+        md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+        _local.md = md
+    return md
+
+def _render(markdown_content: str) -> str:
+    """Render markdown with the pre-built instance, resetting it afterwards."""
+    md = _get_markdown()
+    try:
+        return md.convert(markdown_content)
+    finally:
+        md.reset()
+
+class RenderCache:
+    """LRU cache of rendered HTML keyed by a hash of the markdown source."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(markdown_content: str) -> str:
+        """Get the cache key for a markdown source."""
+        return hashlib.sha256(markdown_content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Get cached HTML, marking it as most recently used."""
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def set(self, key: str, html: str):
+        """Store rendered HTML, evicting the least recently used entries."""
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Get cache statistics."""
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+render_cache = RenderCache(settings.markdown_cache_size)
+
+_executor: Optional[ProcessPoolExecutor] = None
+_render_slots: Optional[asyncio.Semaphore] = None
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Get the render process pool, creating it on first use."""
+    global _executor
+    if _executor is None:
+        # Spawned, not forked: by now Motor's threads are running and a fork would copy their locks
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.markdown_render_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+def _get_render_slots() -> asyncio.Semaphore:
+    """Get the semaphore bounding renders queued on the process pool."""
+    global _render_slots
+    if _render_slots is None:
+        _render_slots = asyncio.Semaphore(settings.markdown_render_workers * settings.markdown_render_queue_factor)
+    return _render_slots
+
 def markdown_to_html(markdown_content: str) -> str:
     """Convert markdown content to HTML."""
-    md = markdown.Markdown(extensions=['extra', 'codehilite', 'toc'])
-    return md.convert(markdown_content)
+    key = render_cache.key(markdown_content)
+    html = render_cache.get(key)
+    if html is None:
+        html = _render(markdown_content)
+        render_cache.set(key, html)
+    return html
+
+async def render_markdown(markdown_content: str, offload: Optional[bool] = None) -> str:
+    """Convert markdown content to HTML without blocking the event loop.
+
+    Large documents (or every document when ``offload`` is True) are rendered
+    on the bounded process pool; small ones are rendered inline.
+    """
+    key = render_cache.key(markdown_content)
+    html = render_cache.get(key)
+    if html is not None:
+        return html
+
+    if offload is None:
+        offload = len(markdown_content) >= settings.markdown_offload_threshold
+
+    if offload:
+        async with _get_render_slots():
+            loop = asyncio.get_running_loop()
+            html = await loop.run_in_executor(_get_executor(), _render, markdown_content)
+    else:
+        html = _render(markdown_content)
+
+    render_cache.set(key, html)
+    return html
+
+def shutdown_renderer():
+    """Shut down the render process pool."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
 
 def extract_media_urls(content: str) -> list[str]:
     """Extract media URLs from markdown content."""
@@ -12,4 +144,4 @@ def extract_media_urls(content: str) -> list[str]:
     # Look for image patterns in markdown
     image_pattern = r'!\[.*?\]\((.*?)\)'
     urls = re.findall(image_pattern, content)
-    return urls 
\ No newline at end of file
+    return urls